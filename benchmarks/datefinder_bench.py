@@ -0,0 +1,85 @@
+'''
+Compares the datefinder tokenizer with the regex it replaced.
+
+Run from the repository root: python benchmarks/datefinder_bench.py
+'''
+from __future__ import print_function
+import os
+import re
+import sys
+import timeit
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from tombot import datefinder # pylint: disable=wrong-import-position
+
+
+# The pre-tokenizer implementation, kept here for comparison only.
+SEP_PART = '({})*'.format('|'.join([r'\s', ',', 'en', 'and', '&']))
+PARTS = []
+for _name, _words in zip(('years', 'weeks', 'days', 'hours', 'minutes'),
+                         datefinder.WORDS):
+    PARTS.append(r'((?P<{}>\d+)\s*?({}){})?'.format(_name, '|'.join(_words), SEP_PART))
+PARTS.append(r'((?P<seconds>\d+)\s*?({}))?'.format('|'.join(datefinder.SECOND_WORDS)))
+LEGACY_REGEX = re.compile(''.join(PARTS), re.IGNORECASE)
+LEGACY_CLOCK_REGEX = re.compile(
+    r'((om|at)\s?)?((?P<hour>\d{1,2})(:?((?P<minute>\d{2})(:?(?P<second>\d{2}))?)?))',
+    re.IGNORECASE)
+
+def legacy_find_timedelta(text):
+    ''' The old find_timedelta. '''
+    match = None
+    for res in LEGACY_REGEX.findall(text):
+        if any(res):
+            match = res
+            break
+    if not match:
+        raise ValueError('Could not extract duration!')
+    values = [int(match[i]) if match[i] else 0 for i in (1, 5, 9, 13, 17, 21)]
+    return timedelta(days=values[2] + 7 * values[1] + 365 * values[0],
+                     hours=values[3], minutes=values[4], seconds=values[5])
+
+def legacy_find_first_time(text):
+    ''' The matching part of the old find_first_time. '''
+    return LEGACY_CLOCK_REGEX.search(text)
+
+FILLER = 'dit is een heel lang bericht zonder tijden erin, echt waar. '
+
+def messages(length):
+    '''
+    Return test messages of about length characters.
+
+    (duration first, duration last, clock time last)
+    '''
+    padding = FILLER * (length // len(FILLER) + 1)
+    return ('over 2 uur en 30 minuten ' + padding[:length],
+            padding[:length] + ' over 2 uur en 30 minuten',
+            padding[:length] + ' om 15:30')
+
+def bench(func, text, number):
+    ''' Return microseconds per call. '''
+    timer = timeit.Timer(lambda: func(text))
+    return min(timer.repeat(3, number)) / number * 1e6
+
+def main():
+    ''' Print a comparison table. '''
+    header = '{:>7} | {:>12} {:>12} | {:>12} {:>12} | {:>12} {:>12}'
+    row = '{:>7} | {:>10.1f}us {:>10.1f}us | {:>10.1f}us {:>10.1f}us | {:>10.1f}us {:>10.1f}us'
+    print(header.format('length', 'first old', 'first new', 'last old', 'last new',
+                        'clock old', 'clock new'))
+    for length in (20, 200, 2000, 20000):
+        number = max(10, 20000 // length)
+        first_msg, last_msg, clock_msg = messages(length)
+        for msg in (first_msg, last_msg):
+            assert legacy_find_timedelta(msg) == datefinder.find_timedelta(msg)
+        print(row.format(
+            length,
+            bench(legacy_find_timedelta, first_msg, number),
+            bench(datefinder.find_timedelta, first_msg, number),
+            bench(legacy_find_timedelta, last_msg, number),
+            bench(datefinder.find_timedelta, last_msg, number),
+            bench(legacy_find_first_time, clock_msg, number),
+            bench(datefinder.scan_clock, clock_msg, number)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+'''
+Times the bot's hot functions and compares them with a saved baseline.
+
+A bot is built with the replay harness against a temporary database with
+many users, so routing, mentions and user lookups see realistic tables.
+
+Run from the repository root:
+    python benchmarks/microbench.py --save     # record a baseline
+    python benchmarks/microbench.py            # compare with it
+
+Each benchmark is timed several times, in turns with the other benchmarks
+so the timings are spread over the whole run, and the medians are
+compared. A fixed reference workload is timed along with them; the
+baseline is scaled by how much slower or faster it ran, to make up for a
+machine that is busier than when the baseline was saved. A benchmark only
+counts as slower if the difference is both above the threshold and well
+outside the spread of the timings, so a noisy run does not fail.
+
+Exits with status 1 if a benchmark got slower than that allows.
+'''
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict, namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+#pylint: disable=wrong-import-position
+import tombot # installs _()
+from apscheduler.schedulers.background import BackgroundScheduler
+from tombot import datefinder, plugins
+from tombot.helper_functions import determine_sender, extract_query
+from tombot.replay import (ReplayLayer, ReplayMessage, GROUP_JID, build_config,
+                           create_database, user_jid)
+from tombot.view import MessageView
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'microbench_baseline.json')
+DEFAULT_THRESHOLD = 0.25    # 25% slower is a regression...
+NOISE_FACTOR = 3            # ...if also this many times the spreads slower
+DEFAULT_REPEAT = 7
+REFERENCE = '_reference'    # baseline key of the reference workload
+USERS = 1000                # size of the user and nick tables
+FILLER = 'dit is een heel lang bericht zonder commando, echt waar. '
+
+def long_text(length):
+    ''' Return filler text of about length characters. '''
+    return (FILLER * (length // len(FILLER) + 1))[:length]
+
+def private(body):
+    ''' Return a private message from user 2. '''
+    return ReplayMessage('bench', user_jid(2), body)
+
+def group(body):
+    ''' Return a group message from user 2. '''
+    return ReplayMessage('bench', GROUP_JID, body, user_jid(2))
+
+def reference():
+    ''' Plain Python work whose speed only depends on the machine. '''
+    total = 0
+    for num in range(1000):
+        total += num * num % 7
+    return total
+
+def build_cases(bot):
+    ''' Return an OrderedDict of benchmark name -> function without arguments. '''
+    # Imported here, the bot must have loaded them first
+    from tombot.plugins import diceroll_plugin, doekoe_plugin, users_plugin
+    from tombot.plugins.mention_plugin import MENTIONS
+
+    cases = OrderedDict()
+    many_mentions = ' '.join('@user{}'.format(num) for num in range(1, 1000, 20))
+    now = datetime.datetime(2016, 3, 14, 12, 0)
+    messages = {
+        'private_cmd': private('ping'),
+        'group_cmd': group('bot roll 2d6+3'),
+        'group_chatter': group(long_text(2000)),
+        'private_long': private('roll 2d6 ' + long_text(2000)),
+        }
+
+    # Routing and reacting
+    for name, message in sorted(messages.items()):
+        cases['route.' + name] = (
+            lambda body=message.getBody(), isgroup=bool(message.participant):
+            bot.router.route(body, require_trigger=isgroup))
+    views = {name: MessageView.route_message(message, bot.router)
+             for name, message in messages.items()}
+    for name, message in sorted(messages.items()):
+        cases['view.' + name] = (
+            lambda message=message: MessageView.route_message(message, bot.router))
+    cases['react.ping'] = lambda: bot.react(messages['private_cmd'], views['private_cmd'])
+    cases['react.group_roll'] = lambda: bot.react(messages['group_cmd'], views['group_cmd'])
+    cases['react.group_chatter'] = (
+        lambda: bot.react(messages['group_chatter'], views['group_chatter']))
+
+    # Helpers
+    cases['extract_query.group'] = lambda: extract_query(messages['group_cmd'])
+    cases['extract_query.long'] = lambda: extract_query(messages['private_long'])
+    cases['extract_query.view_long'] = lambda: extract_query(views['private_long'])
+    cases['determine_sender.group'] = lambda: determine_sender(messages['group_cmd'])
+    cases['determine_sender.private'] = lambda: determine_sender(messages['private_cmd'])
+
+    # Mentions, with USERS nicks
+    cases['mentions.none_long'] = lambda: MENTIONS.find(bot, long_text(2000))
+    cases['mentions.one'] = lambda: MENTIONS.find(bot, 'hey @user500 kijk hier eens naar')
+    cases['mentions.many'] = lambda: MENTIONS.find(bot, many_mentions)
+
+    # Reminder parsing
+    cases['datefinder.timedelta_short'] = (
+        lambda: datefinder.find_timedelta('over 2 uur en 30 minuten'))
+    cases['datefinder.timedelta_long'] = (
+        lambda: datefinder.find_timedelta(long_text(2000) + ' over 2 uur en 30 minuten'))
+    cases['datefinder.first_time'] = (
+        lambda: datefinder.find_first_time('bel mama om 15:30 over de verjaardag'))
+    cases['datefinder.first_time_long'] = (
+        lambda: datefinder.find_first_time(long_text(2000) + ' om 15:30'))
+    cases['datefinder.parse_duration'] = lambda: datefinder.parse_reminder_time(
+        'remind me in 10 minutes to stretch', now)
+    cases['datefinder.parse_clock_long'] = lambda: datefinder.parse_reminder_time(
+        'remind me ' + long_text(500) + ' om 15:30', now)
+
+    def parse_uncached(text):
+        ''' Parse a reminder without help from the parse cache. '''
+        datefinder.PARSE_CACHE.clear()
+        return datefinder.parse_reminder_time(text, now)
+    cases['datefinder.parse_duration_uncached'] = lambda: parse_uncached(
+        'remind me in 10 minutes to stretch')
+    cases['datefinder.parse_clock_long_uncached'] = lambda: parse_uncached(
+        'remind me ' + long_text(500) + ' om 15:30')
+
+    # Plugins
+    cases['diceroll.small'] = lambda: diceroll_plugin.diceroll_cb(
+        bot, private('roll 2d6+3'))
+    cases['diceroll.large'] = lambda: diceroll_plugin.diceroll_cb(
+        bot, private('roll 50d100 * 2'))
+    cases['doekoe.neo'] = lambda: doekoe_plugin.doekoe_neo(now)
+    cases['doekoe.message'] = doekoe_plugin.doekoe
+
+    # User lookups
+    cases['users.nick_to_jid'] = lambda: users_plugin.nick_to_jid(bot, 'user500')
+    cases['users.jid_to_nick'] = lambda: users_plugin.jid_to_nick(bot, user_jid(500))
+    def nick_to_jid_miss():
+        ''' Look up a nick that does not exist. '''
+        try:
+            users_plugin.nick_to_jid(bot, 'nobody')
+        except KeyError:
+            pass
+    cases['users.nick_to_jid_miss'] = nick_to_jid_miss
+    cases['users.isadmin'] = lambda: users_plugin.isadmin(bot, messages['group_cmd'])
+    return cases
+
+# median: median time per call in microseconds
+# spread: median absolute deviation of the timings from it
+Timing = namedtuple('Timing', 'median spread')
+
+def median(values):
+    ''' Return the median of a non-empty list of numbers. '''
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def calibrate(timer, min_time=0.04):
+    ''' Return how many calls of timer take at least min_time. '''
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time or number >= 10 ** 6:
+            return number
+        number *= 10
+
+def measure(cases, repeat=DEFAULT_REPEAT):
+    '''
+    Return an OrderedDict of benchmark name -> Timing.
+
+    Every round times each benchmark once, so a slow moment of the machine
+    shows up as spread in all benchmarks instead of slowing down a few.
+    '''
+    timers = OrderedDict((name, timeit.Timer(func)) for name, func in cases.items())
+    numbers = {name: calibrate(timer) for name, timer in timers.items()}
+    times = {name: [] for name in timers}
+    for dummy in range(repeat):
+        for name, timer in timers.items():
+            times[name].append(timer.timeit(numbers[name]) / numbers[name] * 1e6)
+    results = OrderedDict()
+    for name in timers:
+        middle = median(times[name])
+        results[name] = Timing(middle, median([abs(value - middle) for value in times[name]]))
+    return results
+
+def load_timing(entry):
+    ''' Return a baseline entry as Timing; old baselines hold only the time. '''
+    if isinstance(entry, dict):
+        return Timing(float(entry['median']), float(entry.get('spread', 0.0)))
+    return Timing(float(entry), 0.0)
+
+def scale_baseline(results, baseline):
+    '''
+    Return the baseline as Timings, scaled by the speed of the machine now
+    compared to when it was saved, and that factor.
+    '''
+    timings = {name: load_timing(entry) for name, entry in baseline.items()}
+    factor = 1.0
+    old = timings.get(REFERENCE)
+    if old is not None and old.median and REFERENCE in results:
+        factor = results[REFERENCE].median / old.median
+    return {name: Timing(timing.median * factor, timing.spread * factor)
+            for name, timing in timings.items()}, factor
+
+def is_regression(now, old, threshold):
+    '''
+    Return whether now is slower than old by more than threshold and by
+    more than NOISE_FACTOR times the spread of both.
+    '''
+    slowdown = now.median - old.median
+    if not old.median or slowdown / old.median <= threshold:
+        return False
+    return slowdown > NOISE_FACTOR * (now.spread + old.spread)
+
+def compare(results, baseline, threshold):
+    ''' Print results next to the baseline, return the names that regressed. '''
+    regressed = []
+    baseline, factor = scale_baseline(results, baseline)
+    print('Machine speed compared to the baseline: {:.2f}x the time'.format(factor))
+    print('{:<36} {:>18} {:>18} {:>8}'.format('benchmark', 'now', 'baseline', 'change'))
+    for name, now in results.items():
+        if name == REFERENCE:
+            continue
+        if name not in baseline:
+            print('{:<36} {:>10.2f}+-{:<6.2f} {:>18} {:>8}'.format(
+                name, now.median, now.spread, '-', 'new'))
+            continue
+        old = baseline[name]
+        change = now.median / old.median - 1 if old.median else 0.0
+        flag = ''
+        if is_regression(now, old, threshold):
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print('{:<36} {:>10.2f}+-{:<6.2f} {:>10.2f}+-{:<6.2f} {:>+7.0%}{}'.format(
+            name, now.median, now.spread, old.median, old.spread, change, flag))
+    return regressed
+
+def main():
+    ''' Run the benchmarks, compare or save them. '''
+    parser = argparse.ArgumentParser(description='Benchmark the bot\'s hot functions')
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('-s', '--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown as a fraction (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='timings per benchmark, the median is used '
+                        '(default: %(default)s)')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix='tombot-bench-')
+    database = os.path.join(workdir, 'bench.db')
+    create_database(database, USERS)
+    bot = ReplayLayer(build_config(database), BackgroundScheduler())
+    try:
+        plugins.LOADER.load_all()
+        cases = OrderedDict([(REFERENCE, reference)])
+        cases.update((name, func) for name, func in build_cases(bot).items()
+                     if args.filter in name)
+        results = measure(cases, args.repeat)
+    finally:
+        bot.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+    regressed = compare(results, baseline, args.threshold)
+    if args.save:
+        baseline.update((name, timing._asdict()) for name, timing in results.items())
+        with open(args.baseline, 'w') as outfile:
+            json.dump(baseline, outfile, indent=2, sort_keys=True)
+        print('Baseline saved to', args.baseline)
+        return 0
+    if regressed:
+        print('{} benchmark(s) slower than {:.0%} over baseline, beyond the noise: {}'.format(
+            len(regressed), args.threshold, ', '.join(regressed)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
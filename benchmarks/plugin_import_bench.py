@@ -0,0 +1,77 @@
+'''
+Reports how long importing each plugin takes, to see what lazy loading saves.
+
+Every plugin is imported in a fresh interpreter, so shared dependencies are
+counted for every plugin that needs them. The baseline is the cost of
+importing the plugin package itself, which is subtracted.
+
+Run from the repository root: python benchmarks/plugin_import_bench.py
+'''
+from __future__ import print_function
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+from tombot.plugins import find_plugins, MANIFEST # pylint: disable=wrong-import-position
+from tombot.registry import BOT_START # pylint: disable=wrong-import-position
+
+REPEAT = 5
+# Plugins use _() at import time, normally installed by tombot/__init__.py
+SNIPPET = '''
+import __builtin__, time
+__builtin__._ = lambda text: text
+began = time.time()
+import {}
+print(time.time() - began)
+'''
+
+def import_time(module):
+    '''
+    Return the fastest of REPEAT cold imports of module in seconds.
+
+    Returns None with the error message if the module cannot be imported.
+    '''
+    best = None
+    for dummy in range(REPEAT):
+        proc = subprocess.Popen(
+            [sys.executable, '-c', SNIPPET.format(module)], cwd=ROOT,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            return None, err.strip().splitlines()[-1]
+        seconds = float(out.strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best, None
+
+def main():
+    ''' Print a table with the import cost of every plugin. '''
+    base, error = import_time('tombot.plugins')
+    if error:
+        print('Cannot import tombot.plugins:', error)
+        return 1
+    print('tombot.plugins itself: {:.1f}ms'.format(base * 1000))
+    print('{:<22} {:>10} {:>8}  {}'.format('plugin', 'import', 'startup', 'notes'))
+    eager = lazy = 0.0
+    for plugin in find_plugins():
+        seconds, error = import_time('tombot.plugins.' + plugin)
+        spec = MANIFEST.get(plugin)
+        at_startup = spec is None or BOT_START in spec.events
+        if error:
+            print('{:<22} {:>10} {:>8}  {}'.format(plugin, '-', '', error))
+            continue
+        cost = max(seconds - base, 0.0)
+        if at_startup:
+            eager += cost
+        else:
+            lazy += cost
+        print('{:<22} {:>8.1f}ms {:>8}'.format(
+            plugin, cost * 1000, 'yes' if at_startup else 'no'))
+    print('Imported at startup: {:.1f}ms, deferred until first use: {:.1f}ms'.format(
+        eager * 1000, lazy * 1000))
+    print('(Shared dependencies are counted once per plugin.)')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
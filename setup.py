@@ -19,14 +19,14 @@ setup(
             'configobj',
             ],
         dependency_links=[
-            'http://github.com/maartenberg/fortune/tarball/master#egg=fortune-1.1',
             'git://github.com/tgalal/yowsup.git#egg=yowsupgit',
             ],
         entry_points = {
             'console_scripts' : [
                 'tombot-run=tombot.run:main',
-                'tombot-stop=tombot.rpc:remote_shutdown',
-                'tombot-restart=tombot.rpc:remote_restart'
+                'tombot-stop=tombot.rpc:shutdown_main',
+                'tombot-restart=tombot.rpc:restart_main',
+                'tombot-replay=tombot.replay:main',
                 ],
             },
         zip_safe=False
@@ -0,0 +1,167 @@
+''' Tests for importing and reloading plugins. '''
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import tombot # installs _()
+from tombot.registry import EVENTS, COMMAND_DICT, unregister_module
+from tombot.plugins import PluginLoader, LazyEvent
+
+
+PACKAGE = 'loadertest_plugins'
+EVENT = 'tests.loader.event'
+
+SLOW_PLUGIN = '''
+import time
+from tombot.registry import Command, Subscribe
+SEEN = []
+time.sleep(0.3)
+
+@Subscribe({event!r})
+def seen_cb(value):
+    SEEN.append(value)
+
+@Command('loadertestunlisted')
+def unlisted_cb(bot, message, *args, **kwargs):
+    return 'unlisted'
+'''.format(event=EVENT)
+
+class FakeBot(object):
+    ''' Records router rebuilds. '''
+    def __init__(self):
+        self.functions = {}
+        self.rebuilt = 0
+
+    def rebuild_router(self):
+        ''' Count the rebuild. '''
+        self.rebuilt += 1
+
+class PluginLoaderTestCase(unittest.TestCase):
+    ''' Creates a package of plugins in a temporary directory. '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='tombot-test-')
+        os.mkdir(os.path.join(self.root, PACKAGE))
+        self.write('__init__', '')
+        sys.path.insert(0, self.root)
+        self.bot = FakeBot()
+        self.loader = PluginLoader(PACKAGE)
+        self.loader.bot = self.bot
+
+    def tearDown(self):
+        for name in list(sys.modules):
+            if name == PACKAGE or name.startswith(PACKAGE + '.'):
+                unregister_module(name)
+                del sys.modules[name]
+        EVENTS.unsubscribe_where(lambda func: isinstance(func, LazyEvent))
+        sys.path.remove(self.root)
+        shutil.rmtree(self.root)
+
+    def write(self, module, source):
+        ''' Write the source of a module in the package. '''
+        path = os.path.join(self.root, PACKAGE, module + '.py')
+        with open(path, 'w') as pyfile:
+            pyfile.write(source)
+        if os.path.exists(path + 'c'):
+            os.remove(path + 'c')
+
+class LazyEventTest(PluginLoaderTestCase):
+    ''' Events arriving while a plugin is being imported. '''
+    def test_concurrent_events_all_delivered_once(self):
+        self.write('slow_plugin', SLOW_PLUGIN)
+        EVENTS.subscribe(EVENT, LazyEvent(self.loader, 'slow_plugin', EVENT), priority=100)
+        threads = [threading.Thread(target=EVENTS.fire, args=(EVENT, value))
+                   for value in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        EVENTS.fire(EVENT, 'after')
+        module = sys.modules[PACKAGE + '.slow_plugin']
+        self.assertEqual(sorted(module.SEEN), [0, 1, 2, 3, 4, 'after'])
+
+    def test_unlisted_command_rebuilds_router(self):
+        self.write('slow_plugin', SLOW_PLUGIN)
+        self.assertTrue(self.loader.load('slow_plugin'))
+        self.assertIn('LOADERTESTUNLISTED', COMMAND_DICT)
+        self.assertEqual(self.bot.rebuilt, 1)
+
+GREETER_PLUGIN = '''
+from tombot.registry import BOT_SHUTDOWN, BOT_START, Command, Subscribe
+STARTED = []
+
+@Command('loadertestgreet')
+def greet_cb(bot, message, *args, **kwargs):
+    return {greeting!r}
+
+@Subscribe({event!r})
+def greet_event_cb(value):
+    pass
+
+@Subscribe(BOT_START)
+def start_cb(bot):
+    STARTED.append(True)
+
+@Subscribe(BOT_SHUTDOWN)
+def stop_cb(bot):
+    STARTED.pop()
+'''
+
+DEPENDENT_PLUGIN = '''
+from . import greeter_plugin
+
+def greeting():
+    return greeter_plugin.greet_cb(None, None)
+'''
+
+class ReloadTest(PluginLoaderTestCase):
+    ''' Reloading a plugin in place. '''
+    def setUp(self):
+        super(ReloadTest, self).setUp()
+        self.write('greeter_plugin', GREETER_PLUGIN.format(greeting='hello', event=EVENT))
+        self.assertTrue(self.loader.load('greeter_plugin'))
+        self.module = sys.modules[PACKAGE + '.greeter_plugin']
+
+    def event_handlers(self):
+        ''' Return the names of the plugin's subscribed event handlers. '''
+        return sorted(sub.func.__name__ for sub in EVENTS.subscribed_where(
+            lambda func: getattr(func, '__module__', None) == self.module.__name__))
+
+    def test_reload(self):
+        self.write('greeter_plugin', GREETER_PLUGIN.format(greeting='bye', event=EVENT))
+        rebuilt = self.bot.rebuilt
+        self.assertTrue(self.loader.reload('greeter_plugin'))
+        self.assertEqual(self.bot.functions['LOADERTESTGREET'](self.bot, None), 'bye')
+        self.assertEqual(self.module.STARTED, [True])
+        self.assertEqual(self.bot.rebuilt, rebuilt + 1)
+
+    def test_reload_seen_by_dependent(self):
+        self.write('dependent_plugin', DEPENDENT_PLUGIN)
+        self.assertTrue(self.loader.load('dependent_plugin'))
+        dependent = sys.modules[PACKAGE + '.dependent_plugin']
+        self.write('greeter_plugin', GREETER_PLUGIN.format(greeting='bye', event=EVENT))
+        self.assertTrue(self.loader.reload('greeter_plugin'))
+        self.assertEqual(dependent.greeting(), 'bye')
+
+    def test_reload_syntax_error_keeps_old_code(self):
+        handlers = self.event_handlers()
+        self.write('greeter_plugin', 'def broken(:\n')
+        rebuilt = self.bot.rebuilt
+        self.assertFalse(self.loader.reload('greeter_plugin'))
+        self.assertEqual(COMMAND_DICT['LOADERTESTGREET'](self.bot, None), 'hello')
+        self.assertEqual(self.bot.functions['LOADERTESTGREET'](self.bot, None), 'hello')
+        self.assertEqual(self.event_handlers(), handlers)
+        self.assertEqual(self.module.STARTED, [True])   # stopped and started again
+        self.assertEqual(self.bot.rebuilt, rebuilt + 1)
+
+    def test_reload_error_halfway_keeps_old_code(self):
+        self.write('greeter_plugin', GREETER_PLUGIN.format(greeting='bye', event=EVENT) +
+                   'raise ValueError("halfway")\n')
+        self.assertFalse(self.loader.reload('greeter_plugin'))
+        self.assertEqual(COMMAND_DICT['LOADERTESTGREET'](self.bot, None), 'hello')
+        self.assertEqual(self.module.greet_cb(self.bot, None), 'hello')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+''' Tests for the RPC server and client. '''
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import tombot # installs _()
+from tombot import rpc
+
+
+class FakeOutbox(object):
+    ''' An outbound queue that is never full. '''
+    @staticmethod
+    def is_full():
+        ''' Return whether the queue is full. '''
+        return False
+
+class FakeBot(object):
+    ''' Records shutdown requests. '''
+    def __init__(self):
+        self.outbox = FakeOutbox()
+        self.stopped = threading.Event()
+
+    def stop(self, restart=False):
+        ''' Record the request instead of exiting. '''
+        self.stopped.set()
+
+class RPCServerTest(unittest.TestCase):
+    ''' Idle connections must not keep requests from being answered. '''
+    workers = 2
+
+    def setUp(self):
+        self.bot = FakeBot()
+        self.server = rpc.ThreadedTCPServer(
+            ('localhost', 0), rpc.ThreadedTCPRequestHandler, self.bot,
+            workers=self.workers, queue_size=1, timeout=0.5)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self):
+        ''' Return a new client for the test server. '''
+        client = rpc.RPCClient(self.server.server_address, timeout=5.0, path='')
+        self.clients.append(client)
+        return client
+
+    def test_shutdown_with_idle_connections(self):
+        for num in range(self.workers):
+            self.assertEqual(self.client().call('ping', str(num)), 'Pong: {}'.format(num))
+        silent = [self.client().connect() for dummy in range(self.workers)]
+        self.assertEqual(len(silent), self.workers)
+        self.assertEqual(self.client().call('shutdown'), rpc.RPC_OK)
+        self.assertTrue(self.bot.stopped.is_set())
+
+    def test_idle_connection_reused(self):
+        client = self.client()
+        self.assertEqual(client.call('ping', 'a'), 'Pong: a')
+        sock = client.sock
+        self.assertEqual(client.call('ping', 'b'), 'Pong: b')
+        self.assertIs(client.sock, sock)
+
+    def test_idle_connection_closed_after_timeout(self):
+        client = self.client()
+        client.call('ping')
+        time.sleep(2.0)
+        self.assertEqual(client.sock.recv(1), '')
+
+    def test_pipelined_requests(self):
+        responses = self.client().pipeline([('ping', str(num)) for num in range(10)])
+        self.assertEqual(responses, ['Pong: {}'.format(num) for num in range(10)])
+
+class UnixSocketTest(unittest.TestCase):
+    ''' The Unix socket transport and finding it from the config file. '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='tombot-test-')
+        self.path = os.path.join(self.root, 'rpc.sock')
+        self.start()
+
+    def start(self):
+        ''' Start a server on self.path. '''
+        self.server = rpc.ThreadedTCPServer(
+            self.path, rpc.ThreadedTCPRequestHandler, FakeBot())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        rpc._CONFIGURED.clear() #pylint: disable=protected-access
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_only_owner_may_connect(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), rpc.SOCKET_MODE)
+
+    def test_socket_from_config(self):
+        configfile = os.path.join(self.root, 'bot.ini')
+        with open(configfile, 'w') as config:
+            config.write('[RPC]\nsocket = {}\nport = 1\n'.format(self.path))
+        rpc.use_config(configfile)
+        self.assertEqual(rpc.rpc_call('ping', 'unix'), 'Pong: unix')
+
+    def test_stale_socket_replaced(self):
+        self.server.shutdown()
+        self.server.socket_path = None  # leave the file behind, like a crash
+        self.server.server_close()
+        self.assertTrue(os.path.exists(self.path))
+        self.start()
+        self.assertEqual(rpc.rpc_call('ping', 'again', path=self.path), 'Pong: again')
+        self.assertEqual(os.listdir(self.root), ['rpc.sock'])
+
+    def test_socket_in_use_kept(self):
+        with self.assertRaises(socket.error):
+            rpc.ThreadedTCPServer(self.path, rpc.ThreadedTCPRequestHandler, FakeBot())
+        self.assertEqual(rpc.rpc_call('ping', 'unix', path=self.path), 'Pong: unix')
+
+    def test_other_file_kept(self):
+        other = os.path.join(self.root, 'notes.txt')
+        with open(other, 'w') as notes:
+            notes.write('keep me')
+        with self.assertRaises(socket.error):
+            rpc.ThreadedTCPServer(other, rpc.ThreadedTCPRequestHandler, FakeBot())
+        with open(other) as notes:
+            self.assertEqual(notes.read(), 'keep me')
+
+    def test_socket_removed_on_close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertFalse(os.path.exists(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
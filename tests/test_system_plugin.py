@@ -0,0 +1,124 @@
+''' Tests for the help command of the system plugin. '''
+import unittest
+
+import tombot # installs _()
+from tombot.registry import Command, COMMAND_DICT, unregister_module, registry_changed
+from tombot.plugins import LazyCommand, system_plugin
+from tombot.plugins.manifest import MANIFEST, PluginSpec, CommandHelp
+
+
+class FakeMessage(object):
+    ''' A private text message. '''
+    participant = None
+
+    def __init__(self, body):
+        self.body = body
+
+    def getBody(self):
+        ''' Return the text of the message. '''
+        return self.body
+
+    def getFrom(self):
+        ''' Return the chat the message was sent in. '''
+        return '31600000002@s.whatsapp.net'
+
+def shared_cb(bot, message, *args, **kwargs):
+    '''
+    Command sharing its name with its category.
+
+    Longer description of the shared command.
+    '''
+
+def other_cb(bot, message, *args, **kwargs):
+    ''' Another command in the shared category. '''
+
+class HelpTest(unittest.TestCase):
+    ''' help <name> for commands and categories. '''
+    def setUp(self):
+        Command('helptestshared', 'helptestshared')(shared_cb)
+        Command('helptestother', 'helptestshared')(other_cb)
+        Command('helptestonly', 'helptestcategory')(other_cb)
+
+    def tearDown(self):
+        unregister_module(__name__)
+
+    def help(self, query):
+        ''' Return the reply to 'help query'. '''
+        return system_plugin.help_cb(None, FakeMessage('help ' + query))
+
+    def test_command(self):
+        reply = self.help('helptestother')
+        self.assertEqual(reply, 'Another command in the shared category.')
+
+    def test_category(self):
+        reply = self.help('helptestcategory')
+        self.assertTrue(reply.startswith('Commands in helptestcategory:'))
+        self.assertIn('helptestonly', reply)
+
+    def test_command_named_like_category(self):
+        reply = self.help('helptestshared')
+        self.assertTrue(reply.startswith('Command sharing its name with its category.'))
+        self.assertIn('Longer description of the shared command.', reply)
+        self.assertIn('Commands in helptestshared:', reply)
+        self.assertIn('helptestother', reply)
+
+    def test_unknown(self):
+        self.assertEqual(self.help('helptestnothing'), 'Sorry, that command is not known.')
+
+def lazy_cb(bot, message, *args, **kwargs):
+    '''
+    Command of a plugin that is not imported yet.
+
+    Only known after the import.
+    '''
+
+class FakeLoader(object):
+    ''' Registers lazy_cb when 'importing' helptest_plugin. '''
+    def __init__(self):
+        self.loaded = []
+
+    def load(self, plugin):
+        ''' Pretend to import the plugin. '''
+        self.loaded.append(plugin)
+        Command(['helptestlazy', 'helptestalias'], 'helptestlazycat')(lazy_cb)
+
+class UnloadedHelpTest(unittest.TestCase):
+    ''' help lists plugins from the manifest without importing them. '''
+    def setUp(self):
+        self.loader = FakeLoader()
+        MANIFEST['helptest_plugin'] = PluginSpec(
+            commands=('helptestlazy', 'helptestalias'), rpc=(), events=(),
+            help=(CommandHelp('helptestlazy', ('helptestalias',), 'helptestlazycat',
+                              'Command of a plugin that is not imported yet.'),))
+        for name in ('HELPTESTLAZY', 'HELPTESTALIAS'):
+            COMMAND_DICT[name] = LazyCommand(self.loader, 'helptest_plugin', name, COMMAND_DICT)
+        registry_changed()
+
+    def tearDown(self):
+        del MANIFEST['helptest_plugin']
+        for name in ('HELPTESTLAZY', 'HELPTESTALIAS'):
+            if isinstance(COMMAND_DICT.get(name), LazyCommand):
+                del COMMAND_DICT[name]
+        unregister_module(__name__)
+
+    def help(self, query):
+        ''' Return the reply to 'help query'. '''
+        return system_plugin.help_cb(None, FakeMessage('help ' + query))
+
+    def test_overview(self):
+        self.assertIn('- helptestlazycat: helptestlazy', self.help(''))
+        self.assertEqual(self.loader.loaded, [])
+
+    def test_category(self):
+        reply = self.help('helptestlazycat')
+        self.assertIn('helptestlazy (helptestalias): Command of a plugin that is not '
+                      'imported yet.', reply)
+
+    def test_command_imports_plugin(self):
+        reply = self.help('helptestalias')
+        self.assertEqual(self.loader.loaded, ['helptest_plugin'])
+        self.assertIn('Only known after the import.', reply)
+        self.assertIn('Also known as: helptestalias', reply)
+
+if __name__ == '__main__':
+    unittest.main()
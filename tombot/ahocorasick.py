@@ -0,0 +1,68 @@
+'''
+Contains a small Aho-Corasick automaton for finding many words in one scan.
+
+Used to find all known nicks in a message at once, instead of running a
+lookup for every candidate word.
+'''
+
+
+class Automaton(object):
+    '''
+    Finds all occurrences of a fixed set of words in a text in a single pass.
+
+    Built from a mapping of word -> value; matching is exact, so lowercase
+    both the words and the text for case-insensitive matching.
+    '''
+    def __init__(self, mapping):
+        self._goto = [{}]       # state -> {character: next state}
+        self._fail = [0]        # state -> fallback state
+        self._out = [[]]        # state -> [(word, value)] ending in this state
+        for word, value in mapping.iteritems():
+            if word:
+                self._add(word, value)
+        self._link()
+        self.size = len(mapping)
+
+    def _add(self, word, value):
+        ''' Add one word to the trie. '''
+        state = 0
+        for char in word:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append((word, value))
+
+    def _link(self):
+        ''' Compute failure links breadth-first and merge their outputs. '''
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, nxt in self._goto[state].iteritems():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def finditer(self, text):
+        '''
+        Yield (start, end, word, value) for every occurrence of every word.
+
+        Occurrences are yielded in order of their end position.
+        '''
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for word, value in out[state]:
+                yield index + 1 - len(word), index + 1, word, value
@@ -0,0 +1,148 @@
+'''
+Contains a small thread-safe LRU cache with optional expiry, shared by plugins.
+'''
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Least-recently-used cache with a size bound and optional time-to-live.
+
+    Entries can have their own ttl; expired entries count as misses.
+    Hits and misses are counted for the stats.
+    '''
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expiry time or None, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        ''' Return the cached value for key, or default. '''
+        with self.lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (expires, value)   # most recently used
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        ''' Store value under key, with the cache's ttl unless one is given. '''
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        ''' Remove all entries, counters are kept. '''
+        with self.lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        ''' Return a dict with size and hit/miss counters. '''
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': round(float(self.hits) / total, 3) if total else 0.0,
+                }
+
+class CallTimeout(Exception):
+    ''' Raised by SingleFlight.do when the call did not finish in time. '''
+    pass
+
+class _Call(object):
+    ''' One in-flight SingleFlight call. '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    '''
+    Makes sure only one call per key is running at any time.
+
+    Callers asking for a key that is already being fetched wait for that
+    call and share its result. The call runs on its own daemon thread, so
+    every caller, including the first, can give up after a timeout. A call
+    that timed out is forgotten, the next caller starts a new one; func
+    should still bound its own running time, e.g. with a socket timeout.
+    '''
+    def __init__(self, name='singleflight'):
+        self.name = name
+        self.lock = threading.Lock()
+        self._calls = {}
+        self.started = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, func, timeout, *args, **kwargs):
+        '''
+        Return func(*args, **kwargs), or the result of the running call for key.
+
+        Exceptions raised by func are raised in every waiting caller;
+        CallTimeout is raised if no result arrived within timeout seconds.
+        '''
+        with self.lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.started += 1
+                thread = threading.Thread(
+                    target=self._run, args=(key, call, func, args, kwargs),
+                    name='{}-call'.format(self.name))
+                thread.daemon = True
+                thread.start()
+            else:
+                self.shared += 1
+        if not call.done.wait(timeout):
+            with self.lock:
+                self.timeouts += 1
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            raise CallTimeout('{} {!r} did not finish within {}s'.format(
+                self.name, key, timeout))
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self, key, call, func, args, kwargs):
+        ''' Run one call and wake up its waiters. '''
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as ex: #pylint: disable=broad-except
+            call.error = ex
+        finally:
+            with self.lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        ''' Return a dict with the number of started, shared and timed out calls. '''
+        with self.lock:
+            return {
+                'inflight': len(self._calls),
+                'started': self.started,
+                'shared': self.shared,
+                'timeouts': self.timeouts,
+                }
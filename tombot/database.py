@@ -0,0 +1,112 @@
+'''
+Contains the database layer, which gives every thread its own SQLite connection.
+
+The bot is used from the network loop, the dispatcher workers, the RPC
+server and the scheduler's threads. Sharing one cursor between them
+interleaves results, so each thread gets a private connection instead.
+The database runs in WAL mode, so readers do not wait for the writer.
+'''
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .metrics import METRICS
+from .registry import get_easy_logger
+
+
+LOGGER = get_easy_logger('database')
+
+class Database(object):
+    '''
+    Thread-safe access to one SQLite database file.
+
+    Reads run on the calling thread's own connection; writes are serialized
+    and committed immediately. Each connection caches its prepared
+    statements, so repeated queries are not recompiled.
+    '''
+    def __init__(self, path, timeout=5.0, cached_statements=100):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.write_lock = threading.RLock()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._read_timer = METRICS.histogram('db.read')
+        self._write_timer = METRICS.histogram('db.write')
+        # Switching to WAL is persistent, do it once up front.
+        mode = self.connection().execute('PRAGMA journal_mode=WAL').fetchone()
+        LOGGER.info('Database %s opened, journal mode %s', path, mode[0])
+
+    def connection(self):
+        ''' Return the calling thread's connection, opening it if needed. '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path,
+                                   timeout=self.timeout,
+                                   detect_types=sqlite3.PARSE_DECLTYPES,
+                                   cached_statements=self.cached_statements)
+            conn.text_factory = str
+            conn.execute('PRAGMA busy_timeout = {:d}'.format(int(self.timeout * 1000)))
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+            LOGGER.debug('New connection for thread %s',
+                         threading.current_thread().name)
+        return conn
+
+    # Reading
+    def execute(self, query, params=()):
+        ''' Run a read query, return the cursor. '''
+        with self._read_timer.time():
+            return self.connection().execute(query, params)
+
+    def fetchone(self, query, params=()):
+        ''' Run a read query, return the first row or None. '''
+        return self.execute(query, params).fetchone()
+
+    def fetchall(self, query, params=()):
+        ''' Run a read query, return all rows. '''
+        return self.execute(query, params).fetchall()
+
+    # Writing
+    @contextmanager
+    def transaction(self):
+        '''
+        Context manager for a write transaction, yields a cursor.
+
+        Commits when the block ends, rolls back if it raises. The time
+        recorded includes waiting for other writers.
+        '''
+        with self._write_timer.time(), self.write_lock:
+            conn = self.connection()
+            try:
+                yield conn.cursor()
+            except:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def write(self, query, params=()):
+        ''' Run and commit a single write query, return the cursor. '''
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+        return cursor
+
+    def writemany(self, query, seq_of_params):
+        ''' Run a write query for every parameter tuple, in one transaction. '''
+        with self.transaction() as cursor:
+            cursor.executemany(query, seq_of_params)
+        return cursor
+
+    def close(self):
+        ''' Close the connections of all threads. '''
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    pass # created in a thread that no longer exists
+            self._connections = []
+        self._local = threading.local()
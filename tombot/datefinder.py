@@ -1,9 +1,12 @@
 ''' Contains date/time finding logic. '''
 import re
 import datetime
+from collections import namedtuple
 from datetime import timedelta
 import dateutil.parser
 
+from .cache import LRUCache
+
 
 YEAR_WORDS = ['y', 'j', 'jaar', 'jaren', 'years', 'year']
 WEEK_WORDS = ['w', 'weeks', 'week', 'weken']
@@ -16,70 +19,217 @@ WORDS = [YEAR_WORDS, WEEK_WORDS, DAY_WORDS, HOUR_WORDS, MINUTE_WORDS, SECOND_WOR
 for item in WORDS:
     item.sort(key=len, reverse=True)
 
-SEPARATORS = [r'\s', ',', 'en', 'and', '&']
-SEP_PART = '({})*'.format('|'.join(SEPARATORS))
+SEPARATORS = [',', 'en', 'and', '&']
+DURATION_MARKERS = ['in', 'over', 'na']
+CLOCK_MARKERS = ['om', 'at']
 
-YEAR_PART = r'((?P<years>\d+)\s*?({}){})?'.format('|'.join(YEAR_WORDS), SEP_PART)
-WEEK_PART = r'((?P<weeks>\d+)\s*?({}){})?'.format('|'.join(WEEK_WORDS), SEP_PART)
-DAY_PART = r'((?P<days>\d+)\s*?({}){})?'.format('|'.join(DAY_WORDS), SEP_PART)
-HOUR_PART = r'((?P<hours>\d+)\s*?({}){})?'.format('|'.join(HOUR_WORDS), SEP_PART)
-MINUTE_PART = r'((?P<minutes>\d+)\s*?({}){})?'.format('|'.join(MINUTE_WORDS), SEP_PART)
-SECOND_PART = r'((?P<seconds>\d+)\s*?({}))?'.format('|'.join(SECOND_WORDS))
+# unit word -> Duration field
+UNITS = {}
+for _field, _words in zip(
+        ('years', 'weeks', 'days', 'hours', 'minutes', 'seconds'), WORDS):
+    for _word in _words:
+        UNITS[_word] = _field
+del _field, _words, _word
 
-DURATION_MARKERS = ['in', 'over', 'na']
+# A number followed by a word, which is a duration if the word is in UNITS.
+NUMBER_UNIT_REGEX = re.compile(r'(\d+)\s*([^\W\d_]+)')
+# What may come between two number-unit pairs of one duration.
+DURATION_SEPARATOR_REGEX = re.compile(
+    r'(?:\s|{})*'.format('|'.join(
+        re.escape(sep) + (r'\b' if sep.isalpha() else '') for sep in SEPARATORS)),
+    re.IGNORECASE)
+# A run of digits with up to two ':NN' groups, optionally after 'om'/'at'.
+CLOCK_CANDIDATE_REGEX = re.compile(
+    r'(?:(?<![^\W\d_])(?P<marker>{})\s?)?(?P<digits>\d+)(?P<parts>(?::\d{{2}}){{1,2}})?'.format(
+        '|'.join(CLOCK_MARKERS)),
+    re.IGNORECASE)
 
-MONSTER = ''.join([YEAR_PART, WEEK_PART, DAY_PART, HOUR_PART, MINUTE_PART, SECOND_PART])
-REGEX = re.compile(MONSTER, re.IGNORECASE)
+class Duration(namedtuple('Duration', 'years weeks days hours minutes seconds start end')):
+    ''' A duration found in a text; start and end are its offsets. '''
+    __slots__ = ()
 
-def find_timedelta(text):
+    def timedelta(self):
+        ''' Return the duration as a timedelta, years count as 365 days. '''
+        return timedelta(
+            days=self.days + 7 * self.weeks + 365 * self.years,
+            hours=self.hours, minutes=self.minutes, seconds=self.seconds)
+
+class ClockTime(namedtuple('ClockTime', 'hour minute second marker start end')):
+    ''' A clock time found in a text; marker is the preceding 'om'/'at', if any. '''
+    __slots__ = ()
+
+    def next_datetime(self, now=None):
+        ''' Return the first moment at this time, today or tomorrow. '''
+        now = now or datetime.datetime.now()
+        result = now.replace(hour=self.hour, minute=self.minute,
+                             second=self.second, microsecond=0)
+        if result < now:
+            result = result + datetime.timedelta(days=1)
+        return result
+
+def scan_duration(text):
     '''
-    (Attempts to) Find the first readable duration in a text and return it as a datetime.
+    Find the first duration in text in a single left-to-right pass.
 
-    Argument: the text to search. The regex is horrible, so take care.
-    Returns a timedelta, zero-length if no matches.
+    A duration is one or more '<number> <unit>' pairs, optionally separated
+    by commas, 'en', 'and' or '&'. Returns a Duration or None.
     '''
-    matches = REGEX.findall(text)
-    match = None
-    for res in matches:
-        if any(res):
-            match = res
+    for match in NUMBER_UNIT_REGEX.finditer(text):
+        if match.group(2).lower() in UNITS:
+            break
+    else:
+        return None
+    start = match.start()
+    fields = dict.fromkeys(Duration._fields[:6], 0)
+    while True:
+        field = UNITS.get(match.group(2).lower())
+        if field is None:
+            break
+        fields[field] += int(match.group(1))
+        end = match.end()
+        match = NUMBER_UNIT_REGEX.match(
+            text, DURATION_SEPARATOR_REGEX.match(text, end).end())
+        if match is None:
             break
-    if not match:
+    return Duration(start=start, end=end, **fields)
+
+def _split_clock_digits(digits):
+    '''
+    Split a run of digits into (hour, minute, second) like '930' or '153000'.
+
+    Follows the old pattern: one or two hour digits, then optionally two
+    minute and two second digits; extra digits are ignored.
+    '''
+    length = len(digits)
+    if length <= 2:
+        return int(digits), 0, 0
+    hour_len = 2 - length % 2 if length < 6 else 2
+    hour = digits[:hour_len]
+    minute = digits[hour_len:hour_len + 2]
+    second = digits[hour_len + 2:hour_len + 4]
+    return int(hour), int(minute), int(second) if len(second) == 2 else 0
+
+def scan_clock(text):
+    '''
+    Find the first valid clock time in text in a single left-to-right pass.
+
+    Understands '15', '15:30', '15:30:45', '1530' and an optional 'om'/'at'
+    before them. Returns a ClockTime or None.
+    '''
+    for match in CLOCK_CANDIDATE_REGEX.finditer(text):
+        digits = match.group('digits')
+        hour, minute, second = _split_clock_digits(digits)
+        end = match.end('digits')
+        parts = match.group('parts')
+        if parts and len(digits) <= 2:
+            parts = parts.split(':')
+            minute = int(parts[1])
+            second = int(parts[2]) if len(parts) > 2 else 0
+            end = match.end()
+        if hour < 24 and minute < 60 and second < 60:
+            return ClockTime(hour, minute, second, match.group('marker'),
+                             match.start('digits'), end)
+    return None
+
+def find_timedelta(text):
+    '''
+    (Attempts to) Find the first readable duration in a text and return it as a timedelta.
+
+    Raises ValueError if there is none.
+    '''
+    duration = scan_duration(text)
+    if duration is None:
         raise ValueError('Could not extract duration!')
-    years = int(match[1]) if match[1] else 0 # in tdays
-    weeks = int(match[5]) if match[5] else 0 # in tdays
-    days = int(match[9]) if match[9] else 0 # in tdays
-    tdays = days + 7 * weeks + 365 * years
-    hours = int(match[13]) if match[13] else 0 # passed
-    minutes = int(match[17]) if match[17] else 0 # passed
-    seconds = int(match[21]) if match[21] else 0 # passed
-    result = timedelta(
-        days=tdays, hours=hours, minutes=minutes, seconds=seconds)
-    return result
+    return duration.timedelta()
 
-CLOCK_MARKERS = ['om', 'at']
-CLOCK_PAT = r'((#!)\s?)?((?P<hour>\d{1,2})(:?((?P<minute>\d{2})(:?(?P<second>\d{2}))?)?))'.replace(
-    r'#!', '|'.join(CLOCK_MARKERS))
 STRICT_CLOCK_PAT = r'((#@)\s?)?((?P<hour>\d{1,2})(:?(?P<minute>\d{2})|\s?(#!)))(?![-/])'.replace(
     '#!', '|'.join(HOUR_WORDS)).replace('#@', '|'.join(CLOCK_MARKERS))
-CLOCK_REGEX = re.compile(CLOCK_PAT, re.IGNORECASE)
 STRICT_CLOCK_REGEX = re.compile(STRICT_CLOCK_PAT, re.IGNORECASE)
 def find_first_time(text):
     '''
     Find the first occurrence of a clock time, return as datetime in today or tomorrow.
     Raises ValueError if no time is found.
     '''
-    match = CLOCK_REGEX.search(text)
-    if not match:
+    clock = scan_clock(text)
+    if clock is None:
         raise ValueError('No time found!')
-    hour = int(match.group('hour'))
-    minute = int(match.group('minute')) if match.group('minute') else 0
-    second = int(match.group('second')) if match.group('second') else 0
-    result = datetime.datetime.now().replace(
-        hour=hour, minute=minute, second=second)
-    if result < datetime.datetime.now():
-        result = result + datetime.timedelta(days=1)
-    return result
+    return clock.next_datetime()
+
+# Why a parse failed
+ERR_EMPTY = 'empty'         # nothing to parse
+ERR_NO_TIME = 'no-time'     # no time or date found
+ERR_PAST = 'past'           # the time found is not in the future
+
+# Strategies, cheapest first; also the kinds of cached plans.
+STRATEGY_DURATION = 'duration'
+STRATEGY_CLOCK = 'clock'
+STRATEGY_DATEUTIL = 'dateutil'
+
+ParseResult = namedtuple('ParseResult', 'deadline strategy error')
+PARSE_CACHE = LRUCache(maxsize=256)
+
+def _plan(text, today):
+    '''
+    Parse text once, return (strategy, payload) that does not depend on the time of day.
+
+    payload is a timedelta, a ClockTime or a datetime for the three
+    strategies, and an ERR_ reason for strategy None.
+    '''
+    words = text.split(None, 1)
+    if not words:
+        return None, ERR_EMPTY
+    timespec = words[0]
+    if timespec in DURATION_MARKERS or STRICT_CLOCK_REGEX.match(timespec):
+        duration = scan_duration(text)
+        if duration is not None:
+            return STRATEGY_DURATION, duration.timedelta()
+    elif timespec in CLOCK_MARKERS:
+        clock = scan_clock(text)
+        if clock is not None:
+            return STRATEGY_CLOCK, clock
+    # Most expensive, only when the cheap strategies do not apply.
+    try:
+        return STRATEGY_DATEUTIL, dateutil.parser.parse(
+            text, parserinfo=BPI, fuzzy=True,
+            default=datetime.datetime.combine(today, datetime.time()))
+    except (ValueError, OverflowError):
+        return None, ERR_NO_TIME
+
+def parse_reminder_time(text, now=None):
+    '''
+    Find the moment a reminder text refers to.
+
+    Tries, depending on the first word, a duration ('in 5 minuten ...'),
+    a clock time ('om 15:30 ...') and finally dateutil's fuzzy parser.
+    Results are cached by normalized text; durations and clock times are
+    cached without reference to the current time, dateutil results and
+    failures only for the day they were parsed on.
+
+    Returns a ParseResult; on failure deadline is None and error is one of
+    the ERR_ constants.
+    '''
+    now = now or datetime.datetime.now()
+    key = ' '.join(text.lower().split())
+    today = now.date()
+    cached = PARSE_CACHE.get(key)
+    # dateutil and failed parses depend on today's date, e.g. '31 juni'
+    if cached is None or (cached[0] in (STRATEGY_DATEUTIL, None) and cached[2] != today):
+        strategy, payload = _plan(key, today)
+        cached = (strategy, payload, today)
+        PARSE_CACHE.put(key, cached)
+    strategy, payload, dummy = cached
+
+    if strategy is None:
+        return ParseResult(None, None, payload)
+    if strategy == STRATEGY_DURATION:
+        deadline = now + payload
+    elif strategy == STRATEGY_CLOCK:
+        deadline = payload.next_datetime(now)
+    else:
+        deadline = payload
+    if deadline <= now:
+        return ParseResult(None, strategy, ERR_PAST)
+    return ParseResult(deadline, strategy, None)
 
 class Biliparserinfo(dateutil.parser.parserinfo):
     ''' Bilingual dutch/english dateutil parserinfo '''
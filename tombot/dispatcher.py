@@ -0,0 +1,183 @@
+'''
+Contains the dispatcher, which runs incoming messages on a pool of workers.
+
+Messages from the same chat are handled one at a time and in the order in
+which they were received; messages from different chats run in parallel.
+'''
+import threading
+import time
+from collections import deque
+
+from .registry import get_easy_logger
+
+
+LOGGER = get_easy_logger('dispatcher')
+
+OVERLOAD_DROP = 'drop'      # refuse new work when the queue is full
+OVERLOAD_BLOCK = 'block'    # make the submitter wait until there is room
+OVERLOAD_POLICIES = (OVERLOAD_DROP, OVERLOAD_BLOCK)
+
+class Dispatcher(object):
+    '''
+    Bounded worker pool which keeps tasks with the same key in order.
+
+    Each key (usually a chat jid) has its own FIFO of pending tasks, and at
+    most one worker handles a given key at any time.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, workers=4, queue_size=100, overload=OVERLOAD_DROP,
+                 name='dispatcher', on_exit=None):
+        if overload not in OVERLOAD_POLICIES:
+            raise ValueError('Unknown overload policy {}'.format(overload))
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overload = overload
+        self.name = name
+        self.on_exit = on_exit
+
+        self._cond = threading.Condition()
+        self._chats = {}        # key -> deque of pending tasks
+        self._ready = deque()   # keys with pending tasks and no active worker
+        self._pending = 0
+        self._running = False
+        self._threads = []
+
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        ''' Start the worker threads. '''
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for num in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name='{}-{}'.format(self.name, num))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        LOGGER.info('%s started with %s workers.', self.name, self.workers)
+
+    def stop(self, wait=True):
+        '''
+        Stop the workers after they finish their current task.
+
+        Pending tasks are discarded. Do not wait when called from a worker.
+        '''
+        with self._cond:
+            self._running = False
+            self._chats.clear()
+            self._ready.clear()
+            self._pending = 0
+            self._cond.notify_all()
+        if wait:
+            current = threading.current_thread()
+            for thread in self._threads:
+                if thread is not current:
+                    thread.join()
+        self._threads = []
+
+    def submit(self, key, func, *args, **kwargs):
+        '''
+        Queue func(*args, **kwargs) to run after earlier tasks for key.
+
+        Returns False if the task was dropped because the queue is full.
+        '''
+        with self._cond:
+            while self._pending >= self.queue_size:
+                if self.overload == OVERLOAD_DROP or not self._running:
+                    self.dropped += 1
+                    LOGGER.warning('%s overloaded, dropping task for %s',
+                                   self.name, key)
+                    return False
+                self._cond.wait()
+            if not self._running:
+                self.dropped += 1
+                return False
+            tasks = self._chats.get(key)
+            if tasks is None:
+                tasks = self._chats[key] = deque()
+                self._ready.append(key)
+            tasks.append((func, args, kwargs))
+            self._pending += 1
+            self._cond.notify_all()
+        return True
+
+    def drain(self, timeout=None):
+        '''
+        Wait until all queued and running tasks are done.
+
+        Returns False if that took longer than timeout seconds, or at once
+        when called from one of the workers, which would wait for itself.
+        '''
+        if threading.current_thread() in self._threads:
+            return False
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._running and self._chats:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        ''' Return a dict describing the current state of the pool. '''
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'pending': self._pending,
+                'chats': len(self._chats),
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                }
+
+    def _next_task(self):
+        ''' Block until a task is ready, return (key, task) or None when stopped. '''
+        with self._cond:
+            while self._running and not self._ready:
+                self._cond.wait()
+            if not self._running:
+                return None
+            key = self._ready.popleft()
+            task = self._chats[key].popleft()
+            self._pending -= 1
+            self._cond.notify_all()
+            return key, task
+
+    def _finish(self, key):
+        ''' Hand key back to the pool, or forget it if it has no more tasks. '''
+        with self._cond:
+            tasks = self._chats.get(key)
+            if tasks:
+                self._ready.append(key)
+                self._cond.notify_all()
+            elif tasks is not None:
+                del self._chats[key]
+                self._cond.notify_all()     # for drain()
+
+    def _work(self):
+        ''' Worker thread main loop. '''
+        while True:
+            item = self._next_task()
+            if item is None:
+                return
+            key, (func, args, kwargs) = item
+            try:
+                func(*args, **kwargs)
+            except SystemExit as ex:
+                # sys.exit only ends this thread, hand the code to the owner.
+                LOGGER.info('%s: task for %s requested exit.', self.name, key)
+                if self.on_exit:
+                    self.on_exit(ex.code)
+                return
+            except Exception as ex: #pylint: disable=broad-except
+                self.failed += 1
+                LOGGER.exception('%s: task for %s failed: %s', self.name, key, ex)
+            else:
+                self.processed += 1
+            finally:
+                self._finish(key)
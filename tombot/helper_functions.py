@@ -2,6 +2,7 @@
 from functools import wraps
 from yowsup.layers.protocol_messages.protocolentities \
         import TextMessageProtocolEntity
+from .view import MessageView
 
 
 def byteify(param):
@@ -19,7 +20,13 @@ def byteify(param):
         return param
 
 def extract_query(message, cmdlength=1):
-    """ Removes the command and trigger from the message body, return the stripped text."""
+    """
+    Removes the command and trigger from the message body, return the stripped text.
+
+    Accepts a message or its MessageView, which has the body already split.
+    """
+    if isinstance(message, MessageView):
+        return ' '.join(message.tokens[message.trigger_offset + cmdlength:])
     content = message.getBody()
     if message.participant:
         offset = 1 + cmdlength
@@ -28,7 +35,9 @@ def extract_query(message, cmdlength=1):
     return ' '.join(content.split()[offset:])
 
 def determine_sender(message):
-    ''' Returns the person who wrote a message. '''
+    ''' Returns the person who wrote a message, accepts a MessageView too. '''
+    if isinstance(message, MessageView):
+        return message.sender
     if message.participant:
         return message.participant
     return message.getFrom()
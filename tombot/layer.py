@@ -3,7 +3,6 @@ import os
 import sys
 import logging
 import time
-import sqlite3
 import threading
 
 from apscheduler.schedulers import SchedulerNotRunningError
@@ -21,7 +20,13 @@ from yowsup.layers.protocol_presence.protocolentities \
         import AvailablePresenceProtocolEntity, UnavailablePresenceProtocolEntity
 
 from . import plugins
+from . import outbound
+from .database import Database
+from .dispatcher import Dispatcher
+from .metrics import METRICS, MetricsLogger
 from .helper_functions import unknown_command
+from .router import CommandRouter
+from .view import MessageView
 import tombot.registry as registry
 import tombot.rpc as rpc
 
@@ -30,7 +35,7 @@ class TomBotLayer(YowInterfaceLayer):
     ''' The tombot layer, a chatbot for WhatsApp. '''
     # pylint: disable=too-many-instance-attributes
     def __init__(self, config, scheduler):
-        super(self.__class__, self).__init__()
+        super(TomBotLayer, self).__init__()
         self.connected = False
         self.config = config
         self.scheduler = scheduler
@@ -38,32 +43,77 @@ class TomBotLayer(YowInterfaceLayer):
         try:
             logging.info('Database location: %s',
                          config['Yowsup']['database'])
-            self.conn = sqlite3.connect(config['Yowsup']['database'],
-                                        detect_types=sqlite3.PARSE_DECLTYPES,
-                                        check_same_thread=False)
-            self.conn.text_factory = str
-            self.cursor = self.conn.cursor()
+            self.db = Database(config['Yowsup']['database'])
         except KeyError:
             logging.critical('Database could not be loaded!')
 
         # Group list holder
         self.known_groups = []
 
+        # Worker pool for commands and message events
+        dispatch_conf = config.get('Dispatcher', {})
+        self.dispatcher = Dispatcher(
+            workers=int(dispatch_conf.get('workers', 4)),
+            queue_size=int(dispatch_conf.get('queue', 100)),
+            overload=dispatch_conf.get('overload', 'drop'),
+            on_exit=self.exit_from_worker)
+        self.dispatcher.start()
+
+        # Worker pool for background event handlers, e.g. mentions
+        events_conf = config.get('Events', {})
+        self.event_pool = Dispatcher(
+            workers=int(events_conf.get('workers', 2)),
+            queue_size=int(events_conf.get('queue', 200)),
+            name='events')
+        self.event_pool.start()
+        registry.EVENTS.set_pool(self.event_pool)
+
+        # Outgoing messages are buffered while disconnected and rate limited
+        outbox_conf = config.get('Outbound', {})
+        self.outbox = outbound.OutboundQueue(
+            self.send_lower,
+            maxlen=int(outbox_conf.get('queue', 200)),
+            rate=float(outbox_conf.get('rate', 2.0)),
+            burst=int(outbox_conf.get('burst', 5)),
+            recipient_interval=float(outbox_conf.get('recipient_interval', 1.0)))
+        self.outbox.start()
+
         # Start rpc listener
-        host = 'localhost'
-        port = 10666
-        self.rpcserver = rpc.ThreadedTCPServer((host, port), rpc.ThreadedTCPRequestHandler, self)
+        rpc_conf = config.get('RPC', {})
+        address = rpc_conf.get('socket') or (
+            rpc_conf.get('host', rpc.DEFAULT_ADDRESS[0]),
+            int(rpc_conf.get('port', rpc.DEFAULT_ADDRESS[1])))
+        self.rpcserver = rpc.ThreadedTCPServer(
+            address, rpc.ThreadedTCPRequestHandler, self,
+            workers=int(rpc_conf.get('workers', 2)),
+            queue_size=int(rpc_conf.get('queue', 8)),
+            backlog=int(rpc_conf.get('backlog', 5)),
+            timeout=float(rpc_conf.get('timeout', 30.0)))
 
         server_thread = threading.Thread(target=self.rpcserver.serve_forever)
         server_thread.daemon = True
         server_thread.start()
 
+        # Queue depths, reported with the other metrics
+        METRICS.gauge('dispatcher.pending', lambda: self.dispatcher.stats()['pending'])
+        METRICS.gauge('events.pending', lambda: self.event_pool.stats()['pending'])
+        METRICS.gauge('rpc.pending', lambda: self.rpcserver.pool.stats()['pending'])
+        METRICS.gauge('outbound.depth', lambda: self.outbox.stats()['depth'])
+        self.metrics_logger = MetricsLogger()
+        log_interval = int(config.get('Metrics', {}).get('log_interval', 0))
+        if log_interval > 0:
+            self.metrics_logger.start(log_interval)
+
+        # Let scheduled jobs send messages without the RPC round trip
+        outbound.register_sender(self.send_message)
+
         # Start the passed scheduler
         self.scheduler.start()
 
         self.functions = {}
-        plugins.load_plugins()
+        plugins.load_plugins(self)
         self.functions.update(registry.COMMAND_DICT)
+        self.rebuild_router()
 
         # Execute startup hooks
         registry.fire_event(registry.BOT_START, self)
@@ -84,6 +134,7 @@ class TomBotLayer(YowInterfaceLayer):
         if layerEvent.getName() == YowNetworkLayer.EVENT_STATE_DISCONNECTED:
             reason = layerEvent.getArg('reason')
             logging.warning(_('Connection lost: {}').format(reason))
+            self.outbox.set_connected(False)
             registry.fire_event(registry.BOT_DISCONNECTED, self)
             if reason == 'Connection Closed':
                 time.sleep(.5)
@@ -100,6 +151,7 @@ class TomBotLayer(YowInterfaceLayer):
             logging.info('Connection established.')
             self.connected = True
             self.set_online()
+            self.outbox.set_connected(True)
             registry.fire_event(registry.BOT_CONNECTED, self)
         return False
 
@@ -115,10 +167,20 @@ class TomBotLayer(YowInterfaceLayer):
             'read', message.getParticipant())
         self.toLower(receipt)
 
-        time.sleep(0.2)
-        self.react(message)
+        METRICS.counter('messages.received').inc()
+        view = MessageView.route_message(message, self.router)
+        if not self.dispatcher.submit(message.getFrom(), self.handle_message, message, view):
+            logging.warning('Dispatcher full, message %s from %s not handled.',
+                            message.getId(), message.getFrom())
+
+    def handle_message(self, message, view=None):
+        ''' Respond to a message and notify subscribers, runs on a dispatcher worker. '''
+        if view is None:
+            view = MessageView.route_message(message, self.router)
+        with METRICS.histogram('messages.react').time():
+            self.react(message, view)
 
-        registry.fire_event(registry.BOT_MSG_RECEIVE, self, message)
+        registry.fire_event(registry.BOT_MSG_RECEIVE, self, message, view=view)
 
     @ProtocolEntityCallback('receipt')
     def onReceipt(self, entity):
@@ -130,11 +192,24 @@ class TomBotLayer(YowInterfaceLayer):
         self.toLower(entity.ack())
 
     def toLower(self, entity):
-        ''' Intercept entites if not connected and warn user. '''
+        '''
+        Queue messages for sending, intercept other entities if not connected.
+
+        Messages go through the outbound queue, so they survive reconnects and
+        are rate limited. Receipts, acks, presence and chatstates are only
+        meaningful right now, so they are sent directly or dropped.
+        '''
+        if entity.getTag() == 'message':
+            self.outbox.put(entity)
+            return
         if not self.connected:
             logging.warning('Not connected, dropping entity!')
             return
-        super(self.__class__, self).toLower(entity)
+        self.send_lower(entity)
+
+    def send_lower(self, entity):
+        ''' Pass an entity to the layer below. '''
+        super(TomBotLayer, self).toLower(entity)
 
     koekje = '\xf0\x9f\x8d\xaa'
 
@@ -147,43 +222,61 @@ class TomBotLayer(YowInterfaceLayer):
         'MINION', 'MINION,',
         ]
 
-    def react(self, message):
+    def react(self, message, view=None):
         ''' Generates a response to a message using a response function and sends it. '''
-        content = message.getBody()
-        text = content.upper().split()
-        isgroup = False
-        if message.participant:  # A trigger is required in groups
-            isgroup = True
-            if text[0] not in self.triggers:
-                return
-            text.remove(text[0])
-        try:
-            response = self.functions[text[0]](self, message)
-        except IndexError:
-            return
-        except KeyError:
-            if isgroup or content.startswith('@'):
+        if view is None:
+            view = MessageView.route_message(message, self.router)
+        content = view.body
+        isgroup = view.is_group  # A trigger is required in groups
+        route = view.route
+        if route is None:
+            if isgroup or not content.strip() or content.startswith('@'):
                 return # no 'unknown command!' spam
             response = unknown_command(message)
-            logging.debug('Failed command %s', text[0])
-        except UnicodeDecodeError as ex:
-            response = 'UnicodeDecodeError, see logs.'
-            logging.error(ex)
+            logging.debug('Failed command %s', content.split()[0])
+        else:
+            try:
+                func = self.functions[route.name]
+                with METRICS.histogram('command.' + route.name.lower()).time():
+                    response = func(self, message, route=route, view=view)
+            except KeyError:
+                if isgroup:
+                    return
+                response = unknown_command(message)
+                logging.debug('Disabled command %s', route.name)
+            except UnicodeDecodeError as ex:
+                response = 'UnicodeDecodeError, see logs.'
+                logging.error(ex)
         if response:
             reply_message = TextMessageProtocolEntity(
                 response, to=message.getFrom())
             self.toLower(reply_message)
 
+    def rebuild_router(self):
+        ''' Recompile the command router, after commands were (un)registered. '''
+        self.router = CommandRouter(self.triggers, registry.COMMAND_DICT)
+
     def stop(self, restart=False):
         ''' Shut down the bot. '''
         logging.info('Shutting down via stop method.')
+        # Let queued background handlers finish before the shutdown hooks,
+        # e.g. the last seen updates before they are written
+        if not self.event_pool.drain(timeout=5.0):
+            logging.warning('Event handlers still running, shutting down anyway.')
         # Execute shutdown hooks
         registry.fire_event(registry.BOT_SHUTDOWN, self)
+        outbound.unregister_sender()
+        self.dispatcher.stop(wait=False)
+        registry.EVENTS.set_pool(None)
+        self.event_pool.stop(wait=False)
+        self.metrics_logger.stop()
+        self.outbox.stop()
         self.set_offline()
         try:
             self.scheduler.shutdown()
         except SchedulerNotRunningError:
             pass
+        self.db.close()
         self.rpcserver.shutdown()
         self.rpcserver.server_close()
         if self.connected:
@@ -192,7 +285,22 @@ class TomBotLayer(YowInterfaceLayer):
             sys.exit(3)
         sys.exit(0)
 
+    @staticmethod
+    def exit_from_worker(code):
+        '''
+        Exit the process after stop() was called from a dispatcher worker.
+
+        sys.exit only ends the calling thread there, so flush the logs and
+        leave with the requested exit code directly.
+        '''
+        logging.shutdown()
+        os._exit(code or 0) # pylint: disable=protected-access
+
     # Helper functions
+    def send_message(self, body, recipient):
+        ''' Send a text message to recipient. '''
+        self.toLower(TextMessageProtocolEntity(body, to=recipient))
+
     def set_online(self, *_):
         ''' Set presence as available '''
         logging.debug('Setting presence online.')
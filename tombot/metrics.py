@@ -0,0 +1,192 @@
+'''
+Contains counters, latency histograms and gauges to see where time is spent.
+
+Metrics are created on first use and kept in the module-level METRICS
+registry. Recording is cheap enough for every command, event and query:
+a histogram keeps a fixed set of buckets instead of all measurements.
+'''
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+LOGGER = logging.getLogger('metrics')
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+           0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter(object):
+    ''' A number that only goes up. '''
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        ''' Add amount to the counter. '''
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        ''' Return a one-line description. '''
+        return '{} {}'.format(self.name, self.value)
+
+class Gauge(object):
+    ''' A value read from a function when it is reported, e.g. a queue depth. '''
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    @property
+    def value(self):
+        ''' Call the function, None if it fails. '''
+        try:
+            return self.func()
+        except Exception: #pylint: disable=broad-except
+            return None
+
+    def render(self):
+        ''' Return a one-line description. '''
+        return '{} {}'.format(self.name, self.value)
+
+class Histogram(object):
+    ''' Counts durations per bucket, with error count, total and maximum. '''
+    def __init__(self, name, buckets=BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one: above all bounds
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        ''' Record one duration. '''
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if error:
+                self.errors += 1
+
+    @contextmanager
+    def time(self):
+        ''' Context manager recording how long its block takes, and if it raises. '''
+        began = time.time()
+        try:
+            yield
+        except:
+            self.observe(time.time() - began, error=True)
+            raise
+        self.observe(time.time() - began)
+
+    def percentile(self, fraction):
+        '''
+        Estimate a percentile (0 < fraction <= 1) as the upper bound of its bucket.
+
+        Above the largest bucket the maximum is returned.
+        '''
+        with self._lock:
+            if not self.count:
+                return 0.0
+            wanted = fraction * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= wanted:
+                    if index < len(self.buckets):
+                        return min(self.buckets[index], self.max)
+                    break
+            return self.max
+
+    def render(self):
+        ''' Return a one-line description, times in milliseconds. '''
+        avg = self.total / self.count if self.count else 0.0
+        return '{} count={} errors={} avg={:.2f}ms p50={:.2f}ms p95={:.2f}ms ' \
+               'p99={:.2f}ms max={:.2f}ms'.format(
+                   self.name, self.count, self.errors, avg * 1000,
+                   self.percentile(0.5) * 1000, self.percentile(0.95) * 1000,
+                   self.percentile(0.99) * 1000, self.max * 1000)
+
+class Metrics(object):
+    ''' Creates metrics by name and reports all of them. '''
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, cls, *args):
+        ''' Return the metric with this name, creating it if needed. '''
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = cls(name, *args)
+        return metric
+
+    def counter(self, name):
+        ''' Return the counter with this name. '''
+        return self._get(name, Counter)
+
+    def histogram(self, name):
+        ''' Return the histogram with this name. '''
+        return self._get(name, Histogram)
+
+    def gauge(self, name, func):
+        ''' Register (or replace) a gauge reading func. '''
+        with self._lock:
+            metric = self._metrics[name] = Gauge(name, func)
+        return metric
+
+    def render(self, prefix=''):
+        ''' Return lines describing all metrics whose name starts with prefix. '''
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)
+                       if name.startswith(prefix)]
+        return [metric.render() for metric in metrics]
+
+    def clear(self):
+        ''' Forget all metrics. '''
+        with self._lock:
+            self._metrics.clear()
+
+METRICS = Metrics()
+
+class MetricsLogger(object):
+    ''' Writes all metrics to the log periodically. '''
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+        self.interval = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, interval):
+        ''' Start logging every interval seconds. '''
+        self.interval = interval
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-logger')
+        self._thread.daemon = True
+        self._thread.start()
+        LOGGER.info('Logging metrics every %s seconds.', interval)
+
+    def stop(self):
+        ''' Stop logging. '''
+        self._stopped.set()
+
+    def dump(self):
+        ''' Write all metrics to the log now. '''
+        for line in self.metrics.render():
+            LOGGER.info(line)
+
+    def _run(self):
+        ''' Logger thread main loop. '''
+        while not self._stopped.wait(self.interval):
+            self.dump()
@@ -0,0 +1,193 @@
+'''
+Contains the in-process outbound API, which lets scheduled jobs send messages.
+
+Scheduled jobs are pickled into the job store, so they must refer to a
+module-level function instead of the bot itself. send() is that function:
+it hands the message straight to the running bot, and only goes over the
+RPC socket when no bot is running in this process (e.g. external scripts).
+
+Also contains the outbound queue, which sits between the bot and the stack.
+'''
+import time
+import threading
+from collections import deque
+
+from .metrics import METRICS
+from .registry import get_easy_logger
+from . import rpc
+
+
+LOGGER = get_easy_logger('outbound')
+_SENDER = None
+
+def register_sender(func):
+    ''' Make func(body, recipient) the in-process send function. '''
+    global _SENDER
+    _SENDER = func
+
+def unregister_sender():
+    ''' Remove the in-process send function, send() falls back to RPC. '''
+    global _SENDER
+    _SENDER = None
+
+def send(body, recipient):
+    '''
+    Send body to recipient from any thread.
+
+    Uses the registered in-process sender if there is one, the RPC socket otherwise.
+    '''
+    sender = _SENDER
+    if sender is None:
+        LOGGER.debug('No local sender, sending to %s via RPC', recipient)
+        rpc.remote_send(body, recipient)
+        return
+    sender(body, recipient)
+
+class OutboundQueue(object):
+    '''
+    Buffers outgoing messages and sends them at a limited rate.
+
+    Messages are held while disconnected and sent once the connection is back.
+    The buffer is bounded; when it is full the oldest message is dropped.
+    Sending is limited by a global token bucket (rate messages per second,
+    bursts of up to burst messages) and a minimum interval per recipient.
+    Messages to the same recipient are always sent in order.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, send_func, maxlen=200, rate=2.0, burst=5,
+                 recipient_interval=1.0):
+        self.send_func = send_func
+        self.maxlen = maxlen
+        self.rate = rate
+        self.burst = burst
+        self.recipient_interval = recipient_interval
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._next_allowed = {}     # recipient -> earliest time of next send
+        self._tokens = float(burst)
+        self._last_refill = time.time()
+        self._connected = False
+        self._running = False
+        self._thread = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._send_timer = METRICS.histogram('outbound.send')
+
+    def start(self):
+        ''' Start the sending thread. '''
+        with self._cond:
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='outbound')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        ''' Stop sending, after trying to empty the queue for at most timeout seconds. '''
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._queue and self._connected and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            self._running = False
+            self._cond.notify_all()
+        if self._queue:
+            LOGGER.warning('%s outgoing messages not sent.', len(self._queue))
+
+    def put(self, entity):
+        ''' Queue an entity for sending. '''
+        with self._cond:
+            if len(self._queue) >= self.maxlen:
+                dropped = self._queue.popleft()
+                self.dropped += 1
+                LOGGER.warning('Outbound queue full, dropped message to %s',
+                               dropped.getTo())
+            self._queue.append(entity)
+            self._cond.notify_all()
+
+    def set_connected(self, connected):
+        ''' Pause (False) or resume (True) sending. '''
+        with self._cond:
+            self._connected = connected
+            if connected:
+                LOGGER.info('Connected, %s messages queued.', len(self._queue))
+            self._cond.notify_all()
+
+    def is_full(self):
+        ''' Return whether the next put() will drop a message. '''
+        with self._cond:
+            return len(self._queue) >= self.maxlen
+
+    def stats(self):
+        ''' Return a dict with the queue depth and counters. '''
+        with self._cond:
+            return {
+                'depth': len(self._queue),
+                'connected': self._connected,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                }
+
+    def _refill(self, now):
+        ''' Add the tokens earned since the last refill, lock must be held. '''
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _take(self, now):
+        '''
+        Find the next entity that may be sent now, lock must be held.
+
+        Returns (entity, None), or (None, seconds to wait).
+        '''
+        self._refill(now)
+        if self._tokens < 1:
+            return None, (1 - self._tokens) / self.rate
+        wait = None
+        blocked = set()
+        for index, entity in enumerate(self._queue):
+            recipient = entity.getTo()
+            if recipient in blocked:
+                continue
+            allowed = self._next_allowed.get(recipient, 0)
+            if allowed <= now:
+                del self._queue[index]
+                self._tokens -= 1
+                self._next_allowed[recipient] = now + self.recipient_interval
+                if len(self._next_allowed) > self.maxlen:
+                    self._forget_recipients(now)
+                return entity, None
+            blocked.add(recipient)
+            wait = allowed - now if wait is None else min(wait, allowed - now)
+        return None, wait
+
+    def _forget_recipients(self, now):
+        ''' Drop per-recipient intervals that have passed, lock must be held. '''
+        self._next_allowed = {recipient: allowed for recipient, allowed
+                              in self._next_allowed.iteritems() if allowed > now}
+
+    def _run(self):
+        ''' Sending thread main loop. '''
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    entity, wait = None, None
+                    if self._connected and self._queue:
+                        entity, wait = self._take(time.time())
+                        if entity is not None:
+                            break
+                    self._cond.wait(wait)
+                self._cond.notify_all()
+            began = time.time()
+            try:
+                self.send_func(entity)
+                self.sent += 1
+                self._send_timer.observe(time.time() - began)
+            except Exception as ex: #pylint: disable=broad-except
+                self._send_timer.observe(time.time() - began, error=True)
+                self.failed += 1
+                LOGGER.error('Sending to %s failed: %s', entity.getTo(), ex)
@@ -1,27 +1,302 @@
 '''
 Provides the plugin infrastructure and some helper functions for plugins.
+
+Plugins are imported on first use: at startup only the names from the
+manifest are registered, as stubs which import the plugin when called.
 '''
 import os.path
+import pydoc
+import sys
 import importlib
-from tombot.registry import get_easy_logger
+import threading
+import time
+from tombot.registry import get_easy_logger, registry_changed
+from tombot.registry import COMMAND_DICT, COMMAND_CATEGORIES, RPC_DICT, EVENTS
+from tombot.registry import BOT_START, BOT_SHUTDOWN
+from tombot.registry import unregister_module, module_registrations, restore_registrations
+from .manifest import MANIFEST, CommandHelp
 
 
 LOGGER = get_easy_logger('moduleloader')
+PLUGIN_SUFFIX = '_plugin'
 
-def load_plugins():
-    '''
-    Import all plugins.
-    '''
+def plugin_name(name):
+    ''' Normalize 'users' and 'users_plugin' to 'users_plugin'. '''
+    name = name.strip().lower()
+    if not name.endswith(PLUGIN_SUFFIX):
+        name += PLUGIN_SUFFIX
+    return name
+
+def find_plugins():
+    ''' Return the names of all plugin modules in this package. '''
     root = os.path.dirname(__file__)
-    LOGGER.info('Loading plugins from %s', root)
+    result = []
     for dummy, dummy, files in os.walk(root):
         for ffile in files:
-            if ffile.endswith('_plugin.py'):
-                modulename = ffile.strip('.py')
-                LOGGER.info('Initializing plugin %s', modulename)
-                try:
-                    importlib.import_module('.' + modulename, package=__name__)
-                    LOGGER.debug('%s loaded.', modulename)
-                except (NameError, SyntaxError) as ex:
-                    LOGGER.error('Module %s cannot be loaded!', modulename)
-                    LOGGER.error(ex)
+            if ffile.endswith(PLUGIN_SUFFIX + '.py'):
+                result.append(ffile[:-len('.py')])
+    return sorted(result)
+
+class LazyCommand(object):
+    ''' Stands in for a command or RPC command until its plugin is imported. '''
+    def __init__(self, loader, plugin, name, target_dict):
+        self.loader = loader
+        self.plugin = plugin
+        self.name = name
+        self.target_dict = target_dict
+        self.__doc__ = 'Provided by {}, not loaded yet.'.format(plugin)
+
+    def __call__(self, *args, **kwargs):
+        self.loader.load(self.plugin)
+        if self.target_dict is COMMAND_DICT:
+            bot = args[0]
+            func = bot.functions.get(self.name)
+        else:
+            func = self.target_dict.get(self.name)
+        if func is None or isinstance(func, LazyCommand):
+            # The plugin failed to load or disabled the command
+            LOGGER.error('%s did not provide %s.', self.plugin, self.name)
+            return None
+        return func(*args, **kwargs)
+
+class LazyEvent(object):
+    ''' Subscribed in place of a plugin, imports it when the event fires. '''
+    def __init__(self, loader, plugin, eventname):
+        self.loader = loader
+        self.plugin = plugin
+        self.eventname = eventname
+        self.__name__ = 'lazy_{}'.format(plugin)
+
+    def __call__(self, *args, **kwargs):
+        # Blocks while another caller is importing the plugin
+        self.loader.load(self.plugin)
+        if self.plugin in self.loader.loaded:
+            # The stubs are swapped for the plugin's own handlers at once, so
+            # those were not subscribed when this event started firing.
+            EVENTS.deliver(self.eventname, args, kwargs,
+                           module=self.loader.module_name(self.plugin))
+
+    def __repr__(self):
+        return '<LazyEvent {} {}>'.format(self.plugin, self.eventname)
+
+class PluginLoader(object):
+    '''
+    Imports plugins on first use.
+
+    Which plugins are available is read from the manifest; plugins that are
+    not in the manifest are imported at startup.
+    '''
+    def __init__(self, package):
+        self.package = package
+        self.bot = None
+        self.disabled = set()
+        self.loaded = {}        # plugin -> seconds spent importing
+        self.failed = set()
+        self.lock = threading.RLock()
+
+    def module_name(self, plugin):
+        ''' Return the full module name of a plugin. '''
+        return '{}.{}'.format(self.package, plugin)
+
+    def enabled(self):
+        ''' Return the names of all enabled plugins. '''
+        return [plugin for plugin in find_plugins() if plugin not in self.disabled]
+
+    def install(self, bot, lazy=True):
+        '''
+        Register stubs for all enabled plugins and import the ones needed at startup.
+
+        BOT_START must be fired after this.
+        '''
+        self.bot = bot
+        conf = bot.config.get('Plugins', {}) if bot else {}
+        self.disabled = set(plugin_name(name) for name in conf.get('disabled', []))
+        lazy = lazy and conf.get('lazy', True)
+        for plugin in sorted(self.disabled):
+            LOGGER.info('Plugin %s disabled.', plugin)
+        eager = []
+        for plugin in self.enabled():
+            spec = MANIFEST.get(plugin)
+            if not lazy or spec is None or BOT_START in spec.events:
+                eager.append(plugin)
+                continue
+            for name in spec.commands:
+                COMMAND_DICT.setdefault(
+                    name.upper(), LazyCommand(self, plugin, name.upper(), COMMAND_DICT))
+            for name in spec.rpc:
+                RPC_DICT.setdefault(
+                    name.upper(), LazyCommand(self, plugin, name.upper(), RPC_DICT))
+            for eventname in spec.events:
+                # Before the plugin's own handlers would have run
+                EVENTS.subscribe(eventname, LazyEvent(self, plugin, eventname), priority=100)
+        registry_changed()
+        for plugin in eager:
+            self.load(plugin, start=False)
+
+    def load(self, plugin, start=True):
+        '''
+        Import a plugin if it was not imported yet.
+
+        Plugins imported after startup get their BOT_START handlers called,
+        as well as any other plugins they import. Callers wait while another
+        thread imports the plugin. Returns True if the plugin was imported by
+        this call.
+        '''
+        if plugin in self.loaded or plugin in self.failed:
+            return False
+        with self.lock:
+            if plugin in self.loaded or plugin in self.failed:
+                return False
+            before = set(sys.modules)
+            commands_before = set(COMMAND_DICT)
+            prefix = self.package + '.'
+            # Event handlers of the plugin (and plugins it imports) replace the
+            # stubs in one step, so no event reaches both or neither.
+            EVENTS.hold(
+                lambda func: (getattr(func, '__module__', None) or '').startswith(prefix))
+            LOGGER.info('Initializing plugin %s', plugin)
+            began = time.time()
+            try:
+                importlib.import_module('.' + plugin, package=self.package)
+            except Exception as ex: #pylint: disable=broad-except
+                LOGGER.error('Module %s cannot be loaded!', plugin)
+                LOGGER.error(ex)
+                EVENTS.release(discard=True)
+                self.failed.add(plugin)
+                self._drop_stubs(plugin)
+                return False
+            self.loaded[plugin] = time.time() - began
+            LOGGER.debug('%s loaded in %.3fs.', plugin, self.loaded[plugin])
+            # Also account for plugins imported by this one
+            new = [name for name in set(sys.modules) - before
+                   if name.startswith(prefix) and name.endswith(PLUGIN_SUFFIX)]
+            for name in new:
+                self.loaded.setdefault(name[len(prefix):], 0.0)
+                self._check_manifest(name[len(prefix):])
+            EVENTS.release(drop=lambda func: isinstance(func, LazyEvent) and
+                           func.loader.module_name(func.plugin) in new)
+            registry_changed()
+            if self.bot is not None:
+                self.bot.functions.update(
+                    (key, func) for key, func in COMMAND_DICT.items()
+                    if getattr(func, '__module__', None) in new)
+                if set(COMMAND_DICT) - commands_before:
+                    # Commands the manifest did not list have no route yet
+                    self.bot.rebuild_router()
+                if start:
+                    for name in sorted(new):
+                        EVENTS.deliver(BOT_START, (self.bot,), {}, module=name)
+            return True
+
+    def reload(self, plugin):
+        '''
+        Re-import a plugin in place, e.g. after its code was changed.
+
+        The plugin's BOT_SHUTDOWN handlers are called, everything it
+        registered is removed, and after the import its BOT_START handlers
+        are called. Other plugins should use its functions and state as
+        attributes of its module (users_plugin.CACHE), names imported with
+        'from .users_plugin import CACHE' keep referring to the old objects.
+        Returns False if the new code could not be imported, the plugin then
+        keeps running its old code.
+        '''
+        module_name = self.module_name(plugin)
+        with self.lock:
+            module = sys.modules.get(module_name)
+            if plugin not in self.loaded or module is None:
+                self.failed.discard(plugin)
+                return self.load(plugin)
+            LOGGER.info('Reloading plugin %s', plugin)
+            saved = module_registrations(module_name)
+            if self.bot is not None:
+                EVENTS.deliver(BOT_SHUTDOWN, (self.bot,), {}, module=module_name)
+            unregister_module(module_name)
+            if self.bot is not None:
+                for key, func in self.bot.functions.items():
+                    if getattr(func, '__module__', None) == module_name:
+                        del self.bot.functions[key]
+            namespace = dict(module.__dict__)
+            began = time.time()
+            try:
+                reload(module)
+            except Exception as ex: #pylint: disable=broad-except
+                LOGGER.error('Module %s cannot be reloaded, keeping the old code!', plugin)
+                LOGGER.exception(ex)
+                # Forget what the failed import did, bring the old code back
+                module.__dict__.clear()
+                module.__dict__.update(namespace)
+                unregister_module(module_name)
+                restore_registrations(saved)
+                if self.bot is not None:
+                    self.bot.functions.update(saved.commands)
+                    self.bot.rebuild_router()
+                    EVENTS.deliver(BOT_START, (self.bot,), {}, module=module_name)
+                return False
+            self.loaded[plugin] = time.time() - began
+            self._check_manifest(plugin)
+            registry_changed()
+            if self.bot is not None:
+                self.bot.functions.update(
+                    (key, func) for key, func in COMMAND_DICT.items()
+                    if getattr(func, '__module__', None) == module_name)
+                self.bot.rebuild_router()
+                EVENTS.deliver(BOT_START, (self.bot,), {}, module=module_name)
+            LOGGER.info('%s reloaded in %.3fs.', plugin, self.loaded[plugin])
+            return True
+
+    def load_all(self):
+        ''' Import all enabled plugins, e.g. to list all commands. '''
+        for plugin in self.enabled():
+            self.load(plugin)
+
+    def _check_manifest(self, plugin):
+        ''' Warn about manifest entries the plugin did not register. '''
+        spec = MANIFEST.get(plugin)
+        if spec is None:
+            return
+        for name in spec.commands:
+            if isinstance(COMMAND_DICT.get(name.upper()), LazyCommand):
+                LOGGER.warning('Manifest lists command %s, but %s does not provide it.',
+                               name, plugin)
+        for name in spec.rpc:
+            if isinstance(RPC_DICT.get(name.upper()), LazyCommand):
+                LOGGER.warning('Manifest lists RPC command %s, but %s does not provide it.',
+                               name, plugin)
+        module_name = self.module_name(plugin)
+        registered = set(
+            CommandHelp(entry.name, entry.aliases, category,
+                        pydoc.splitdoc(pydoc.getdoc(entry.func))[0])
+            for category, entries in COMMAND_CATEGORIES.items() for entry in entries
+            if getattr(entry.func, '__module__', None) == module_name and not entry.hidden
+            and COMMAND_DICT.get(entry.name.upper()) is entry.func)
+        for entry in registered.symmetric_difference(spec.help):
+            LOGGER.warning('Help for %s in the manifest differs from what %s registers.',
+                           entry.name, plugin)
+
+    @staticmethod
+    def _drop_event_stubs(modules):
+        ''' Unsubscribe the event stubs of plugins that have been imported. '''
+        EVENTS.unsubscribe_where(
+            lambda func: isinstance(func, LazyEvent) and func.loader.module_name(
+                func.plugin) in modules)
+
+    def _drop_stubs(self, plugin):
+        ''' Forget all stubs of a plugin that could not be imported. '''
+        for target_dict in (COMMAND_DICT, RPC_DICT):
+            for key, func in target_dict.items():
+                if isinstance(func, LazyCommand) and func.plugin == plugin:
+                    del target_dict[key]
+        self._drop_event_stubs([self.module_name(plugin)])
+        registry_changed()
+
+LOADER = PluginLoader(__name__)
+
+def load_plugins(bot=None):
+    '''
+    Prepare all enabled plugins for use.
+
+    With a bot, plugins are imported on first use as configured in its
+    Plugins config section. Without one, all plugins are imported at once.
+    '''
+    LOGGER.info('Loading plugins from %s', os.path.dirname(__file__))
+    LOADER.install(bot, lazy=bot is not None)
@@ -3,7 +3,7 @@ ABAS: Automated Birthday Announcement System
 '''
 from apscheduler.jobstores.base import JobLookupError
 from tombot.registry import get_easy_logger, Subscribe, BOT_START, BOT_SHUTDOWN
-from tombot.rpc import remote_send
+from tombot.outbound import send
 
 
 LOGGER = get_easy_logger('plugins.abas')
@@ -12,18 +12,17 @@ def announce_bday(name, recipient):
     ''' Send a congratulation for name to recipient. '''
     LOGGER.info('Congratulating %s', name)
     body = 'Gefeliciteerd, {}!'.format(name)
-    remote_send(body, recipient)
+    send(body, recipient)
 
 @Subscribe(BOT_START)
 def abas_register_cb(bot, *args, **kwargs):
     ''' Add jobs to the scheduler for all birthdays. '''
     LOGGER.info('Registering ABAs.')
     try:
-        bot.cursor.execute('SELECT primary_nick,bday FROM users WHERE bday IS NOT NULL')
+        results = bot.db.fetchall('SELECT primary_nick,bday FROM users WHERE bday IS NOT NULL')
     except TypeError:
         LOGGER.error('Invalid date found, fix your database!')
         return
-    results = bot.cursor.fetchall()
     for person in results:
         LOGGER.info('Scheduling ABA for %s', person[0])
         bot.scheduler.add_job(
@@ -45,8 +44,7 @@ def abas_deregister_cb(bot, *args, **kwargs):
     functions leads to Fun.
     '''
     LOGGER.info('Deregistering ABAs.')
-    bot.cursor.execute('SELECT primary_nick FROM users WHERE bday IS NOT NULL')
-    results = bot.cursor.fetchall()
+    results = bot.db.fetchall('SELECT primary_nick FROM users WHERE bday IS NOT NULL')
     for person in results:
         try:
             bot.scheduler.remove_job('abas.{}'.format(person[0]))
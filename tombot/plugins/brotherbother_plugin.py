@@ -3,7 +3,7 @@ Brotherbother: semianonymously send messages under a group's name.
 '''
 from tombot.helper_functions import extract_query
 from tombot.registry import Command
-from .users_plugin import jid_to_nick, nick_to_jid
+from . import users_plugin
 from yowsup.layers.protocol_messages.protocolentities import TextMessageProtocolEntity
 
 
@@ -14,7 +14,7 @@ def anonsend_cb(bot, message, *args, **kwargs):
         return
 
     try:
-        groupname = jid_to_nick(bot, message.getFrom())
+        groupname = users_plugin.jid_to_nick(bot, message.getFrom())
     except KeyError:
         return 'This group is not enrolled in the BrotherBother program, sorry'
 
@@ -24,7 +24,7 @@ def anonsend_cb(bot, message, *args, **kwargs):
     # Who was mentioned?
     nick = message.getBody().split()[2]
     try:
-        recipient = nick_to_jid(bot, nick)
+        recipient = users_plugin.nick_to_jid(bot, nick)
     except KeyError:
         return 'Unknown recipient!'
 
@@ -2,9 +2,8 @@
 Provides the cookie command, which originally was a test for unicode and now
 spouts cookie quotes.
 '''
-import fortune
 from tombot.registry import Command, get_easy_logger
-from .fortune_plugin import SPECIALS
+from . import fortune_plugin
 
 
 LOGGER = get_easy_logger('plugins.cookie')
@@ -15,7 +14,7 @@ def cookie_cb(bot, *args, **kwargs):
     Return a cookie-related quote.
     '''
     try:
-        return fortune.get_random_fortune(SPECIALS['cookie.spc'])
+        return fortune_plugin.SPECIALS['cookie.spc'].random()
     except KeyError:
         LOGGER.error('Specials file was not loaded!')
         return 'Error!\xf0\x9f\x8d\xaa'
@@ -34,7 +34,7 @@ def diceroll_cb(bot, message, *args, **kwargs):
 
     Supported operators are: +, -, /, *, % (modulo), ^ (power).
     '''
-    query = extract_query(message)
+    query = extract_query(kwargs.get('view') or message)
     match = DICE_PATTERN.search(query)
     if match is None:
         return
@@ -7,7 +7,9 @@ plaatsvinden, zie de docstring van doekoe().
 '''
 from __future__ import print_function
 from collections import namedtuple
+import bisect
 import datetime
+import threading
 from datetime import date
 
 from dateutil.relativedelta import relativedelta
@@ -15,14 +17,83 @@ import dateutil.rrule
 from dateutil.rrule import rrule
 from apscheduler.jobstores.base import JobLookupError
 
-import tombot.rpc
+import tombot.outbound
 from tombot.registry import Command, get_easy_logger, Subscribe, BOT_START, BOT_SHUTDOWN
 
 
 LOGGER = get_easy_logger('plugins.doekoe')
 Rule = namedtuple('rule', 'name rule relocator')
+HORIZON_MONTHS = 13     # how far ahead the calendar is computed
+RELOCATION_MARGIN = 7   # days before today to include, relocators move dates by less
 
-def doekoe_neo(relative_to=datetime.datetime.today()):
+class PayoutCalendar(object):
+    '''
+    Table of the (relocated) payout dates of all rules for the coming months.
+
+    Built once per day; answering 'when is the next payout' is then a binary
+    search per rule, and 'what is today' a binary search in the merged table.
+    '''
+    def __init__(self, rules, horizon_months=HORIZON_MONTHS):
+        self.rules = rules
+        self.horizon_months = horizon_months
+        self.lock = threading.Lock()
+        self.built_on = None
+        self._dates = {}    # rule name -> sorted list of dates
+        self._merged = []   # sorted list of (date, rule name)
+
+    def build(self, today):
+        ''' Compute all payout dates from a few days before today up to the horizon. '''
+        start = datetime.datetime.combine(
+            today - datetime.timedelta(days=RELOCATION_MARGIN), datetime.time())
+        end = datetime.datetime.combine(
+            today + relativedelta(months=self.horizon_months), datetime.time())
+        dates = {}
+        merged = []
+        for rule in self.rules:
+            relocated = sorted(set(
+                rule.relocator(naive) for naive in rule.rule.between(start, end, inc=True)))
+            dates[rule.name] = relocated
+            merged.extend((day, rule.name) for day in relocated)
+        merged.sort()
+        with self.lock:
+            self._dates = dates
+            self._merged = merged
+            self.built_on = today
+        LOGGER.info('Payout calendar built for %s: %s dates.', today, len(merged))
+
+    def ensure(self, today):
+        ''' Rebuild the calendar if it was not built today. '''
+        if self.built_on != today:
+            self.build(today)
+
+    def next_occurrences(self, today):
+        '''
+        Return a (Rule, date) tuple for the first payout of every rule on or after today.
+
+        Rules without a payout within the horizon are left out.
+        '''
+        self.ensure(today)
+        result = []
+        with self.lock:
+            for rule in self.rules:
+                dates = self._dates[rule.name]
+                index = bisect.bisect_left(dates, today)
+                if index < len(dates):
+                    result.append((rule, dates[index]))
+        return result
+
+    def on(self, day):
+        ''' Return the names of the rules that pay out on day. '''
+        self.ensure(day)
+        with self.lock:
+            index = bisect.bisect_left(self._merged, (day,))
+            names = []
+            while index < len(self._merged) and self._merged[index][0] == day:
+                names.append(self._merged[index][1])
+                index += 1
+        return names
+
+def doekoe_neo(relative_to=None):
     '''
     Bereken wanneer de uitbetalingen in RULES gebeuren.
 
@@ -30,7 +101,8 @@ def doekoe_neo(relative_to=datetime.datetime.today()):
     '''
     result = ''
 
-    relative_to.replace(hour=0, minute=0, second=0, microsecond=0)
+    if relative_to is None:
+        relative_to = datetime.datetime.today()
 
     LOGGER.debug('relative_to %s', relative_to)
     for item in next_occurrences(relative_to):
@@ -39,9 +111,8 @@ def doekoe_neo(relative_to=datetime.datetime.today()):
             result += '{} is vandaag! ({})\n'.format(
                 item[0].name, item[1])
         else:
-            delta = relativedelta(item[1], relative_to.date())
-            LOGGER.debug('Delta: %s (%s)', delta, delta.days)
-            numdays = delta.days
+            numdays = (item[1] - relative_to.date()).days
+            LOGGER.debug('Delta: %s days', numdays)
             word = 'dag' if numdays == 1 else 'dagen'
             result += '{} komt over {} {}. ({})\n'.format(
                 item[0].name, numdays, word, item[1])
@@ -49,25 +120,28 @@ def doekoe_neo(relative_to=datetime.datetime.today()):
     result += '\n\nAan deze informatie kunnen geen rechten worden ontleend.'
     return result
 
-def next_occurrences(relative_to=datetime.datetime.today()):
+def next_occurrences(relative_to=None):
     '''
     Calculate when the rules in RULES will next fire.
     Returns a list of (Rule, datetime.date) tuples.
     '''
-    result = []
-    for rule in RULES:
-        yesterday = relative_to - datetime.timedelta(days=1)
-        naive_next = rule.rule.after(yesterday)
-        actual_next = rule.relocator(naive_next)
-        result.append((rule, actual_next))
+    if relative_to is None:
+        relative_to = datetime.datetime.today()
+    if hasattr(relative_to, 'date'):
+        relative_to = relative_to.date()
+    return CALENDAR.next_occurrences(relative_to)
 
-    return result
-
-def which_today(relative_to=datetime.datetime.today()):
+def which_today(relative_to=None):
     ''' List all events which should happen on the same date as relative_to. '''
-    todays_events = [x[0].name for x in next_occurrences(relative_to)
-                     if x[1] == date.today()]
-    return todays_events
+    if relative_to is None:
+        relative_to = date.today()
+    if hasattr(relative_to, 'date'):
+        relative_to = relative_to.date()
+    return CALENDAR.on(relative_to)
+
+def refresh_calendar_cb(*args, **kwargs):
+    ''' Rebuild the payout calendar for the new day. '''
+    CALENDAR.build(date.today())
 
 def midnight_announce_cb(recipient, *args, **kwargs):
     '''
@@ -83,7 +157,7 @@ def midnight_announce_cb(recipient, *args, **kwargs):
     result = 'Vandaag {} {}!'.format(
         'komt' if len(todays_events) == 1 else 'komen',
         ', '.join(todays_events))
-    tombot.rpc.remote_send(result, recipient)
+    tombot.outbound.send(result, recipient)
     LOGGER.info('Done.')
 
 @Subscribe(BOT_START)
@@ -100,6 +174,12 @@ def add_midnight_announce_cb(bot, *args, **kwargs):
         args=(bot.config['Jids']['announce-group'],),
         replace_existing=True,
         *args, **kwargs)
+    bot.scheduler.add_job(
+        refresh_calendar_cb,
+        'cron', hour=0, minute=0, second=0,
+        coalesce=True, misfire_grace_time=3600,
+        id='plugins.doekoe.refresh',
+        replace_existing=True)
 
 @Subscribe(BOT_SHUTDOWN)
 def rem_midnight_announce_cb(bot, *args, **kwargs):
@@ -107,10 +187,11 @@ def rem_midnight_announce_cb(bot, *args, **kwargs):
     Verwijder announcer bij afsluiten om geen dubbele jobs te krijgen.
     '''
     LOGGER.info('Deregistering doekoeannouncer.')
-    try:
-        bot.scheduler.remove_job('plugins.doekoe.midnight')
-    except JobLookupError:
-        pass
+    for job_id in ('plugins.doekoe.midnight', 'plugins.doekoe.refresh'):
+        try:
+            bot.scheduler.remove_job(job_id)
+        except JobLookupError:
+            pass
 
 def doekoe():
     '''
@@ -207,9 +288,13 @@ def last_weekday_before(arg):
         return arg
     return arg + relativedelta(days=4 - arg.weekday())
 
+# Monthly rules start in the past, so the calendar can relocate payouts
+# from just before the bot started.
+RULES_START = date(2016, 1, 1)
 RULES = [
     Rule('SaH-loon',
-         rrule(dateutil.rrule.MONTHLY, bymonthday=8),
+         rrule(dateutil.rrule.MONTHLY, bymonthday=8,
+               dtstart=RULES_START, cache=True),
          lambda x: x.date()),
     Rule('AH-loon',
          rrule(dateutil.rrule.WEEKLY, interval=4,
@@ -217,17 +302,18 @@ RULES = [
          first_weekday_after),
     Rule('Defensie-loon',
          rrule(dateutil.rrule.MONTHLY, bymonthday=21,
-               cache=True),
+               dtstart=RULES_START, cache=True),
          first_weekday_after),
     Rule('Zorgtoeslag',
          rrule(dateutil.rrule.MONTHLY, bymonthday=20,
-               cache=True),
+               dtstart=RULES_START, cache=True),
          first_weekday_after),
     Rule('Stufi',
          rrule(dateutil.rrule.MONTHLY, bymonthday=24,
-               cache=True),
+               dtstart=RULES_START, cache=True),
          last_weekday_before),
     ]
+CALENDAR = PayoutCalendar(RULES)
 
 if __name__ == '__main__':
     print(doekoe_neo())
@@ -1,22 +1,106 @@
 '''
 Provides command for answering queries using the DuckDuckGo API.
+
+Answers and misses are cached (misses for a shorter time), identical
+queries asked at the same time share one request, and callers stop
+waiting for DuckDuckGo after LOOKUP_TIMEOUT seconds.
 '''
+import json
+import urllib
+import urllib2
+
 import duckduckgo
-from tombot.registry import Command, get_easy_logger
+from tombot.cache import LRUCache, SingleFlight, CallTimeout
+from tombot.registry import Command, RPCCommand, get_easy_logger
 from tombot.helper_functions import extract_query
 
 
 LOGGER = get_easy_logger('plugins.duckduckgo')
+LOOKUP_TIMEOUT = 10 # seconds
+QUERY_TIMEOUT = 8   # seconds, the request itself gives up before the callers
+API_URL = 'http://api.duckduckgo.com/'
+NO_RESULT = 'Sorry, no results.'
+ANSWERS = LRUCache(maxsize=512, ttl=24 * 60 * 60)
+MISSES = LRUCache(maxsize=256, ttl=10 * 60)
+LOOKUPS = SingleFlight('duckduckgo')
+
+def normalise(query):
+    ''' Return the cache key for a query: lowercased, whitespace collapsed. '''
+    return ' '.join(query.lower().split())
+
+def timed_query(query):
+    '''
+    Do duckduckgo.query(query), but give up if the network stalls.
+
+    duckduckgo.query uses urlopen without a timeout.
+    '''
+    params = {'q': query, 'o': 'json', 'kp': '1', 'no_redirect': '1',
+              'no_html': '1', 'd': '1'}
+    request = urllib2.Request(
+        API_URL + '?' + urllib.urlencode(params),
+        headers={'User-Agent': 'python-duckduckgo {}'.format(duckduckgo.__version__)})
+    resp = urllib2.urlopen(request, timeout=QUERY_TIMEOUT)
+    try:
+        return duckduckgo.Results(json.loads(resp.read()))
+    finally:
+        resp.close()
+
+def zero_click(results):
+    ''' Pick the best answer from results like duckduckgo.get_zci, None if there is none. '''
+    for field in ('answer', 'abstract', 'related', 'definition'):
+        result = getattr(results, field)
+        if field == 'related':
+            result = result[0] if result else None
+        if result and result.text:
+            url = getattr(result, 'url', None)
+            return u'{} ({})'.format(result.text, url) if url else result.text
+    return results.redirect.url or None
+
+def lookup(key, query):
+    '''
+    Ask DuckDuckGo, store the outcome in the caches and return the answer.
+
+    Returns None if DuckDuckGo has no answer; network errors are raised and
+    not cached.
+    '''
+    try:
+        answer = zero_click(timed_query('\\' + query))
+    except (ValueError, AttributeError):
+        answer = None
+    if answer:
+        ANSWERS.put(key, answer)
+    else:
+        MISSES.put(key, True)
+    return answer
 
 @Command(['duckduckgo', 'ddg', 'define'], 'info')
 def duckduckgo_cb(bot, message, *args, **kwargs):
     '''
     Answer query using DuckDuckGo.
     '''
+    query = extract_query(kwargs.get('view') or message)
+    key = normalise(query)
+    answer = ANSWERS.get(key)
+    if answer is not None:
+        return answer
+    if MISSES.get(key):
+        return NO_RESULT
     try:
-        query = extract_query(message)
-        return duckduckgo.get_zci(query)
-    except ValueError:
-        return 'Sorry, no results.'
-    except AttributeError:
-        return 'Sorry, no results.'
+        answer = LOOKUPS.do(key, lookup, LOOKUP_TIMEOUT, key, query)
+    except CallTimeout as ex:
+        LOGGER.warning(ex)
+        return 'Sorry, DuckDuckGo is not answering.'
+    except IOError as ex:
+        LOGGER.error('DuckDuckGo lookup %s failed: %s', query, ex)
+        return NO_RESULT
+    return answer or NO_RESULT
+
+@RPCCommand('ddgstats')
+def duckduckgo_stats_rpc(handler, *args):
+    ''' Report DuckDuckGo cache hit rates and request de-duplication counters. '''
+    lines = []
+    for name, stats in (('answers', ANSWERS.stats()), ('misses', MISSES.stats()),
+                        ('lookups', LOOKUPS.stats())):
+        lines.append('{}: {}'.format(name, ' '.join(
+            '{}={}'.format(key, stats[key]) for key in sorted(stats))))
+    return '\n'.join(lines)
@@ -1,15 +1,128 @@
 '''
 8ball: provide answers from the void beyond.
 '''
-import os.path
+import os
 import random
-import fortune
+import bisect
+import threading
 from tombot.registry import Command, get_easy_logger, Subscribe, BOT_START
 
 
 LOGGER = get_easy_logger('plugins.fortune')
-FORTUNE_FILES = []
-SPECIALS = {}
+FORTUNE_DELIMITER = '%'
+
+class FortuneFile(object):
+    '''
+    One fortune file, read into memory once with an index of where each entry is.
+
+    Entries are separated by lines containing only a '%'.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'rb') as ffile:
+            self.data = ffile.read()
+        self.offsets = self._index(self.data)
+        if not self.offsets:
+            raise ValueError('No fortunes in {}'.format(path))
+
+    @staticmethod
+    def _index(data):
+        ''' Return a list of (start, end) offsets of the non-empty entries. '''
+        offsets = []
+        start = 0
+        position = 0
+        length = len(data)
+        while position < length:
+            newline = data.find('\n', position)
+            if newline == -1:
+                newline = length
+            if data[position:newline].rstrip('\r') == FORTUNE_DELIMITER:
+                if data[start:position].strip():
+                    offsets.append((start, position))
+                start = newline + 1
+            position = newline + 1
+        if data[start:].strip():
+            offsets.append((start, length))
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def entry(self, number):
+        ''' Return entry number, without surrounding newlines. '''
+        start, end = self.offsets[number]
+        return self.data[start:end].strip('\r\n')
+
+    def random(self):
+        ''' Return a random entry. '''
+        return self.entry(random.randrange(len(self.offsets)))
+
+class FortuneCorpus(object):
+    '''
+    All fortune files with a given suffix in a directory tree.
+
+    Files are known by their path relative to root, e.g. 'eightball.spc'.
+    scan() only rereads files whose modification time changed, random()
+    picks uniformly over all entries of all files.
+    '''
+    def __init__(self, root, suffix):
+        self.root = root
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.files = {}         # path relative to root -> FortuneFile
+        self._files = []        # FortuneFiles in index order
+        self._cumulative = []   # number of entries up to and including each file
+
+    def scan(self):
+        ''' (Re)load new and changed files, forget removed ones. '''
+        files = {}
+        for root, dummy, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root)
+                known = self.files.get(key)
+                try:
+                    if known and known.mtime == os.path.getmtime(path):
+                        files[key] = known
+                        continue
+                    LOGGER.debug('Loading fortune file %s', path)
+                    files[key] = FortuneFile(path)
+                except (IOError, OSError, ValueError) as ex:
+                    LOGGER.error('Fortune file %s failed to load: %s', path, ex)
+        ordered = sorted(files.values(), key=lambda x: x.path)
+        cumulative = []
+        total = 0
+        for ffile in ordered:
+            total += len(ffile)
+            cumulative.append(total)
+        with self.lock:
+            self.files = files
+            self._files = ordered
+            self._cumulative = cumulative
+        return files
+
+    def __len__(self):
+        return self._cumulative[-1] if self._cumulative else 0
+
+    def __getitem__(self, name):
+        return self.files[name]
+
+    def random(self):
+        ''' Return a random entry, every entry of every file equally likely. '''
+        with self.lock:
+            if not self._cumulative:
+                raise ValueError('No fortunes loaded')
+            number = random.randrange(self._cumulative[-1])
+            index = bisect.bisect_right(self._cumulative, number)
+            ffile = self._files[index]
+            previous = self._cumulative[index - 1] if index else 0
+        return ffile.entry(number - previous)
+
+FORTUNES = FortuneCorpus('fortunes/', '.txt')
+SPECIALS = FortuneCorpus('specials/', '.spc')
 
 @Command('fortune', 'fortune')
 def fortune_cb(bot, *args, **kwargs):
@@ -17,8 +130,7 @@ def fortune_cb(bot, *args, **kwargs):
     Return a random quote from one of the quote files.
     '''
     try:
-        source = random.choice(FORTUNE_FILES)
-        return fortune.get_random_fortune(source)
+        return FORTUNES.random()
     except ValueError as ex:
         LOGGER.error('Fortune failed: %s', ex)
         return _('Be the quote you want to see on a wall.\n -- Error 20XX')
@@ -27,41 +139,16 @@ def fortune_cb(bot, *args, **kwargs):
 @Command('loadfortunes', 'fortune', hidden=True)
 def load_fortunes_cb(bot, message=None, *args, **kwargs):
     '''
-    (Re)load all fortune and specials files from their directories.
+    (Re)load changed fortune and specials files from their directories.
     '''
     LOGGER.info('Loading specials.')
-    for root, dummy, files in os.walk('specials/'):
-        for file_ in files:
-            if not file_.endswith('.spc'):
-                continue
-            LOGGER.debug('Loading specials file %s', file_)
-            abspath = os.path.join(root, file_)
-            try:
-                fortune.make_fortune_data_file(abspath, True)
-                SPECIALS[file_] = abspath
-                LOGGER.debug('Specials file %s loaded.', abspath)
-            except (TypeError, ValueError) as ex:
-                LOGGER.error('Specials file %s failed to load: %s',
-                             abspath, ex)
-    LOGGER.info('%s specials loaded.', len(SPECIALS))
+    SPECIALS.scan()
+    LOGGER.info('%s specials loaded.', len(SPECIALS.files))
 
     LOGGER.info('Loading fortunes.')
-    for root, dummy, files in os.walk('fortunes/'):
-        for file_ in files:
-            if not file_.endswith('.txt'):
-                continue
-            LOGGER.debug('Loading fortune file %s', file_)
-            abspath = os.path.join(root, file_)
-            try:
-                fortune.make_fortune_data_file(abspath, True)
-                FORTUNE_FILES.append(abspath)
-                LOGGER.debug('Fortune file %s loaded.',
-                             abspath)
-            except ValueError as ex:
-                LOGGER.error('Fortune file %s failed to load: %s',
-                             abspath, ex)
-
-    LOGGER.info('%s fortune files loaded.', len(FORTUNE_FILES))
+    FORTUNES.scan()
+    LOGGER.info('%s fortune files loaded, %s fortunes.',
+                len(FORTUNES.files), len(FORTUNES))
     if message:
         return 'Done.'
 
@@ -73,8 +160,7 @@ def eightball_cb(bot, *args, **kwargs):
     Accuracy not guaranteed.
     '''
     try:
-        return fortune.get_random_fortune(
-            SPECIALS['eightball.spc'])
+        return SPECIALS['eightball.spc'].random()
     except KeyError:
         LOGGER.error('Eightball specials not loaded!')
         return "Sorry, you're out of luck. (ERROR)"
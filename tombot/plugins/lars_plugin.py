@@ -3,9 +3,8 @@ The best plugin.
 
 Provides the best command, which provides bad pickuplines.
 '''
-import fortune
 from tombot.registry import Command
-from .fortune_plugin import SPECIALS
+from . import fortune_plugin
 
 
 @Command(['lars', 'loveyou', 'pickup', 'date'], 'fortune')
@@ -13,4 +12,4 @@ def lars_cb(bot, message, *args, **kwargs):
     '''
     Send a (bad) genderless pickupline to sender.
     '''
-    return fortune.get_random_fortune(SPECIALS['pickupline.spc'])
+    return fortune_plugin.SPECIALS['pickupline.spc'].random()
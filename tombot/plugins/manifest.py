@@ -0,0 +1,146 @@
+'''
+Lists what every plugin provides, so plugins can be loaded on first use.
+
+The command router only needs to know command names, not the functions
+behind them. With this manifest, a plugin is imported (with its possibly
+heavy dependencies) the first time one of its commands or RPC commands is
+called, or one of its events fires.
+
+The manifest also holds what the help command lists, so help does not
+have to import every plugin; only 'help <command>' imports the plugin for
+the command's full description.
+
+Keep this in sync with the decorators in the plugins: the loader logs a
+warning when a plugin does not register something listed here.
+'''
+from collections import namedtuple
+from tombot.registry import BOT_START, BOT_MSG_RECEIVE
+
+
+# commands: command names and aliases, as accepted by the router
+# rpc: RPC command names
+# events: events that should import the plugin when fired. Plugins listing
+#   BOT_START are imported at startup; other plugins have their BOT_START
+#   handlers called right after they are imported.
+# help: CommandHelp for each command listed by help, hidden ones are left out
+PluginSpec = namedtuple('PluginSpec', 'commands rpc events help')
+# name, aliases and category as given to @Command, summary: the first line
+# of the command's docstring
+CommandHelp = namedtuple('CommandHelp', 'name aliases category summary')
+
+MANIFEST = {
+    'abas_plugin': PluginSpec(
+        commands=(),
+        rpc=(),
+        events=(BOT_START,),
+        help=()),
+    'brotherbother_plugin': PluginSpec(
+        commands=('bother',),
+        rpc=(),
+        events=(),
+        help=(
+            CommandHelp('bother', (), None,
+                        "Send a mention under the group name and not the author's name"),
+            )),
+    'cookie_plugin': PluginSpec(
+        commands=('cookie', 'koekje', '\xf0\x9f\x8d\xaa'),
+        rpc=(),
+        events=(),
+        help=(
+            CommandHelp('cookie', ('koekje', '\xf0\x9f\x8d\xaa'), 'fortune',
+                        'Return a cookie-related quote.'),
+            )),
+    'diceroll_plugin': PluginSpec(
+        commands=('roll',),
+        rpc=(),
+        events=(),
+        help=(
+            CommandHelp('roll', (), None, 'Roll some dice!'),
+            )),
+    'doekoe_plugin': PluginSpec(
+        commands=('doekoe', 'duku', 'geld', 'gheldt', 'munnie', 'moneys', 'cash'),
+        rpc=(),
+        events=(BOT_START,),
+        help=(
+            CommandHelp('doekoe', ('duku', 'geld', 'gheldt', 'munnie', 'moneys', 'cash'),
+                        None, 'Tel af tot wanneer je weer geld krijgt.'),
+            )),
+    'duckduckgo_plugin': PluginSpec(
+        commands=('duckduckgo', 'ddg', 'define'),
+        rpc=('ddgstats',),
+        events=(),
+        help=(
+            CommandHelp('duckduckgo', ('ddg', 'define'), 'info',
+                        'Answer query using DuckDuckGo.'),
+            )),
+    'fortune_plugin': PluginSpec(
+        commands=('fortune', 'loadfortunes', '8ball', 'is'),
+        rpc=(),
+        events=(),
+        help=(
+            CommandHelp('fortune', (), 'fortune',
+                        'Return a random quote from one of the quote files.'),
+            CommandHelp('8ball', ('is',), 'fortune',
+                        'Provide certainty in a turbulent world.'),
+            )),
+    'lars_plugin': PluginSpec(
+        commands=('lars', 'loveyou', 'pickup', 'date'),
+        rpc=(),
+        events=(),
+        help=(
+            CommandHelp('lars', ('loveyou', 'pickup', 'date'), 'fortune',
+                        'Send a (bad) genderless pickupline to sender.'),
+            )),
+    'mention_plugin': PluginSpec(
+        commands=('timeout', 'settimeout', 'ftimeout'),
+        rpc=(),
+        events=(BOT_MSG_RECEIVE,),
+        help=(
+            CommandHelp('timeout', ('settimeout',), 'mentions',
+                        'Update your mention timeout.'),
+            )),
+    'reminder_plugin': PluginSpec(
+        commands=('remind', 'remindme'),
+        rpc=(),
+        events=(),
+        help=(
+            CommandHelp('remind', ('remindme',), None,
+                        '(Hopefully) sends user a message at the given time'),
+            )),
+    'system_plugin': PluginSpec(
+        commands=('ping', 'forcelog', 'shutdown', 'halt', 'restart',
+                  'logdebug', 'loginfo', 'help', '?', 'reload'),
+        rpc=('reload',),
+        events=(),
+        help=(
+            CommandHelp('ping', (), 'system', "Return 'pong' to indicate non-deadness."),
+            CommandHelp('shutdown', ('halt',), 'system', 'Shut down the bot.'),
+            CommandHelp('restart', (), 'system', 'Restart the bot.'),
+            CommandHelp('logdebug', (), 'system', 'Temporarily set the loglevel to debug.'),
+            CommandHelp('loginfo', (), 'system', 'Temporarily (re)set the loglevel to info.'),
+            CommandHelp('reload', (), 'system',
+                        'Reload a plugin without restarting the bot.'),
+            CommandHelp('help', ('?',), 'system',
+                        'Give moral and spiritual guidance in using this bot.'),
+            )),
+    'users_plugin': PluginSpec(
+        commands=('mynicks', 'lsnicks', 'user', 'whois', 'addnick', 'newnick',
+                  'rmnick', 'delnick', 'gns', 'register', 'isadmin'),
+        rpc=('identitystats', 'identityreload'),
+        events=(),
+        help=(
+            CommandHelp('mynicks', ('lsnicks',), 'users', "List all your nicks and their id's."),
+            CommandHelp('user', ('whois',), 'users', 'List all nicks of another user.'),
+            CommandHelp('addnick', ('newnick',), 'users', 'Add a new nick to yourself.'),
+            CommandHelp('rmnick', ('delnick',), 'users', 'Remove one of your nicks.'),
+            CommandHelp('isadmin', (), 'users', 'Check whether the sender has admin rights.'),
+            )),
+    'wolframalpha_plugin': PluginSpec(
+        commands=('calc', 'calculate', 'bereken'),
+        rpc=('wolframstats',),
+        events=(),
+        help=(
+            CommandHelp('calc', ('calculate', 'bereken'), None,
+                        '(Attempt to) answer query using the WolframAlpha API.'),
+            )),
+    }
@@ -10,95 +10,247 @@ last message is equal to or greather than their timeout, a copy of the
 message is CC'd directly to the user.
 This is useful for 'productive' chats with many messages.
 '''
-import re
 import datetime
 import operator
+import threading
 
 from yowsup.layers.protocol_messages.protocolentities import TextMessageProtocolEntity
 
+from tombot.ahocorasick import Automaton
 from tombot.helper_functions import determine_sender, extract_query
-from tombot.registry import Command, Subscribe, get_easy_logger, BOT_MSG_RECEIVE
-from .users_plugin import jid_to_nick, nick_to_jid, nick_to_id, isadmin
+from tombot.registry import Command, Subscribe, get_easy_logger
+from tombot.registry import BOT_MSG_RECEIVE, BOT_START, BOT_SHUTDOWN
+from tombot.view import MessageView
+from . import users_plugin
 
 
 LOGGER = get_easy_logger('plugins.users.mentions')
-MENTION_PATTERN = r'(?<!\w)@\s?([^ .:,]+)[ .:,]?'
-MENTION_REGEX = re.compile(MENTION_PATTERN, re.IGNORECASE)
+MENTION_MARK = '@'
+NICK_TERMINATORS = ' .:,'
 
-@Subscribe(BOT_MSG_RECEIVE)
+class MentionEngine(object):
+    '''
+    Finds all @mentions of known nicks in a message in a single scan.
+
+    A mention is '@nick' or '@ nick', where the @ does not follow a word
+    character and the nick ends the message or is followed by one of
+    NICK_TERMINATORS. The automaton is rebuilt when the identity cache changes.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = None
+        self.version = None
+        self.automaton = None
+
+    def _current(self, bot):
+        ''' Return an automaton matching the current nick table. '''
+        cache = users_plugin.CACHE
+        cache.ensure_loaded(bot)
+        with self.lock:
+            # A reload of users_plugin replaces the cache
+            if self.cache is not cache or self.version != cache.version:
+                self.version, table = cache.nick_table()
+                self.cache = cache
+                self.automaton = Automaton(table)
+                LOGGER.debug('Mention automaton rebuilt for %s nicks.', len(table))
+            return self.automaton
+
+    def find(self, bot, body):
+        ''' Return the jids mentioned in body, in order and without duplicates. '''
+        if MENTION_MARK not in body:
+            return []
+        text = body.lower()
+        length = len(text)
+        result = []
+        for start, end, dummy, jid in self._current(bot).finditer(text):
+            if end < length and text[end] not in NICK_TERMINATORS:
+                continue
+            mark = start - 1
+            if mark >= 0 and text[mark].isspace():
+                mark -= 1
+            if mark < 0 or text[mark] != MENTION_MARK:
+                continue
+            if mark > 0 and (text[mark - 1].isalnum() or text[mark - 1] == '_'):
+                continue
+            if jid not in result:
+                result.append(jid)
+        return result
+
+MENTIONS = MentionEngine()
+
+class LastSeenBuffer(object):
+    '''
+    Keeps users' last seen time and message in memory, written to the database in batches.
+
+    Every message updates the buffer; the pending updates are written in one
+    transaction every flush_interval seconds, as soon as flush_batch users are
+    pending, and at shutdown. Lookups are answered from memory, so unflushed
+    updates are visible to the mention timeout check.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # keeps flushes in order
+        self.lastactive = {}    # jid -> last seen time, flushed or not
+        self.pending = {}       # jid -> (lastactive, message), not yet written
+        self.flush_interval = 30
+        self.flush_batch = 50
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self, bot):
+        ''' Read the current last seen times from the database. '''
+        rows = bot.db.fetchall('SELECT jid, lastactive FROM users')
+        with self.lock:
+            self.lastactive.update(rows)
+
+    def start(self, bot, flush_interval=None, flush_batch=None):
+        '''
+        Load the last seen times and start the periodic flusher.
+
+        Does nothing but update the settings if the flusher is already running.
+        '''
+        if flush_interval:
+            self.flush_interval = flush_interval
+        if flush_batch:
+            self.flush_batch = flush_batch
+        if self._thread is not None and self._thread.is_alive() \
+                and not self._stopped.is_set():
+            return
+        self.load(bot)
+        self._stopped = threading.Event()   # a stopping flusher keeps the old one
+        self._thread = threading.Thread(
+            target=self._flush_periodically, args=(bot,), name='lastseen-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, bot):
+        ''' Stop the flusher and write everything that is pending. '''
+        self._stopped.set()
+        self.flush(bot)
+
+    def update(self, bot, jid, lastactive, body):
+        ''' Record that jid said body at lastactive, flushing if the batch is full. '''
+        with self.lock:
+            self.lastactive[jid] = lastactive
+            self.pending[jid] = (lastactive, body)
+            full = len(self.pending) >= self.flush_batch
+        if full:
+            self.flush(bot)
+
+    def get(self, jid):
+        ''' Return the last seen time of jid, 0 if never seen. '''
+        with self.lock:
+            return self.lastactive.get(jid) or 0
+
+    def get_many(self, jids):
+        ''' Return {jid: last seen time} for all jids, 0 if never seen. '''
+        with self.lock:
+            return {jid: self.lastactive.get(jid) or 0 for jid in jids}
+
+    def flush(self, bot):
+        '''
+        Write all pending updates in a single transaction.
+
+        If writing fails the updates are pending again, unless newer ones
+        for the same user arrived meanwhile.
+        '''
+        with self.write_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                pending, self.pending = self.pending, {}
+            LOGGER.debug('Flushing last seen for %s users.', len(pending))
+            try:
+                bot.db.writemany(
+                    'UPDATE users SET lastactive = ?, message = ? WHERE jid = ?',
+                    [(time, body, jid) for jid, (time, body) in pending.iteritems()])
+            except:
+                with self.lock:
+                    for jid, update in pending.iteritems():
+                        newer = self.pending.get(jid)
+                        if newer is None or newer[0] < update[0]:
+                            self.pending[jid] = update
+                raise
+
+    def _flush_periodically(self, bot):
+        ''' Flusher thread main loop. '''
+        stopped = self._stopped
+        while not stopped.wait(self.flush_interval):
+            try:
+                self.flush(bot)
+            except Exception as ex: #pylint: disable=broad-except
+                LOGGER.error('Flushing last seen failed: %s', ex)
+
+LASTSEEN = LastSeenBuffer()
+
+@Subscribe(BOT_MSG_RECEIVE, background=True)
 def mention_handler_cb(bot, message, *args, **kwargs):
     '''
     Scans message text for @mentions and notifies user if appropriate.
     '''
-    mentioned_sent = []
-    for nick in MENTION_REGEX.findall(message.getBody()):
-        LOGGER.debug('Nick detected: %s', nick)
-
-        # Who sent the message?
-        senderjid = determine_sender(message)
-        LOGGER.debug('Resolving sender %s', senderjid)
-        try:
-            sendername = jid_to_nick(bot, senderjid)
-            LOGGER.debug('Sendernick %s', sendername)
-        except KeyError:
-            sendername = senderjid
-            LOGGER.debug('Could not find jid %s', senderjid)
-
-        # Who was mentioned?
-        try:
-            targetjid = nick_to_jid(bot, nick)
-            LOGGER.debug('Targetjid %s', targetjid)
-        except KeyError as ex:
-            # Some nick that is unknown, pass
-            LOGGER.debug('Could not resolve nick %s', nick)
-            LOGGER.debug('Exception %s', ex)
-            continue
+    view = kwargs.get('view') or MessageView(message)
+    body = view.body
+    targets = MENTIONS.find(bot, body)
+    if not targets:
+        return
+    LOGGER.debug('Mentioned jids: %s', targets)
 
-        if targetjid not in mentioned_sent:
-            # Check timeout
-            t_info = get_jid_timeout(bot, targetjid)
-            currenttime = (datetime.datetime.now() - datetime.datetime(
-                1970, 1, 1)).total_seconds()
-            if currenttime < (t_info[1] + t_info[0]) and message.participant:
-                # Do not send DM if recipient has not timed out yet
-                continue
+    senderjid = view.sender
+    sendername, timeouts = users_plugin.CACHE.lookup_mentions(senderjid, targets)
+    lastactive = LASTSEEN.get_many(targets)
+    currenttime = (datetime.datetime.now() - datetime.datetime(
+        1970, 1, 1)).total_seconds()
 
-            # Send mention notification: [author]: [body]
-            entity = TextMessageProtocolEntity('{}: {}'.format(
-                sendername, message.getBody()), to=targetjid)
-            bot.toLower(entity)
-            LOGGER.debug('Sent mention with content %s to %s', message.getBody(), targetjid)
-            mentioned_sent.append(targetjid)
-        else:
-            LOGGER.debug('Detected duplicate nick %s, skipping.', targetjid)
+    for targetjid in targets:
+        if currenttime < (timeouts[targetjid] + lastactive[targetjid]) and view.is_group:
+            # Do not send DM if recipient has not timed out yet
+            continue
+
+        # Send mention notification: [author]: [body]
+        entity = TextMessageProtocolEntity('{}: {}'.format(
+            sendername, body), to=targetjid)
+        bot.toLower(entity)
+        LOGGER.debug('Sent mention with content %s to %s', body, targetjid)
 
 @Subscribe(BOT_MSG_RECEIVE)
 def update_lastseen_cb(bot, message, *args, **kwargs):
-    ''' Updates the user's last seen time in the database. '''
-    author = determine_sender(message)
+    '''
+    Updates the user's last seen time, written to the database in batches.
+
+    Not a background handler: it only writes to memory, and a mention must
+    never be checked against a last seen time older than its message.
+    '''
+    view = kwargs.get('view') or MessageView(message)
     currenttime = (datetime.datetime.now() - datetime.datetime(1970, 1, 1)).total_seconds()
-    LOGGER.debug('Updating %s\'s last seen.', author)
-    bot.cursor.execute('UPDATE users SET lastactive = ?, message = ? WHERE jid = ?',
-                       (currenttime, message.getBody().decode('utf-8'), author))
-    bot.conn.commit()
+    LOGGER.debug('Updating %s\'s last seen.', view.sender)
+    LASTSEEN.update(bot, view.sender, currenttime, view.text)
+
+@Subscribe(BOT_START)
+def start_lastseen_cb(bot, *args, **kwargs):
+    ''' Load last seen times and start flushing them periodically. '''
+    conf = bot.config.get('Mentions', {})
+    LASTSEEN.start(bot, int(conf.get('flush_interval', 30)),
+                   int(conf.get('flush_batch', 50)))
+
+@Subscribe(BOT_SHUTDOWN)
+def stop_lastseen_cb(bot, *args, **kwargs):
+    ''' Write all pending last seen updates before exiting. '''
+    LASTSEEN.stop(bot)
 
 @Command(['timeout', 'settimeout'], 'mentions')
 def get_jid_timeout(self, jid):
     '''
     Retrieve a user's lastactive and timeout.
 
-    Returns a (timeout, lastactive) tuple.
+    Returns a (timeout, lastactive) tuple, includes last seen updates not yet written.
     Raises KeyError if jid not known.
     '''
-    self.cursor.execute(
-        'SELECT timeout, lastactive FROM users WHERE jid = ?',
-        (jid,))
-    result = self.cursor.fetchone()
-
-    if result:
-        return result
-
-    raise KeyError('Unknown jid {}'.format(jid))
+    users_plugin.CACHE.ensure_loaded(self)
+    try:
+        timeout = users_plugin.CACHE.get_timeout(jid)
+    except KeyError:
+        raise KeyError('Unknown jid {}'.format(jid))
+    return (timeout or 0, LASTSEEN.get(jid))
 
 @Command(['timeout', 'settimeout'], 'mentions')
 def set_own_timeout_cb(bot, message, *args, **kwargs):
@@ -108,12 +260,14 @@ def set_own_timeout_cb(bot, message, *args, **kwargs):
     Your timeout is the amount of time (in seconds) that has to elapse before you receive @mentions.
     A value of 0 means you receive all mentions.
     '''
+    view = kwargs.get('view') or message
     try:
-        cmd = extract_query(message)
+        cmd = extract_query(view)
         timeout = int(cmd)
-        bot.cursor.execute('UPDATE users SET timeout = ? WHERE jid = ?',
-                           (timeout, determine_sender(message)))
-        bot.conn.commit()
+        sender = determine_sender(view)
+        bot.db.write('UPDATE users SET timeout = ? WHERE jid = ?',
+                     (timeout, sender))
+        users_plugin.CACHE.set_timeout(timeout, jid=sender)
         return 'Ok'
     except ValueError:
         LOGGER.error('Timeout set failure: %s', cmd)
@@ -127,10 +281,11 @@ def set_other_timeout_cb(bot, message, *args, **kwargs):
 
     Specify user by id or nick.
     '''
-    if not isadmin(bot, message):
+    view = kwargs.get('view') or message
+    if not users_plugin.isadmin(bot, view):
         return
     try:
-        cmd = extract_query(message)
+        cmd = extract_query(view)
         cmdl = cmd.split()
 
         is_id = operator.methodcaller('isdigit')
@@ -138,13 +293,13 @@ def set_other_timeout_cb(bot, message, *args, **kwargs):
             id_ = int(cmdl[0])
         else:
             try:
-                id_ = nick_to_id(bot, cmdl[0])
+                id_ = users_plugin.nick_to_id(bot, cmdl[0])
             except KeyError:
                 return 'Unknown nick.'
         timeout = int(cmdl[1])
-        bot.cursor.execute('UPDATE users SET timeout = ? WHERE id = ?',
-                           (timeout, id_))
-        bot.conn.commit()
+        bot.db.write('UPDATE users SET timeout = ? WHERE id = ?',
+                     (timeout, id_))
+        users_plugin.CACHE.set_timeout(timeout, id_=id_)
         return 'Timeout for user {} updated to {}'.format(id_, timeout)
     except ValueError:
         return 'IT BROKE'
@@ -3,14 +3,28 @@ Provides commands to globally modify the bot's behaviour.
 '''
 import logging
 import pydoc
-from .users_plugin import isadmin
-from tombot.registry import get_easy_logger, Command, Subscribe, BOT_START
-from tombot.registry import COMMAND_DICT, COMMAND_CATEGORIES
-from tombot.helper_functions import determine_sender, extract_query, reply_directly
+import threading
+from collections import namedtuple
+from . import LOADER, LazyCommand, plugin_name
+from .manifest import MANIFEST
+from . import users_plugin
+from tombot.registry import get_easy_logger, Command, RPCCommand
+from tombot.registry import COMMAND_DICT, COMMAND_CATEGORIES, registry_version
+from tombot.helper_functions import extract_query, reply_directly
+from tombot.view import MessageView
 
 
 LOGGER = get_easy_logger('plugins.system')
-HELP_OVERVIEW = ''
+DEFAULT_CATEGORY = 'other'
+
+# version: registry_version() the index was built from
+# overview: text listing the categories and their commands
+# categories: category -> text with a one-line description per command
+# commands: upper case command name or alias -> long help text
+# unloaded: upper case command name or alias -> stub of a plugin not imported yet
+HelpIndex = namedtuple('HelpIndex', 'version overview categories commands unloaded')
+HELP_INDEX = None
+HELP_LOCK = threading.Lock()
 
 @Command('ping', 'system')
 def ping_cb(bot=None, message=None, *args, **kwargs):
@@ -20,28 +34,27 @@ def ping_cb(bot=None, message=None, *args, **kwargs):
 @Command('forcelog', 'system', hidden=True)
 def forcelog_cb(bot, message, *args, **kwargs):
     ''' Write a message to the root logger. '''
-    logging.info('Forcelog from %s: %s', message.getFrom(), message.getBody())
+    view = kwargs.get('view') or MessageView(message)
+    logging.info('Forcelog from %s: %s', view.chat, view.body)
     return
 
 @Command(['shutdown', 'halt'], 'system')
 def shutdown_cb(bot, message, *args, **kwargs):
     ''' Shut down the bot. '''
-    LOGGER.info('Stop message received from %s, content "%s"',
-                message.getFrom(), message.getBody())
-    if not isadmin(bot, message):
-        LOGGER.warning('Unauthorized shutdown attempt from %s',
-                       determine_sender(message))
+    view = kwargs.get('view') or MessageView(message)
+    LOGGER.info('Stop message received from %s, content "%s"', view.chat, view.body)
+    if not users_plugin.isadmin(bot, view):
+        LOGGER.warning('Unauthorized shutdown attempt from %s', view.sender)
         return 'Not authorized.'
     bot.stop()
 
 @Command('restart', 'system')
 def restart_cb(bot, message, *args, **kwargs):
     ''' Restart the bot. '''
-    LOGGER.info('Restart message received from %s, content "%s"',
-                message.getFrom(), message.getBody())
-    if not isadmin(bot, message):
-        LOGGER.warning('Unauthorized shutdown attempt from %s',
-                       determine_sender(message))
+    view = kwargs.get('view') or MessageView(message)
+    LOGGER.info('Restart message received from %s, content "%s"', view.chat, view.body)
+    if not users_plugin.isadmin(bot, view):
+        LOGGER.warning('Unauthorized shutdown attempt from %s', view.sender)
         return 'Not authorized.'
     bot.stop(True)
 
@@ -49,7 +62,7 @@ def restart_cb(bot, message, *args, **kwargs):
 def logdebug_cb(bot, message=None, *args, **kwargs):
     ''' Temporarily set the loglevel to debug. '''
     if message:
-        if not isadmin(bot, message):
+        if not users_plugin.isadmin(bot, kwargs.get('view') or message):
             return 'Not authorized.'
     logging.getLogger().setLevel(logging.DEBUG)
     return 'Ok.'
@@ -58,25 +71,104 @@ def logdebug_cb(bot, message=None, *args, **kwargs):
 def loginfo_cb(bot, message=None, *args, **kwargs):
     ''' Temporarily (re)set the loglevel to info. '''
     if message:
-        if not isadmin(bot, message):
+        if not users_plugin.isadmin(bot, kwargs.get('view') or message):
             return 'Not authorized.'
     logging.getLogger().setLevel(logging.INFO)
     return 'Ok.'
 
-@Subscribe(BOT_START)
-def build_help_cb(bot, *args, **kwargs):
+def reload_plugin(name):
+    ''' Reload the named plugin, return a message describing the result. '''
+    plugin = plugin_name(name)
+    if plugin not in LOADER.enabled():
+        return 'Unknown or disabled plugin: {}'.format(plugin)
+    if LOADER.reload(plugin):
+        return 'Reloaded {}.'.format(plugin)
+    return 'Reloading {} failed, see the log.'.format(plugin)
+
+@Command('reload', 'system')
+def reload_cb(bot, message, *args, **kwargs):
     '''
-    Build the help overview so it can be cached and poked at from shell.
+    Reload a plugin without restarting the bot.
+
+    Usage: reload <plugin>, e.g. 'reload fortune'.
+    '''
+    view = kwargs.get('view') or MessageView(message)
+    LOGGER.info('Reload message received from %s, content "%s"', view.chat, view.body)
+    if not users_plugin.isadmin(bot, view):
+        LOGGER.warning('Unauthorized reload attempt from %s', view.sender)
+        return 'Not authorized.'
+    query = extract_query(view)
+    if not query:
+        return 'Usage: reload <plugin>'
+    return reload_plugin(query)
+
+@RPCCommand('reload')
+def reload_rpc(handler, name=None, *args):
+    ''' Reload the named plugin. '''
+    if not name:
+        return None
+    return reload_plugin(name)
+
+def build_help_index():
+    '''
+    Build the help index from COMMAND_CATEGORIES and the manifest.
+
+    Commands of plugins that are not imported yet are listed with the
+    summary from the manifest. Hidden commands and entries that were
+    overridden by a later registration of the same name are left out.
     '''
-    global HELP_OVERVIEW
-    HELP_OVERVIEW += 'Available commands:\n'
-    for category in sorted(COMMAND_CATEGORIES):
-        if category:
-            HELP_OVERVIEW += '- {}:\n'.format(category)
-        for command in sorted(COMMAND_CATEGORIES[category]):
-            HELP_OVERVIEW += '{}: {}\n'.format(
-                command[0], pydoc.splitdoc(command[2].__doc__)[0])
+    # category -> [(name, aliases, summary, long help or None)]
+    listed = {}
+    unloaded = {}
+    for category, entries in COMMAND_CATEGORIES.items():
+        for entry in entries:
+            if entry.hidden or COMMAND_DICT.get(entry.name.upper()) is not entry.func:
+                continue
+            doc = pydoc.getdoc(entry.func)
+            listed.setdefault(category, []).append(
+                (entry.name, entry.aliases, pydoc.splitdoc(doc)[0], doc))
+    for plugin, spec in MANIFEST.items():
+        for entry in spec.help:
+            stub = COMMAND_DICT.get(entry.name.upper())
+            if not isinstance(stub, LazyCommand) or stub.plugin != plugin:
+                continue
+            listed.setdefault(entry.category, []).append(
+                (entry.name, entry.aliases, entry.summary, None))
+            for alias in (entry.name,) + entry.aliases:
+                unloaded[alias.upper()] = stub
+    overview = ['Available commands:']
+    categories = {}
+    commands = {}
+    for category in sorted(listed, key=lambda x: x or DEFAULT_CATEGORY):
+        entries = sorted(listed[category])
+        name = category or DEFAULT_CATEGORY
+        overview.append('- {}: {}'.format(
+            name, ', '.join(entry[0] for entry in entries)))
+        page = ['Commands in {}:'.format(name)]
+        for command, aliases, summary, longhelp in entries:
+            if aliases:
+                page.append('{} ({}): {}'.format(command, ', '.join(aliases), summary))
+            else:
+                page.append('{}: {}'.format(command, summary))
+            if longhelp is None:
+                continue
+            if aliases:
+                longhelp = '{}\nAlso known as: {}'.format(longhelp, ', '.join(aliases))
+            for alias in (command,) + aliases:
+                commands[alias.upper()] = longhelp
+        categories[name.upper()] = '\n'.join(page)
+    overview.append("Send 'help <category>' or 'help <command>' for more.")
+    return HelpIndex(registry_version(), '\n'.join(overview), categories, commands,
+                     unloaded)
 
+def get_help_index():
+    ''' Return the help index, rebuilt only if commands were (un)registered since. '''
+    global HELP_INDEX
+    with HELP_LOCK:
+        if HELP_INDEX is None or HELP_INDEX.version != registry_version():
+            HELP_INDEX = build_help_index()
+            LOGGER.debug('Help index built: %s commands.', len(HELP_INDEX.commands))
+        return HELP_INDEX
 
 @Command(['help', '?'], 'system')
 @reply_directly
@@ -84,13 +176,23 @@ def help_cb(bot, message, *args, **kwargs):
     '''
     Give moral and spiritual guidance in using this bot.
 
-    When you select one command, a longer text will be sent!
+    Without arguments, all categories are listed. Ask for a command to get
+    its full description, or for a category to see its commands.
     '''
-    cmd = extract_query(message)
+    cmd = extract_query(kwargs.get('view') or message).upper()
+    index = get_help_index()
+    if cmd in index.unloaded:
+        # Only the plugin itself has the full description
+        stub = index.unloaded[cmd]
+        stub.loader.load(stub.plugin)
+        index = get_help_index()
     if not cmd:
-        return HELP_OVERVIEW
-    else:
-        try:
-            return pydoc.getdoc(COMMAND_DICT[cmd.upper()])
-        except KeyError:
-            return 'Sorry, that command is not known.'
+        return index.overview
+    command = index.commands.get(cmd)
+    category = index.categories.get(cmd)
+    if command and category:
+        # e.g. 'fortune' is both, show the command and then its category
+        return '{}\n\n{}'.format(command, category)
+    if command or category:
+        return command or category
+    return 'Sorry, that command is not known.'
@@ -4,13 +4,205 @@ Provides user and nickname management.
 import datetime
 import sqlite3
 import operator
+import threading
 from tombot.helper_functions import determine_sender, extract_query, reply_directly
-from tombot.registry import Command, get_easy_logger
+from tombot.registry import Command, RPCCommand, Subscribe, get_easy_logger, BOT_START
 
 
 LOGGER = get_easy_logger('plugins.users')
 IS_ID = operator.methodcaller('isdigit')
 
+class IdentityCache(object):
+    '''
+    In-memory copy of the users and nicks tables, used for all lookups.
+
+    Loaded from the database at BOT_START and kept current by the commands
+    that modify those tables, so resolving nicks does not touch the disk.
+    Nicks are stored lowercased, as the old LIKE queries were case-insensitive.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.version = 0        # incremented on every change to the nick maps
+        self.hits = 0
+        self.misses = 0
+        self.primary_nicks = {} # lowercased primary_nick -> jid
+        self.nicks = {}         # lowercased nick -> jid
+        self.names = {}         # jid -> primary_nick (may be None)
+        self.admins = {}        # jid -> admin flag
+        self.timeouts = {}      # jid -> mention timeout in seconds
+        self.ids = {}           # jid -> user id
+        self.jids = {}          # user id -> jid
+
+    def load(self, bot):
+        ''' (Re)load everything from the database. '''
+        users = bot.db.fetchall(
+            'SELECT id,jid,primary_nick,admin,timeout FROM users')
+        nicks = bot.db.fetchall('SELECT name,jid FROM nicks')
+        with self.lock:
+            self.primary_nicks.clear()
+            self.nicks.clear()
+            self.names.clear()
+            self.admins.clear()
+            self.timeouts.clear()
+            self.ids.clear()
+            self.jids.clear()
+            for id_, jid, primary_nick, admin, timeout in users:
+                self._store_user(id_, jid, primary_nick, admin, timeout)
+            for name, jid in nicks:
+                self.nicks[name.lower()] = jid
+            self.loaded = True
+            self.version += 1
+        LOGGER.info('Identity cache loaded: %s users, %s nicks.',
+                    len(users), len(nicks))
+
+    def ensure_loaded(self, bot):
+        ''' Load the cache if this has not happened yet. '''
+        if not self.loaded:
+            self.load(bot)
+
+    def _store_user(self, id_, jid, primary_nick, admin, timeout):
+        ''' Add or replace one row of the users table, lock must be held. '''
+        self.ids[jid] = id_
+        self.jids[id_] = jid
+        self.names[jid] = primary_nick
+        self.admins[jid] = admin == 1
+        self.timeouts[jid] = timeout
+        if primary_nick:
+            self.primary_nicks[primary_nick.lower()] = jid
+
+    def _count(self, found):
+        ''' Update the hit/miss counters. '''
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    # Lookups
+    def nick_to_jid(self, name):
+        ''' Resolve a (nick)name, primary nicks first. Returns None if unknown. '''
+        key = name.lower()
+        with self.lock:
+            jid = self.primary_nicks.get(key) or self.nicks.get(key)
+            self._count(jid is not None)
+        return jid
+
+    def jid_to_nick(self, jid):
+        ''' Return the primary nick of jid, raises KeyError if unknown. '''
+        with self.lock:
+            found = jid in self.names
+            self._count(found)
+            return self.names[jid]
+
+    def jid_to_id(self, jid):
+        ''' Return the user id of jid, raises KeyError if unknown. '''
+        with self.lock:
+            found = jid in self.ids
+            self._count(found)
+            return self.ids[jid]
+
+    def is_admin(self, jid):
+        ''' Return the admin flag of jid, False if unknown. '''
+        with self.lock:
+            self._count(jid in self.admins)
+            return self.admins.get(jid, False)
+
+    def get_timeout(self, jid):
+        ''' Return the mention timeout of jid, raises KeyError if unknown. '''
+        with self.lock:
+            self._count(jid in self.timeouts)
+            return self.timeouts[jid]
+
+    def nick_table(self):
+        '''
+        Return (version, {lowercased nick: jid}) for all nicks and primary nicks.
+
+        Primary nicks take precedence, like in nick_to_jid.
+        '''
+        with self.lock:
+            table = dict(self.nicks)
+            table.update(self.primary_nicks)
+            return self.version, table
+
+    def lookup_mentions(self, sender, targets):
+        '''
+        Resolve everything a mention notification needs in one go.
+
+        Returns (sender name, {target jid: timeout}); the sender name falls
+        back to the jid, unknown timeouts to 0.
+        '''
+        with self.lock:
+            sendername = self.names.get(sender) or sender
+            timeouts = {jid: self.timeouts.get(jid) or 0 for jid in targets}
+            self._count(sender in self.names)
+            return sendername, timeouts
+
+    # Write-through updates
+    def add_user(self, id_, jid, primary_nick=None, admin=False, timeout=None):
+        ''' Record a new row in the users table. '''
+        with self.lock:
+            self._store_user(id_, jid, primary_nick, admin, timeout)
+            self.version += 1
+
+    def add_nick(self, name, jid):
+        ''' Record a new row in the nicks table. '''
+        with self.lock:
+            self.nicks[name.lower()] = jid
+            self.version += 1
+
+    def remove_nick(self, name):
+        ''' Forget a nick removed from the nicks table. '''
+        with self.lock:
+            self.nicks.pop(name.lower(), None)
+            self.version += 1
+
+    def set_primary_nick(self, id_, name):
+        ''' Record a changed primary_nick for user id_. '''
+        with self.lock:
+            jid = self.jids.get(id_)
+            if jid is None:
+                return
+            old = self.names.get(jid)
+            if old and self.primary_nicks.get(old.lower()) == jid:
+                del self.primary_nicks[old.lower()]
+            self.names[jid] = name
+            self.primary_nicks[name.lower()] = jid
+            self.version += 1
+
+    def set_timeout(self, timeout, jid=None, id_=None):
+        ''' Record a changed timeout, specify the user by jid or id. '''
+        with self.lock:
+            if jid is None:
+                jid = self.jids.get(id_)
+            if jid in self.timeouts:
+                self.timeouts[jid] = timeout
+
+    def stats(self):
+        ''' Return a one-line summary of size and hit rate. '''
+        with self.lock:
+            return 'users={} nicks={} hits={} misses={} version={}'.format(
+                len(self.ids), len(self.nicks), self.hits, self.misses,
+                self.version)
+
+CACHE = IdentityCache()
+
+@Subscribe(BOT_START)
+def load_identities_cb(bot, *args, **kwargs):
+    ''' Fill the identity cache from the database. '''
+    CACHE.load(bot)
+
+@RPCCommand('identitystats')
+def identity_stats_rpc(handler, *args):
+    ''' Report identity cache size and hit/miss counters. '''
+    return CACHE.stats()
+
+@RPCCommand('identityreload')
+def identity_reload_rpc(handler, *args):
+    ''' Reload the identity cache, after the database was edited by hand. '''
+    CACHE.load(handler.server.bot)
+    return 'Ok.'
+
 # User
 @Command(['mynicks', 'lsnicks'], 'users')
 @reply_directly
@@ -20,17 +212,16 @@ def list_own_nicks_cb(bot, message, *args, **kwargs):
 
     Nicks can be added using addnick, removed using rmnick.
     '''
-    sender = determine_sender(message)
-    bot.cursor.execute('SELECT id,primary_nick FROM users WHERE jid = ?',
-                       (sender,))
-    result = bot.cursor.fetchone()
+    view = kwargs.get('view') or message
+    sender = determine_sender(view)
+    result = bot.db.fetchone('SELECT id,primary_nick FROM users WHERE jid = ?',
+                             (sender,))
     if result is None:
         return 'Wie ben jij'
     userid = result[0]
     username = result[1]
-    bot.cursor.execute('SELECT id,name FROM nicks WHERE jid = ?',
-                       (sender,))
-    results = bot.cursor.fetchall()
+    results = bot.db.fetchall('SELECT id,name FROM nicks WHERE jid = ?',
+                              (sender,))
     if results is not None:
         reply = 'Nicknames for {} ({}/{}):'.format(username, sender, userid)
         for row in results:
@@ -48,27 +239,26 @@ def list_other_nicks_cb(bot, message, *args, **kwargs):
 
     Specify user by id or nick.
     '''
-    cmd = extract_query(message)
+    view = kwargs.get('view') or message
+    cmd = extract_query(view)
 
     if IS_ID(cmd):
-        bot.cursor.execute(
+        result = bot.db.fetchone(
             'SELECT id,jid,lastactive,primary_nick FROM users WHERE id = ?',
             (cmd,))
     else:
         try:
             userjid = nick_to_jid(bot, cmd)
-            bot.cursor.execute(
+            result = bot.db.fetchone(
                 'SELECT id,jid,lastactive,primary_nick FROM users WHERE jid = ?',
                 (userjid,))
         except KeyError:
             return 'Unknown (nick)name'
-    result = bot.cursor.fetchone()
     if not result:
         return 'Unknown ID' # nick resolution errors earlier
     reply = 'Nicks for {} ({}/{}):\n'.format(result[3], result[1], result[0])
-    bot.cursor.execute('SELECT name FROM nicks WHERE jid = ?',
-                       (result[1],))
-    results = bot.cursor.fetchall()
+    results = bot.db.fetchall('SELECT name FROM nicks WHERE jid = ?',
+                              (result[1],))
     for row in results:
         reply = reply + row[0] + ' '
     return reply
@@ -81,9 +271,10 @@ def add_own_nick_cb(bot, message, *args, **kwargs):
 
     Nicknames can be removed using 'rmnick'.
     '''
-    cmd = extract_query(message)
+    view = kwargs.get('view') or message
+    cmd = extract_query(view)
     cmdl = cmd.split()
-    sender = determine_sender(message)
+    sender = determine_sender(view)
     newnick = cmdl[0].lower()
     if len(newnick) > 16:
         return 'Too long'
@@ -91,9 +282,9 @@ def add_own_nick_cb(bot, message, *args, **kwargs):
         return 'Pls'
     try:
         LOGGER.info('Nick %s added to jid %s', newnick, sender)
-        bot.cursor.execute('INSERT INTO nicks (name, jid) VALUES (?,?)',
-                           (newnick, sender))
-        bot.conn.commit()
+        bot.db.write('INSERT INTO nicks (name, jid) VALUES (?,?)',
+                     (newnick, sender))
+        CACHE.add_nick(newnick, sender)
         return 'Ok.'
     except sqlite3.IntegrityError:
         return 'Nick exists'
@@ -106,21 +297,21 @@ def remove_own_nick_cb(bot, message, *args, **kwargs):
 
     Specify a nick by id (see mynicks) or the nick itself.
     '''
-    cmd = extract_query(message)
+    view = kwargs.get('view') or message
+    cmd = extract_query(view)
     if IS_ID(cmd):
-        bot.cursor.execute('SELECT id,name,jid FROM nicks WHERE id = ?',
-                           (cmd,))
+        result = bot.db.fetchone('SELECT id,name,jid FROM nicks WHERE id = ?',
+                                 (cmd,))
     else:
-        bot.cursor.execute('SELECT id,name,jid FROM nicks WHERE name = ?',
-                           (cmd,))
-    result = bot.cursor.fetchone()
+        result = bot.db.fetchone('SELECT id,name,jid FROM nicks WHERE name = ?',
+                                 (cmd,))
     if result is None:
         return 'Unknown nick'
-    if result[2] != determine_sender(message):
+    if result[2] != determine_sender(view):
         return 'That\'s not you'
-    bot.cursor.execute('DELETE FROM nicks WHERE id = ?',
-                       (result[0],))
-    bot.conn.commit()
+    bot.db.write('DELETE FROM nicks WHERE id = ?',
+                 (result[0],))
+    CACHE.remove_nick(result[1])
     LOGGER.info('Nick %s removed.', cmd)
     return 'Nick {} removed.'.format(cmd)
 
@@ -133,32 +324,33 @@ def collect_users_cb(bot, message=None, *args, **kwargs):
         LOGGER.warning('Groups have not been detected, aborting.')
         return
     for group in bot.known_groups:
-        for user in group.getParticipants().keys():
-            LOGGER.info('User: %s', user)
-            bot.cursor.execute('SELECT COUNT(*) FROM users WHERE jid = ?',
+        with bot.db.transaction() as cursor:
+            for user in group.getParticipants().keys():
+                LOGGER.info('User: %s', user)
+                cursor.execute('SELECT COUNT(*) FROM users WHERE jid = ?',
                                (user,))
-            result = bot.cursor.fetchone()[0]
-            if result == 0:
-                LOGGER.info('User not yet present in database, adding...')
-                currenttime = (datetime.datetime.now() -
-                               datetime.datetime(1970, 1, 1)).total_seconds()
-                default_timeout = 2 * 60 * 60 # 2 hours
-                bot.cursor.execute('''INSERT INTO USERS
-                    (jid, lastactive, timeout, admin) VALUES (?, ?, ?, ?)
-                ''', (user, currenttime, default_timeout, False))
-                LOGGER.info('User added.')
-            else:
-                LOGGER.info('User present.')
-        bot.conn.commit()
+                result = cursor.fetchone()[0]
+                if result == 0:
+                    LOGGER.info('User not yet present in database, adding...')
+                    currenttime = (datetime.datetime.now() -
+                                   datetime.datetime(1970, 1, 1)).total_seconds()
+                    default_timeout = 2 * 60 * 60 # 2 hours
+                    cursor.execute('''INSERT INTO USERS
+                        (jid, lastactive, timeout, admin) VALUES (?, ?, ?, ?)
+                    ''', (user, currenttime, default_timeout, False))
+                    CACHE.add_user(cursor.lastrowid, user,
+                                   timeout=default_timeout)
+                    LOGGER.info('User added.')
+                else:
+                    LOGGER.info('User present.')
 
 @Command('gns', 'users', hidden=True)
 def get_nameless_seen_cb(bot, message, *args, **kwargs):
     ''' List all jids which have been heard by the bot, but have no primary nick. '''
-    if not isadmin(bot, message):
+    if not isadmin(bot, kwargs.get('view') or message):
         return
-    bot.cursor.execute(
+    results = bot.db.fetchall(
         'SELECT id,message,jid FROM users WHERE primary_nick IS NULL AND message IS NOT NULL')
-    results = bot.cursor.fetchall()
     result = 'Non-registered but seen talking:\n'
     for user in results:
         result += '{} ({}): {}\n'.format(user[0], user[2], user[1])
@@ -167,17 +359,18 @@ def get_nameless_seen_cb(bot, message, *args, **kwargs):
 @Command('register', 'users', hidden=True)
 def register_user_cb(bot, message, *args, **kwargs):
     ''' Assign a primary nick to a user. '''
-    if not isadmin(bot, message):
+    view = kwargs.get('view') or message
+    if not isadmin(bot, view):
         return
-    cmd = extract_query(message)
+    cmd = extract_query(view)
     try:
         cmdl = cmd.split()
         id_ = int(cmdl[0])
         name = cmdl[1]
-        bot.cursor.execute('UPDATE users SET primary_nick = ? WHERE id = ?',
-                           (name, id_))
-        bot.conn.commit()
-        LOGGER.info(bot.cursor.rowcount)
+        cursor = bot.db.write('UPDATE users SET primary_nick = ? WHERE id = ?',
+                              (name, id_))
+        CACHE.set_primary_nick(id_, name)
+        LOGGER.info(cursor.rowcount)
         LOGGER.info('User %s registered as %s.', id_, name)
         return 'Ok'
     except IndexError as ex:
@@ -196,18 +389,11 @@ def nick_to_jid(bot, name):
 
     Raises KeyError if the name is unknown.
     '''
-    # Search authornames first
-    queries = [
-        'SELECT jid FROM users WHERE primary_nick LIKE ?',
-        'SELECT jid FROM nicks WHERE name LIKE ?',
-        ]
-    for query in queries:
-        bot.cursor.execute(query, (name,))
-        result = bot.cursor.fetchone()
-        if result:
-            return result[0]
-
-    raise KeyError('Unknown nick {}!'.format(name))
+    CACHE.ensure_loaded(bot)
+    jid = CACHE.nick_to_jid(name)
+    if jid is None:
+        raise KeyError('Unknown nick {}!'.format(name))
+    return jid
 
 def jid_to_nick(bot, jid):
     '''
@@ -215,13 +401,11 @@ def jid_to_nick(bot, jid):
 
     Raises KeyError if user not known.
     '''
-    query = 'SELECT primary_nick FROM users WHERE jid = ?'
-    bot.cursor.execute(query, (jid,))
-    result = bot.cursor.fetchone()
-    if result:
-        return result[0]
-
-    raise KeyError('Unknown jid {}'.format(jid))
+    CACHE.ensure_loaded(bot)
+    try:
+        return CACHE.jid_to_nick(jid)
+    except KeyError:
+        raise KeyError('Unknown jid {}'.format(jid))
 
 def nick_to_id(bot, nick):
     '''
@@ -230,20 +414,17 @@ def nick_to_id(bot, nick):
     Raises KeyError if id not known.
     '''
     jid = nick_to_jid(bot, nick)
-    query = 'SELECT id FROM users WHERE jid = ?'
-    bot.cursor.execute(query, (jid,))
-    result = bot.cursor.fetchone()
-    if result:
-        return result[0]
-
-    # This will never happen, nick_to_jid raises earlier.
-    raise KeyError('Unknown nick {}'.format(jid))
+    try:
+        return CACHE.jid_to_id(jid)
+    except KeyError:
+        # Only happens if a nick points to a jid without a users row.
+        raise KeyError('Unknown nick {}'.format(jid))
 
 # Authorization etc.
 @Command('isadmin', 'users')
 def isadmin_cb(bot, message, *args, **kwargs):
     ''' Check whether the sender has admin rights. '''
-    if isadmin(bot, message):
+    if isadmin(bot, kwargs.get('view') or message):
         return 'Yes!'
     return 'No'
 
@@ -252,7 +433,7 @@ def isadmin(bot, message):
     Determine whether or not a user can execute admin commands.
 
     A user can be marked as admin by either the database, or the config file.
-    Config file overrides database.
+    Config file overrides database. Accepts a message or its MessageView.
     '''
     sender = determine_sender(message)
     try:
@@ -260,11 +441,5 @@ def isadmin(bot, message):
             return True
     except KeyError:
         pass
-    bot.cursor.execute('SELECT admin FROM users WHERE jid = ?',
-                       (sender,))
-    result = bot.cursor.fetchone()
-    if result:
-        if result[0] == 1:
-            return True
-        return False
-    return False
+    CACHE.ensure_loaded(bot)
+    return CACHE.is_admin(sender)
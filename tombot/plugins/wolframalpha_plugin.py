@@ -1,38 +1,54 @@
 '''
 Provides a command for answering queries using the WolframAlpha API.
+
+Queries run on a small worker pool with a network timeout, so the command
+returns right away and the answer is sent when it arrives. Answers are
+cached for a while, keyed on the normalised query text.
 '''
 import os
 import urllib
+import urllib2
 
 import wolframalpha
 
+from tombot.cache import LRUCache
+from tombot.dispatcher import Dispatcher
 from tombot.helper_functions import extract_query
-from tombot.registry import Command, get_easy_logger, Subscribe, BOT_START
+from tombot.registry import Command, RPCCommand, get_easy_logger, Subscribe
+from tombot.registry import BOT_START, BOT_SHUTDOWN
 from yowsup.layers.protocol_chatstate.protocolentities \
     import OutgoingChatstateProtocolEntity, ChatstateProtocolEntity
+from yowsup.layers.protocol_messages.protocolentities \
+    import TextMessageProtocolEntity
 
 
 LOGGER = get_easy_logger('plugins.wolframalpha')
 CLIENT = None
+API_URL = 'https://api.wolframalpha.com/v2/query'
+QUERY_TIMEOUT = 15  # seconds, per network operation
+RESULT_CACHE = LRUCache(maxsize=256, ttl=6 * 60 * 60)
+WORKERS = Dispatcher(workers=2, queue_size=20, name='wolframalpha')
 
-@Command(['calc', 'calculate', 'bereken'])
-def wolfram_cb(bot, message, *args, **kwargs):
+def normalise(query):
+    ''' Return the cache key for a query: lowercased, whitespace collapsed. '''
+    return ' '.join(query.lower().split())
+
+def timed_query(query):
     '''
-    (Attempt to) answer query using the WolframAlpha API.
+    Do CLIENT.query(query), but give up if the network stalls.
 
-    Results may not be interpreted as you'd expect, open link for explanation.
+    wolframalpha.Client.query uses urlopen without a timeout.
     '''
-    if not CLIENT:
-        return _('Not connected to WolframAlpha!')
-    query = extract_query(message)
-    LOGGER.debug('Query to WolframAlpha: %s', query)
-    entity = OutgoingChatstateProtocolEntity(
-        ChatstateProtocolEntity.STATE_TYPING, message.getFrom())
-    bot.toLower(entity)
-    result = CLIENT.query(query)
-    entity = OutgoingChatstateProtocolEntity(
-        ChatstateProtocolEntity.STATE_PAUSED, message.getFrom())
-    bot.toLower(entity)
+    url = API_URL + '?' + urllib.urlencode(
+        dict(input=query, appid=CLIENT.app_id))
+    resp = urllib2.urlopen(url, timeout=QUERY_TIMEOUT)
+    try:
+        return wolframalpha.Result(resp)
+    finally:
+        resp.close()
+
+def format_result(query, result):
+    ''' Turn a query result into the reply text. '''
     restext = _('Result from WolframAlpha:\n')
     results = [p.text.encode('utf-8') for p in result.pods
                if p.title in ('Result', 'Value', 'Decimal approximation', 'Exact result')]
@@ -43,6 +59,53 @@ def wolfram_cb(bot, message, *args, **kwargs):
         urllib.quote(query).replace('%20', '+'))
     return restext
 
+def answer_query(bot, recipient, query):
+    ''' Look up query and send the answer to recipient, runs on a worker. '''
+    key = normalise(query)
+    restext = RESULT_CACHE.get(key)   # may have been answered while queued
+    if restext is None:
+        try:
+            restext = format_result(query, timed_query(query))
+            RESULT_CACHE.put(key, restext)
+        except IOError as ex: # includes socket timeouts and HTTP errors
+            LOGGER.error('WolframAlpha query %s failed: %s', query, ex)
+            restext = _('WolframAlpha did not answer in time.')
+        except Exception as ex: #pylint: disable=broad-except
+            LOGGER.error('WolframAlpha query %s failed: %s', query, ex)
+            restext = _('No result.')
+    bot.toLower(OutgoingChatstateProtocolEntity(
+        ChatstateProtocolEntity.STATE_PAUSED, recipient))
+    bot.toLower(TextMessageProtocolEntity(restext, to=recipient))
+
+@Command(['calc', 'calculate', 'bereken'])
+def wolfram_cb(bot, message, *args, **kwargs):
+    '''
+    (Attempt to) answer query using the WolframAlpha API.
+
+    Results may not be interpreted as you'd expect, open link for explanation.
+    '''
+    if not CLIENT:
+        return _('Not connected to WolframAlpha!')
+    query = extract_query(kwargs.get('view') or message)
+    LOGGER.debug('Query to WolframAlpha: %s', query)
+    cached = RESULT_CACHE.get(normalise(query))
+    if cached is not None:
+        return cached
+    recipient = message.getFrom()
+    bot.toLower(OutgoingChatstateProtocolEntity(
+        ChatstateProtocolEntity.STATE_TYPING, recipient))
+    if not WORKERS.submit(recipient, answer_query, bot, recipient, query):
+        bot.toLower(OutgoingChatstateProtocolEntity(
+            ChatstateProtocolEntity.STATE_PAUSED, recipient))
+        return _('Too many questions at once, try again later.')
+
+@RPCCommand('wolframstats')
+def wolfram_stats_rpc(handler, *args):
+    ''' Report WolframAlpha cache and worker statistics. '''
+    stats = RESULT_CACHE.stats()
+    stats.update(('queue_' + key, value) for key, value in WORKERS.stats().items())
+    return ' '.join('{}={}'.format(key, stats[key]) for key in sorted(stats))
+
 @Subscribe(BOT_START)
 def wolframinit_cb(bot, *args, **kwargs):
     '''
@@ -65,4 +128,10 @@ def wolframinit_cb(bot, *args, **kwargs):
                              if value != wolfram_cb}
             LOGGER.error('Wolfram command disabled.')
     CLIENT = wolframalpha.Client(apikey)
+    WORKERS.start()
     LOGGER.info('WolframAlpha command enabled.')
+
+@Subscribe(BOT_SHUTDOWN)
+def wolframstop_cb(bot, *args, **kwargs):
+    ''' Stop the query workers. '''
+    WORKERS.stop(wait=False)
@@ -2,9 +2,13 @@
 Contains generalized events and the command handlers.
 '''
 #pylint: disable=too-few-public-methods
+import itertools
 import logging
+import threading
+import time
 import types
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from .metrics import METRICS
 
 
 # Events
@@ -17,45 +21,255 @@ BOT_MSG_RECEIVE = 'tombot.layer.msg_receive'    # message received, (bot, messag
 BOT_CONNECTED = 'tombot.bot.connected'          # connection established, (bot)
 BOT_DISCONNECTED = 'tombot.bot.disconnected'    # connection lost, (bot)
 
-EVENT_HANDLERS = defaultdict(set)
+MAX_HANDLER_FAILURES = 3    # consecutive failures before a handler is unsubscribed
+
+class Subscription(object):
+    ''' One function subscribed to one event, with its call statistics. '''
+    __slots__ = ('func', 'eventname', 'priority', 'background', 'order', 'active',
+                 'calls', 'errors', 'failures', 'total_time', 'max_time', 'timer')
+
+    def __init__(self, func, eventname, priority, background, order):
+        self.func = func
+        self.eventname = eventname
+        self.priority = priority
+        self.background = background
+        self.order = order
+        self.active = True
+        self.calls = 0
+        self.errors = 0
+        self.failures = 0       # consecutive, reset by a successful call
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.timer = METRICS.histogram('event.' + self.name)
+
+    @property
+    def name(self):
+        ''' Return the full name of the handler. '''
+        return '{}.{}'.format(getattr(self.func, '__module__', None),
+                              getattr(self.func, '__name__', self.func))
+
+    def stats(self):
+        ''' Return a dict with the call statistics. '''
+        return {
+            'event': self.eventname,
+            'handler': self.name,
+            'priority': self.priority,
+            'background': self.background,
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_ms': self.total_time / self.calls * 1000 if self.calls else 0.0,
+            'max_ms': self.max_time * 1000,
+            }
+
+class EventBus(object):
+    '''
+    Delivers events to subscribed functions.
+
+    Handlers are called in order of descending priority, then in order of
+    subscription. Background handlers are queued on a worker pool (see
+    set_pool), the others run on the thread firing the event. Handlers may
+    subscribe and unsubscribe while an event is being delivered.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self._handlers = defaultdict(dict)  # eventname -> {func: Subscription}
+        self._ordered = {}                  # eventname -> sorted tuple of Subscriptions
+        self._counter = itertools.count()
+        self._held = None                   # predicate, see hold()
+        self._pending = []                  # held (eventname, func, priority, background)
+
+    def set_pool(self, pool):
+        '''
+        Run background handlers on pool, a started Dispatcher, or inline if None.
+        '''
+        self.pool = pool
+
+    def subscribe(self, eventname, func, priority=0, background=False):
+        ''' Subscribe func to an event, replacing an earlier subscription. '''
+        with self.lock:
+            if self._held is not None and self._held(func):
+                self._pending.append((eventname, func, priority, background))
+                return
+            self._subscribe(eventname, func, priority, background)
+
+    def _subscribe(self, eventname, func, priority, background):
+        ''' Subscribe func, lock must be held. '''
+        old = self._handlers[eventname].get(func)
+        if old is not None:
+            old.active = False
+        self._handlers[eventname][func] = Subscription(
+            func, eventname, priority, background, next(self._counter))
+        self._ordered.pop(eventname, None)
+
+    def hold(self, predicate):
+        '''
+        Keep new subscriptions of functions matching predicate back until release().
+
+        Used while importing a plugin, so its handlers appear all at once.
+        '''
+        with self.lock:
+            self._held = predicate
+            self._pending = []
+
+    def release(self, drop=None, discard=False):
+        '''
+        Subscribe the held functions, or forget them if discard is true.
+
+        Functions matching drop are unsubscribed at the same moment, so no
+        event is delivered to both them and the newly subscribed ones.
+        Returns the number of subscriptions made.
+        '''
+        with self.lock:
+            pending, self._pending, self._held = self._pending, [], None
+            if drop is not None:
+                for eventname, handlers in self._handlers.items():
+                    for func in [func for func in handlers if drop(func)]:
+                        handlers.pop(func).active = False
+                        self._ordered.pop(eventname, None)
+            if discard:
+                return 0
+            for eventname, func, priority, background in pending:
+                self._subscribe(eventname, func, priority, background)
+            return len(pending)
+
+    def unsubscribe(self, eventname, func):
+        ''' Unsubscribe func from an event, return False if it was not subscribed. '''
+        with self.lock:
+            sub = self._handlers[eventname].pop(func, None)
+            if sub is None:
+                return False
+            sub.active = False
+            self._ordered.pop(eventname, None)
+            return True
+
+    def unsubscribe_where(self, predicate):
+        ''' Unsubscribe all functions for which predicate(func) is true, return the count. '''
+        removed = 0
+        with self.lock:
+            for eventname, handlers in self._handlers.items():
+                for func in [func for func in handlers if predicate(func)]:
+                    handlers.pop(func).active = False
+                    self._ordered.pop(eventname, None)
+                    removed += 1
+        return removed
+
+    def subscribed_where(self, predicate):
+        ''' Return the subscriptions of all functions for which predicate(func) is true. '''
+        with self.lock:
+            return [sub for handlers in self._handlers.itervalues()
+                    for func, sub in handlers.iteritems() if predicate(func)]
+
+    def subscriptions(self, eventname):
+        ''' Return the subscriptions to an event in the order they are called. '''
+        ordered = self._ordered.get(eventname)
+        if ordered is None:
+            with self.lock:
+                ordered = tuple(sorted(self._handlers[eventname].itervalues(),
+                                       key=lambda sub: (-sub.priority, sub.order)))
+                self._ordered[eventname] = ordered
+        return ordered
+
+    def fire(self, eventname, *args, **kwargs):
+        ''' Deliver an event to all its subscribers. '''
+        self.deliver(eventname, args, kwargs)
+
+    def deliver(self, eventname, args, kwargs, module=None):
+        '''
+        Deliver an event, optionally only to handlers defined in module.
+        '''
+        pool = self.pool
+        for sub in self.subscriptions(eventname):
+            if module is not None and getattr(sub.func, '__module__', None) != module:
+                continue
+            if sub.background and pool is not None:
+                # Keyed by subscription: each handler sees events in order.
+                if not pool.submit(sub, self._call, sub, args, kwargs):
+                    LOGGER.warning('Event queue full, %s not called for %s.',
+                                   sub.func, eventname)
+                continue
+            self._call(sub, args, kwargs)
+
+    def _call(self, sub, args, kwargs):
+        ''' Call one handler, keep its statistics and disable it if it keeps failing. '''
+        if not sub.active:
+            return
+        began = time.time()
+        failed = False
+        try:
+            sub.func(*args, **kwargs)
+        except Exception as ex: #pylint: disable=broad-except
+            failed = True
+            sub.errors += 1
+            sub.failures += 1
+            LOGGER.exception('Event callback %s failed on event %s: %s',
+                             sub.func, sub.eventname, ex)
+            if sub.failures >= MAX_HANDLER_FAILURES:
+                LOGGER.critical('Event callback %s failed %s times in a row, disabled.',
+                                sub.func, sub.failures)
+                self.unsubscribe(sub.eventname, sub.func)
+        else:
+            sub.failures = 0
+        finally:
+            elapsed = time.time() - began
+            sub.calls += 1
+            sub.total_time += elapsed
+            if elapsed > sub.max_time:
+                sub.max_time = elapsed
+            sub.timer.observe(elapsed, error=failed)
+
+    def stats(self):
+        ''' Return a list of statistics dicts, one for every subscription. '''
+        with self.lock:
+            subs = [sub for handlers in self._handlers.values()
+                    for sub in handlers.values()]
+        return [sub.stats() for sub in sorted(
+            subs, key=lambda sub: (sub.eventname, -sub.priority, sub.order))]
+
+EVENTS = EventBus()
+
 class Subscribe(object):
     '''
     Subscribes the decorated function to an event. Function is not modified.
+
+    Handlers with a higher priority are called first. Background handlers
+    run on the event worker pool, so they do not delay the firing thread.
     '''
-    def __init__(self, eventname):
+    def __init__(self, eventname, priority=0, background=False):
         self.eventname = eventname
+        self.priority = priority
+        self.background = background
 
     def __call__(self, func):
-        if hasattr(self.eventname, '__iter__'):
-            if isinstance(self.eventname, types.StringTypes):
-                # String
-                EVENT_HANDLERS[self.eventname].add(func)
-                return func
-
-            # Iterable
-            for name in self.eventname:
-                EVENT_HANDLERS[name].add(func)
-            return func
-
-        # Something else
-        EVENT_HANDLERS[self.eventname].add(func)
+        if hasattr(self.eventname, '__iter__') and not isinstance(
+                self.eventname, types.StringTypes):
+            names = self.eventname
+        else:
+            names = [self.eventname]
+        for name in names:
+            EVENTS.subscribe(name, func, self.priority, self.background)
         return func
 
 def fire_event(eventname, *args, **kwargs):
     '''
     Call all subscribed functions with the given arguments.
 
-    Functions which throw exceptions are unregistered.
+    Functions which throw exceptions several times in a row are unregistered.
     '''
-    for func in EVENT_HANDLERS[eventname]:
-        try:
-            func(*args, **kwargs)
-        except Exception as ex: #pylint: disable=broad-except
-            LOGGER.critical('Event callback %s failed on event %s, disabled:', func, eventname)
-            LOGGER.critical(ex)
-            EVENT_HANDLERS[eventname].remove(func)
+    EVENTS.fire(eventname, *args, **kwargs)
 
 # Commands and RPC commands
+_VERSION = 0
+
+def registry_changed():
+    ''' Mark the command registries as changed, so tables built from them are rebuilt. '''
+    global _VERSION
+    _VERSION += 1
+
+def registry_version():
+    ''' Return a number that changes whenever a command is (un)registered. '''
+    return _VERSION
+
 class RegisteringDecorator(object):
     '''
     Generalized decorator for registering case-insensitive commands in a dict.
@@ -73,11 +287,14 @@ class RegisteringDecorator(object):
                 self.target_dict[item.upper()] = func
         else:
             self.target_dict[self.name.upper()] = func
+        registry_changed()
         LOGGER.debug('Registered %s', self.name)
         return func
 
+# name: primary name, aliases: tuple of other names, hidden: left out of help
+CommandEntry = namedtuple('CommandEntry', 'name aliases func hidden')
 COMMAND_DICT = {}
-COMMAND_CATEGORIES = defaultdict(list)
+COMMAND_CATEGORIES = defaultdict(list)  # category -> list of CommandEntry
 RPC_DICT = {}
 
 class RPCCommand(RegisteringDecorator):
@@ -96,9 +313,10 @@ class Command(RegisteringDecorator):
 
     def __call__(self, func):
         if isinstance(self.name, types.StringTypes):
-            self.help_dict[self.category].append((self.name, None, func))
+            entry = CommandEntry(self.name, (), func, self.hidden)
         else:
-            self.help_dict[self.category].append((self.name[0], self.name[1:], func))
+            entry = CommandEntry(self.name[0], tuple(self.name[1:]), func, self.hidden)
+        self.help_dict[self.category].append(entry)
         return super(Command, self).__call__(func)
 
 def safe_call(target_dict, key, *args, **kwargs):
@@ -111,6 +329,58 @@ def safe_call(target_dict, key, *args, **kwargs):
         del target_dict[key]
         LOGGER.critical('Command %s disabled: %s', key, ex)
 
+# commands, rpc: {key: func}, categories: [(category, CommandEntry)],
+# events: [(eventname, func, priority, background)]
+Registrations = namedtuple('Registrations', 'commands rpc categories events')
+
+def module_registrations(module):
+    ''' Return everything registered by functions defined in module. '''
+    def in_module(func):
+        ''' Check where func was defined. '''
+        return getattr(func, '__module__', None) == module
+
+    return Registrations(
+        {key: func for key, func in COMMAND_DICT.items() if in_module(func)},
+        {key: func for key, func in RPC_DICT.items() if in_module(func)},
+        [(category, entry) for category, entries in COMMAND_CATEGORIES.items()
+         for entry in entries if in_module(entry.func)],
+        [(sub.eventname, sub.func, sub.priority, sub.background)
+         for sub in EVENTS.subscribed_where(in_module)])
+
+def restore_registrations(saved):
+    ''' Register again what module_registrations() returned, e.g. after a failed reload. '''
+    COMMAND_DICT.update(saved.commands)
+    RPC_DICT.update(saved.rpc)
+    for category, entry in saved.categories:
+        COMMAND_CATEGORIES[category].append(entry)
+    for eventname, func, priority, background in saved.events:
+        EVENTS.subscribe(eventname, func, priority, background)
+    registry_changed()
+
+def unregister_module(module):
+    '''
+    Remove all commands, RPC commands and event handlers defined in a module.
+
+    Returns the number of removed entries.
+    '''
+    def in_module(func):
+        ''' Check where func was defined. '''
+        return getattr(func, '__module__', None) == module
+
+    removed = 0
+    for target_dict in (COMMAND_DICT, RPC_DICT):
+        for key, func in target_dict.items():
+            if in_module(func):
+                del target_dict[key]
+                removed += 1
+    for category, entries in COMMAND_CATEGORIES.items():
+        COMMAND_CATEGORIES[category] = [entry for entry in entries
+                                        if not in_module(entry.func)]
+    removed += EVENTS.unsubscribe_where(in_module)
+    registry_changed()
+    LOGGER.debug('Unregistered %s entries from %s', removed, module)
+    return removed
+
 # Helper functions
 def get_easy_logger(name, level=None):
     ''' Create a logger with the given name and optionally a level. '''
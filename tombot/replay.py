@@ -0,0 +1,308 @@
+'''
+Contains the replay harness, which feeds chat logs to the bot without a connection.
+
+The bot is built as usual, but below it there is no yowsup stack: entities
+sent down are counted instead of sent. Messages come from a log file or are
+generated, and the harness reports throughput and latencies, so changes to
+the layer, plugins or database can be compared on any machine.
+
+Chat logs have one JSON object per line, with the keys 'body', 'from' (the
+chat) and optionally 'participant' (the author, in groups).
+'''
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from configobj import ConfigObj
+from validate import Validator
+
+from .layer import TomBotLayer
+from .metrics import METRICS
+
+
+LOGGER = logging.getLogger('replay')
+
+SCHEMA = '''
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY,
+    jid TEXT UNIQUE,
+    lastactive REAL,
+    timeout INTEGER,
+    admin BOOLEAN,
+    primary_nick TEXT,
+    message TEXT,
+    bday DATE
+);
+CREATE TABLE nicks (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    jid TEXT
+);
+'''
+GROUP_JID = '31600000000-1400000000@g.us'
+
+# Message templates for synthetic logs, {nick} is replaced by a random nick
+PRIVATE_MESSAGES = (
+    'ping', 'roll 2d6+3', 'help', 'help system', 'mynicks', 'doekoe',
+    '8ball', 'remind me in 10 minutes to stretch', 'hoi, hoe gaat het?',
+    'user {nick}',
+    )
+GROUP_MESSAGES = (
+    'bot ping', 'tombot, roll 1d20', 'hey @{nick} kijk hier eens naar',
+    'gewoon een bericht zonder commando erin', '{nick}: lunch?',
+    'bot doekoe', 'bot remind me om 15:30 to call mom',
+    )
+
+class ReplayMessage(object):
+    ''' Stands in for a received yowsup text message entity. '''
+    # pylint: disable=invalid-name
+    def __init__(self, id_, chat, body, participant=None):
+        self.id = id_
+        self.chat = chat
+        self.body = body
+        self.participant = participant
+        self.timestamp = int(time.time())
+
+    def getId(self):
+        ''' Return the message id. '''
+        return self.id
+
+    def getFrom(self):
+        ''' Return the chat the message was sent in. '''
+        return self.chat
+
+    def getParticipant(self):
+        ''' Return the author in group chats, None in private chats. '''
+        return self.participant
+
+    def getBody(self):
+        ''' Return the text of the message. '''
+        return self.body
+
+    def getTimestamp(self):
+        ''' Return when the message was created. '''
+        return self.timestamp
+
+    @staticmethod
+    def getTag():
+        ''' Return the entity type. '''
+        return 'message'
+
+class ReplayLayer(TomBotLayer):
+    '''
+    The bot layer with the network replaced by counters.
+
+    Messages are fed with feed(); everything the bot sends is counted in
+    sent (per entity tag) and sent_bytes (message bodies).
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, config, scheduler):
+        self.sent = Counter()
+        self.sent_bytes = 0
+        self.latencies = []
+        self._submitted = {}
+        self._fed = 0
+        self._handled = 0
+        self._done = threading.Condition()
+        super(ReplayLayer, self).__init__(config, scheduler)
+        self.connected = True
+        self.outbox.set_connected(True)
+
+    def send_lower(self, entity):
+        ''' Count the entity instead of sending it. '''
+        tag = entity.getTag()
+        self.sent[tag] += 1
+        if tag == 'message':
+            self.sent_bytes += len(entity.getBody() or '')
+
+    def feed(self, message):
+        ''' Deliver a message as if it was received from the network. '''
+        with self._done:
+            self._submitted[message.getId()] = time.time()
+            self._fed += 1
+        self.onMessage(message)
+
+    def handle_message(self, message, view=None):
+        ''' Handle a message and record how long it took since it was fed. '''
+        try:
+            super(ReplayLayer, self).handle_message(message, view)
+        finally:
+            with self._done:
+                self.latencies.append(time.time() - self._submitted.pop(message.getId()))
+                self._handled += 1
+                self._done.notify_all()
+
+    def wait(self, timeout=None):
+        '''
+        Wait until all fed messages are handled and queues are empty.
+
+        Returns False if that took longer than timeout seconds.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._done:
+            while self._handled + self.dispatcher.dropped < self._fed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        while (self.event_pool.stats()['pending'] or self.outbox.stats()['depth']):
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        ''' Shut the bot down without exiting the process. '''
+        self.connected = False  # there is nothing below to disconnect
+        try:
+            self.stop()
+        except SystemExit:
+            pass
+
+def build_config(database, overrides=None):
+    ''' Return a validated config for a replay bot using the given database. '''
+    specpath = os.path.join(os.path.dirname(__file__), 'configspec.ini')
+    config = ConfigObj(configspec=specpath)
+    config.validate(Validator(), copy=True)
+    config['Yowsup']['database'] = database
+    config['Admins'] = {'31600000001': True}
+    config['Jids'] = {'announce-group': GROUP_JID}
+    config['RPC']['port'] = 0
+    config['Dispatcher']['overload'] = 'block'
+    config['Events']['queue'] = 1000000
+    # Measure the bot, not the rate limiter
+    config['Outbound'].update(
+        {'rate': 1e9, 'burst': 1000000, 'recipient_interval': 0.0})
+    config.merge(overrides or {})
+    return config
+
+def create_database(path, users):
+    ''' Create the tables and users user1 up to userN with matching nicks. '''
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    now = time.time()
+    for num in range(1, users + 1):
+        jid = user_jid(num)
+        conn.execute('INSERT INTO users (jid, lastactive, timeout, admin, primary_nick) '
+                     'VALUES (?, ?, ?, ?, ?)', (jid, now, 0, num == 1, 'user{}'.format(num)))
+        conn.execute('INSERT INTO nicks (name, jid) VALUES (?, ?)',
+                     ('user{}'.format(num), jid))
+    conn.commit()
+    conn.close()
+
+def user_jid(num):
+    ''' Return the jid of synthetic user num. '''
+    return '316{:08d}@s.whatsapp.net'.format(num)
+
+def synthetic_messages(count, users, seed=0):
+    ''' Generate count messages, about half of them in a group. '''
+    rng = random.Random(seed)
+    for num in range(count):
+        author = user_jid(rng.randint(1, users))
+        nick = 'user{}'.format(rng.randint(1, users))
+        if rng.random() < 0.5:
+            body = rng.choice(GROUP_MESSAGES).format(nick=nick)
+            yield ReplayMessage('replay-{}'.format(num), GROUP_JID, body, author)
+        else:
+            body = rng.choice(PRIVATE_MESSAGES).format(nick=nick)
+            yield ReplayMessage('replay-{}'.format(num), author, body)
+
+def logged_messages(path):
+    ''' Read messages from a chat log with one JSON object per line. '''
+    with open(path) as logfile:
+        for num, line in enumerate(logfile):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            participant = entry.get('participant')
+            yield ReplayMessage(
+                'replay-{}'.format(num), entry['from'].encode('utf-8'),
+                entry['body'].encode('utf-8'),
+                participant.encode('utf-8') if participant else None)
+
+def percentile(values, fraction):
+    ''' Return the value below which the given fraction of sorted values fall. '''
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def replay(messages, users=20, timeout=300.0, overrides=None):
+    '''
+    Run the messages through a fresh bot, return a report as a list of lines.
+    '''
+    workdir = tempfile.mkdtemp(prefix='tombot-replay-')
+    database = os.path.join(workdir, 'replay.db')
+    create_database(database, users)
+    scheduler = BackgroundScheduler()   # memory jobstore
+    bot = ReplayLayer(build_config(database, overrides), scheduler)
+    try:
+        began = time.time()
+        for message in messages:
+            bot.feed(message)
+        finished = bot.wait(timeout)
+        elapsed = time.time() - began
+    finally:
+        bot.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = sorted(bot.latencies)
+    report = [
+        'messages: {} handled, {} dropped, {} event calls dropped{}'.format(
+            len(latencies), bot.dispatcher.dropped, bot.event_pool.dropped,
+            '' if finished else ' (timed out)'),
+        'time: {:.3f}s, {:.1f} messages/s'.format(
+            elapsed, len(latencies) / elapsed if elapsed else 0.0),
+        'latency: p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms'.format(
+            *[percentile(latencies, fraction) * 1000
+              for fraction in (0.5, 0.95, 0.99, 1.0)]),
+        'outbound: {} messages ({} bytes), {}'.format(
+            bot.sent['message'], bot.sent_bytes, ', '.join(
+                '{} {}'.format(count, tag) for tag, count in sorted(bot.sent.items())
+                if tag != 'message')),
+        ]
+    report.extend(METRICS.render('command.'))
+    report.extend(METRICS.render('event.'))
+    report.extend(METRICS.render('db.'))
+    return report
+
+def main():
+    ''' Console script to replay a chat log, or synthetic messages. '''
+    parser = argparse.ArgumentParser(
+        description='Replay chat messages through Tombot without connecting')
+    parser.add_argument('log', nargs='?',
+                        help='chat log with one JSON message per line')
+    parser.add_argument('-n', '--messages', type=int, default=1000,
+                        help='number of synthetic messages, without a log')
+    parser.add_argument('-u', '--users', type=int, default=20,
+                        help='number of users in the temporary database')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed for synthetic messages')
+    parser.add_argument('-t', '--timeout', type=float, default=300.0,
+                        help='seconds to wait for the bot to catch up')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the bot\'s log')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL,
+        format='%(levelname)s - %(name)s - %(message)s')
+    if args.log:
+        messages = logged_messages(args.log)
+    else:
+        messages = synthetic_messages(args.messages, args.users, args.seed)
+    for line in replay(messages, args.users, args.timeout):
+        print(line)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+'''
+Contains the command router, which finds the trigger and command in a message.
+
+The router compiles the trigger words and command names into one anchored
+regular expression, so only the start of a message is looked at and messages
+not addressed to the bot are rejected after a few characters.
+'''
+import re
+from collections import namedtuple
+
+
+# trigger: the trigger word as typed, or None
+# name: the normalized (upper case, single-spaced) command name, a COMMAND_DICT key
+# command: the command as typed
+# query: the rest of the message after the command, stripped
+# end: offset in the body where the query starts
+RouteMatch = namedtuple('RouteMatch', 'trigger name command query end')
+
+def _alternation(words):
+    '''
+    Build a regex alternation matching any of the words, longest first.
+
+    Whitespace inside a word matches any run of whitespace, so multi-word
+    commands do not depend on exact spacing.
+    '''
+    parts = []
+    if not words:
+        return '(?!)'   # never matches
+    for word in sorted(set(words), key=len, reverse=True):
+        parts.append(r'\s+'.join(re.escape(piece) for piece in word.split()))
+    return '|'.join(parts)
+
+class CommandRouter(object):
+    ''' Matches trigger words and command names at the start of a message. '''
+    def __init__(self, triggers, commands):
+        '''
+        Compile a router.
+
+        triggers: iterable of trigger words, a trailing comma is optional when matching.
+        commands: iterable of command names (e.g. the keys of COMMAND_DICT).
+        '''
+        self.triggers = set(word.rstrip(',').upper() for word in triggers)
+        self.commands = set(' '.join(name.upper().split()) for name in commands)
+        trigger_part = r'(?P<trigger>{}),?\s+'.format(_alternation(self.triggers))
+        command_part = r'(?P<command>{})(?=\s|$)'.format(_alternation(self.commands))
+        self._group_regex = re.compile(
+            r'\s*' + trigger_part + command_part, re.IGNORECASE)
+        self._direct_regex = re.compile(
+            r'\s*' + command_part, re.IGNORECASE)
+
+    def route(self, body, require_trigger=False):
+        '''
+        Find the command a message is addressed to.
+
+        Returns a RouteMatch, or None if the message does not start with a
+        (trigger and a) known command.
+        '''
+        regex = self._group_regex if require_trigger else self._direct_regex
+        match = regex.match(body)
+        if match is None:
+            return None
+        command = match.group('command')
+        end = match.end()
+        return RouteMatch(
+            trigger=match.group('trigger') if require_trigger else None,
+            name=' '.join(command.upper().split()),
+            command=command,
+            query=body[end:].strip(),
+            end=end)
@@ -1,15 +1,88 @@
-''' Contains functions that poke the bot to do something on its own '''
+'''
+Contains functions that poke the bot to do something on its own.
+
+The RPC protocol is a stream of frames over one connection: every frame is
+a 4-byte big-endian length followed by that many bytes. A request frame
+holds the command and its arguments separated by \\x1c, the response frame
+holds the result. A client may send several requests before reading the
+responses, which come back in the same order.
+
+Connections are handled by a fixed pool of workers, but only while they
+have requests waiting: idle connections are watched by a single thread and
+handed to a worker when the next request arrives, so clients that keep a
+connection open can not starve the others. When all workers are busy and
+too many connections wait for one, a request is answered with RPC_BUSY
+and the connection is closed. Idle connections are closed after a timeout.
+
+The server listens on TCP, or on a Unix domain socket when given a path;
+only the bot's own user can connect to the socket file. Clients use the
+socket from the bot's config file (see use_config) or TOMBOT_RPC_SOCKET,
+and fall back to TCP.
+'''
+import argparse
+import errno
+import os
+import select
+import shutil
 import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
 import SocketServer
-from yowsup.layers.protocol_messages.protocolentities \
-        import TextMessageProtocolEntity
-from .registry import get_easy_logger, RPCCommand, RPC_DICT, safe_call
+from configobj import ConfigObj
+from validate import Validator
+from .dispatcher import Dispatcher
+from .metrics import METRICS
+from .registry import get_easy_logger, RPCCommand, RPC_DICT, EVENTS, safe_call
 
 
 LOGGER = get_easy_logger('rpc')
 RPC_OK = 'Ok.'
 RPC_FAIL = 'Error.'
 RPC_BYE = 'Bye.'
+RPC_BUSY = 'Busy.'
+RPC_SEPARATOR = '\x1c'
+DEFAULT_ADDRESS = ('localhost', 10666)
+SOCKET_ENV = 'TOMBOT_RPC_SOCKET'
+SOCKET_MODE = 0o600
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME = 1024 * 1024
+
+# Framing
+def _recv_exactly(sock, size):
+    ''' Read exactly size bytes, returns None if the peer closed first. '''
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def recv_frame(sock):
+    '''
+    Read one frame from sock.
+
+    Returns None on a clean end of stream, raises ValueError for oversized
+    or truncated frames.
+    '''
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    size = FRAME_HEADER.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ValueError('Frame of {} bytes exceeds limit'.format(size))
+    body = _recv_exactly(sock, size)
+    if body is None:
+        raise ValueError('Connection closed halfway through a frame')
+    return body
+
+def send_frame(sock, data):
+    ''' Write one frame containing data to sock. '''
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
 
 def scheduler_ping():
     ''' Ping '''
@@ -21,33 +94,214 @@ def rpc_ping_cb(bot, *args):
     return 'Pong: {}'.format(' '.join(args))
 
 class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
-    ''' Allow the bot to be poked to do stuff '''
+    '''
+    Allow the bot to be poked to do stuff, answers the requests that have arrived.
+
+    Sets keep_open when the client has no more requests for now, the server
+    then waits for the next one without holding a worker.
+    '''
+    keep_open = False
+
     def handle(self):
-        data = self.request.recv(1024)
-        args = data.split('\x1c')
-        LOGGER.debug('Args: %s', args)
-        response = RPC_FAIL
-        try:
-            response = safe_call(RPC_DICT, args[0], self, *args[1:])
-        except TypeError as ex:
-            response = 'TypeError {}'.format(ex)
-        except SystemExit:
-            response = RPC_BYE
-            self.request.send(response)
-            self.request.close()
-            self.server.shutdown()
-            return
-        LOGGER.debug('Response: %s', response)
-        self.request.sendall(response)
+        while True:
+            try:
+                data = recv_frame(self.request)
+            except (ValueError, socket.error) as ex:
+                LOGGER.warning('Dropping RPC connection: %s', ex)
+                return
+            if data is None:
+                return
+            args = data.split(RPC_SEPARATOR)
+            LOGGER.debug('Args: %s', args)
+            response = RPC_FAIL
+            try:
+                response = safe_call(RPC_DICT, args[0], self, *args[1:])
+            except TypeError as ex:
+                response = 'TypeError {}'.format(ex)
+            except KeyError:
+                response = 'Unknown command {}'.format(args[0])
+            except SystemExit:
+                send_frame(self.request, RPC_BYE)
+                self.request.close()
+                self.server.shutdown()
+                return
+            if response is None:
+                response = RPC_FAIL
+            LOGGER.debug('Response: %s', response)
+            send_frame(self.request, str(response))
+            if not select.select([self.request], [], [], 0)[0]:
+                self.keep_open = True
+                return
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    ''' Extended to have a reference to the currently running bot'''
+class ThreadedTCPServer(SocketServer.TCPServer):
+    '''
+    Extended to have a reference to the currently running bot.
+
+    server_address is a (host, port) tuple, or the path of a Unix domain
+    socket. Requests are handled by a pool of worker threads, at most
+    queue_size connections with requests wait for a free worker and further
+    ones are turned away with RPC_BUSY. Connections without requests are
+    watched by one thread. backlog is the listen backlog of the socket,
+    timeout the number of seconds a connection may stay silent.
+    '''
+    # pylint: disable=too-many-arguments
     allow_reuse_address = True
 
-    def __init__(self, server_address, RequestHandlerClass, bot, bind_and_activate=True):
+    def __init__(self, server_address, RequestHandlerClass, bot, bind_and_activate=True,
+                 workers=2, queue_size=8, backlog=5, timeout=30.0):
         self.bot = bot
+        self.socket_path = None     # set once we own a Unix socket file
+        if isinstance(server_address, basestring):
+            self.address_family = socket.AF_UNIX
+        self.request_queue_size = backlog
+        self.connection_timeout = timeout or None
+        self.pool = Dispatcher(workers=workers, queue_size=queue_size, name='rpc')
+        self._idle = {}     # connection -> (client address, idle since)
+        self._idle_lock = threading.Lock()
+        self._closed = False
+        self._wakeup, self._waker = socket.socketpair()
         SocketServer.TCPServer.__init__(
             self, server_address, RequestHandlerClass, bind_and_activate)
+        self.pool.start()
+        watcher = threading.Thread(target=self._watch_idle, name='rpc-idle')
+        watcher.daemon = True
+        watcher.start()
+
+    @property
+    def is_unix(self):
+        ''' Whether the server listens on a Unix domain socket. '''
+        return self.address_family == socket.AF_UNIX
+
+    def server_bind(self):
+        ''' Bind the socket, a Unix socket file is replaced if no bot uses it. '''
+        if self.is_unix:
+            path = self.server_address
+            remove_stale_socket(path)
+            # Bound inside a directory only we can enter and moved into place
+            # once chmodded, so nobody can connect before that.
+            private = tempfile.mkdtemp(prefix='.tombot-rpc-', dir=os.path.dirname(path) or '.')
+            try:
+                temp = os.path.join(private, 'rpc.sock')
+                self.socket.bind(temp)
+                os.chmod(temp, SOCKET_MODE)
+                os.rename(temp, path)
+            finally:
+                shutil.rmtree(private, ignore_errors=True)
+            self.socket_path = path
+            LOGGER.info('RPC listening on %s', path)
+        else:
+            SocketServer.TCPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        ''' Watch a new connection until its first request arrives. '''
+        request.settimeout(self.connection_timeout)
+        self._park(request, client_address)
+
+    def _park(self, request, client_address):
+        ''' Watch an idle connection for its next request. '''
+        with self._idle_lock:
+            self._idle[request] = (client_address, time.time())
+        self._waker.send('x')
+
+    def _dispatch(self, request, client_address):
+        ''' Hand a connection with a request to a worker, or turn it away if all are busy. '''
+        # Unix socket peers have no address, the connection itself is the key
+        if not self.pool.submit(request, self.process_request_worker,
+                                request, client_address):
+            LOGGER.warning('RPC server busy, refusing request from %s',
+                           client_address)
+            try:
+                send_frame(request, RPC_BUSY)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        ''' Answer the waiting requests on a pool worker, then watch the connection again. '''
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception: #pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        if handler is not None and handler.keep_open and not self._closed:
+            self._park(request, client_address)
+        else:
+            self.shutdown_request(request)
+
+    def _watch_idle(self):
+        ''' Idle watcher thread main loop. '''
+        while not self._closed:
+            with self._idle_lock:
+                connections = list(self._idle)
+            try:
+                readable = select.select(connections + [self._wakeup], [], [], 1.0)[0]
+            except (select.error, socket.error):
+                continue    # a connection was closed meanwhile, only at shutdown
+            if self._wakeup in readable:
+                self._wakeup.recv(4096)
+            now = time.time()
+            timeout = self.connection_timeout
+            with self._idle_lock:
+                ready = [(request, self._idle.pop(request)[0])
+                         for request in readable if request in self._idle]
+                expired = [request for request, (dummy, since) in self._idle.items()
+                           if timeout and now - since > timeout]
+                for request in expired:
+                    del self._idle[request]
+            for request, client_address in ready:
+                self._dispatch(request, client_address)
+            for request in expired:
+                LOGGER.debug('Closing idle RPC connection')
+                self.shutdown_request(request)
+        self._wakeup.close()
+        self._waker.close()
+
+    def server_close(self):
+        ''' Close the socket, the idle connections and stop the workers. '''
+        self._closed = True
+        try:
+            self._waker.send('x')
+        except socket.error:
+            pass    # closed twice
+        with self._idle_lock:
+            idle, self._idle = list(self._idle), {}
+        for request in idle:
+            self.shutdown_request(request)
+        SocketServer.TCPServer.server_close(self)
+        self.pool.stop(wait=False)
+        if self.socket_path:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+def remove_stale_socket(path):
+    '''
+    Remove the Unix socket file at path if no server is listening on it.
+
+    Raises socket.error if a server (e.g. another bot) still uses it, if
+    the path is not a socket, or if it can not tell whether it is in use.
+    '''
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError as ex:
+        if ex.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise socket.error('{} exists and is not a socket'.format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as ex:
+        if ex.errno != errno.ECONNREFUSED:
+            raise
+        LOGGER.info('Removing stale RPC socket %s', path)
+        os.unlink(path)
+    else:
+        raise socket.error('RPC socket {} is in use'.format(path))
+    finally:
+        probe.close()
 
 # The actual commands
 @RPCCommand('log')
@@ -58,13 +312,52 @@ def rpc_log_cb(bot, *args):
 
 @RPCCommand('send')
 def rpc_send_cb(handler, recipient, body, *args):
-    ''' Send a message to the bot ('''
+    '''
+    Send a message via the bot.
+
+    Answers RPC_BUSY without sending when the outbound queue is full, so
+    scripts can back off instead of pushing older messages out of the queue.
+    '''
+    bot = handler.server.bot
+    if bot.outbox.is_full():
+        LOGGER.warning('Outbound queue full, refusing to send to %s', recipient)
+        return RPC_BUSY
     LOGGER.info('Sending %s to %s', body, recipient)
-    msg = TextMessageProtocolEntity(
-        body, to=recipient)
-    handler.server.bot.toLower(msg)
+    bot.send_message(body, recipient)
     return RPC_OK
 
+@RPCCommand('queues')
+def rpc_queues_cb(handler, *args):
+    ''' Report the depth and counters of the dispatcher, event, RPC and outbound queues. '''
+    bot = handler.server.bot
+    lines = []
+    for name, stats in (('dispatcher', bot.dispatcher.stats()),
+                        ('events', bot.event_pool.stats()),
+                        ('rpc', handler.server.pool.stats()),
+                        ('outbound', bot.outbox.stats())):
+        lines.append('{}: {}'.format(name, ' '.join(
+            '{}={}'.format(key, stats[key]) for key in sorted(stats))))
+    return '\n'.join(lines)
+
+@RPCCommand('events')
+def rpc_events_cb(handler, *args):
+    ''' Report call counts, errors and timing of every event handler. '''
+    lines = []
+    for stats in EVENTS.stats():
+        lines.append('{event} {handler} priority={priority} background={background} '
+                     'calls={calls} errors={errors} avg={avg_ms:.2f}ms '
+                     'max={max_ms:.2f}ms'.format(**stats))
+    return '\n'.join(lines)
+
+@RPCCommand('stats')
+def rpc_stats_cb(handler, prefix='', *args):
+    '''
+    Report counters, latency histograms and queue depths.
+
+    Optionally only the metrics whose name starts with prefix, e.g. 'command.'.
+    '''
+    return '\n'.join(METRICS.render(prefix)) or 'No metrics.'
+
 @RPCCommand('shutdown')
 def rpc_shutdown_cb(handler, *args):
     ''' Exits the bot. '''
@@ -78,24 +371,146 @@ def rpc_restart_cb(handler, *args):
     return RPC_OK
 
 # Helper functions
-def rpc_call(command, *args):
-    ''' Call a function via the RPC socket. '''
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect(('localhost', 10666))
-    if args:
-        cmd = '{}\x1c{}'.format(command, '\x1c'.join(args))
+_CONFIGURED = {}    # 'address' and 'path' read by use_config()
+
+def use_config(configfile):
+    '''
+    Make clients in this process use the RPC settings of a bot's config file.
+
+    Its [RPC] host and port become the default address, and its socket is
+    tried first.
+    '''
+    specpath = os.path.join(os.path.dirname(__file__), 'configspec.ini')
+    config = ConfigObj(configfile, configspec=specpath)
+    config.validate(Validator(), copy=True)
+    rpc_conf = config['RPC']
+    _CONFIGURED['address'] = (rpc_conf['host'], rpc_conf['port'])
+    _CONFIGURED['path'] = rpc_conf['socket'] or None
+
+class RPCClient(object):
+    '''
+    Keeps a connection to the RPC socket open for any number of calls.
+
+    path is a Unix socket to try first, by default the one from use_config()
+    or else the TOMBOT_RPC_SOCKET environment variable; if there is none or
+    it cannot be connected to, the TCP address is used.
+    Use as a context manager, or call close() when done.
+    '''
+    def __init__(self, address=None, timeout=None, path=None):
+        self.address = address or _CONFIGURED.get('address', DEFAULT_ADDRESS)
+        self.timeout = timeout
+        if path is None:
+            path = _CONFIGURED.get('path') or os.environ.get(SOCKET_ENV)
+        self.path = path
+        self.sock = None
+
+    def connect(self):
+        '''
+        Open the connection if it is not open yet, or if the bot closed it.
+
+        Nothing is sent before the connection is known to be usable, so a
+        failure here means no request was delivered.
+        '''
+        self.drop_if_closed()
+        if self.sock is None and self.path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+                self.sock = sock
+            except socket.error as ex:
+                sock.close()
+                LOGGER.debug('Cannot use RPC socket %s (%s), trying TCP', self.path, ex)
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, self.timeout)
+        return self.sock
+
+    def drop_if_closed(self):
+        '''
+        Close an idle connection the bot has hung up on (or answered 'Busy.' on).
+
+        Between calls the bot sends nothing, so a readable socket means it
+        is no longer usable.
+        '''
+        if self.sock is not None and select.select([self.sock], [], [], 0)[0]:
+            LOGGER.debug('RPC connection closed by the bot, reconnecting')
+            self.close()
+
+    def close(self):
+        ''' Close the connection. '''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def encode(command, *args):
+        ''' Build the request payload for a command. '''
+        return RPC_SEPARATOR.join((command,) + args)
+
+    def call(self, command, *args):
+        ''' Call a function via the RPC socket and return its response. '''
+        return self.pipeline([(command,) + args])[0]
+
+    def pipeline(self, calls):
+        '''
+        Send several calls before reading any response.
+
+        calls is a sequence of (command, arg, ...) tuples; returns the
+        responses in the same order.
+        '''
+        sock = self.connect()
+        try:
+            for call in calls:
+                cmd = self.encode(*call)
+                LOGGER.debug(cmd)
+                send_frame(sock, cmd)
+            responses = []
+            for dummy in calls:
+                resp = recv_frame(sock)
+                if resp is None:
+                    raise socket.error('RPC connection closed by the bot')
+                LOGGER.debug(resp)
+                responses.append(resp)
+            return responses
+        except:
+            self.close()
+            raise
+
+_SHARED_CLIENT = None
+_SHARED_LOCK = threading.Lock()
+
+def rpc_call(command, *args, **kwargs):
+    '''
+    Call a function via the RPC socket, on a one-off connection.
+
+    Accepts the path keyword argument of RPCClient.
+    '''
+    with RPCClient(path=kwargs.get('path')) as client:
+        return client.call(command, *args)
+
+def remote_send(body, recipient, client=None):
+    '''
+    Send a single message via the local reacharound.
+
+    Without a client, a connection shared by all calls in this process is
+    used, it is reopened when the bot dropped it. A failure after the request
+    was sent is not retried, the bot may have queued the message already.
+    '''
+    global _SHARED_CLIENT
+    if client is not None:
+        resp = client.call('SEND', recipient, body)
     else:
-        cmd = command
-    LOGGER.debug(cmd)
-    sock.sendall(cmd)
-    resp = sock.recv(1024)
-    sock.close()
-    LOGGER.debug(resp)
-    return resp
-
-def remote_send(body, recipient):
-    ''' Send a single message via the local reacharound. '''
-    resp = rpc_call('SEND', recipient, body)
+        with _SHARED_LOCK:
+            if _SHARED_CLIENT is None:
+                _SHARED_CLIENT = RPCClient()
+            resp = _SHARED_CLIENT.call('SEND', recipient, body)
     if resp != RPC_OK:
         raise ValueError('Something happened. ({})'.format(resp))
 
@@ -106,3 +521,21 @@ def remote_shutdown():
 def remote_restart():
     ''' Convenience function to restart a running bot. '''
     rpc_call('restart')
+
+def _control_main(command, description):
+    ''' Send command to the bot whose config file is given on the command line. '''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('configfile', nargs='?',
+                        help='config file of the bot, to find its RPC socket')
+    args = parser.parse_args()
+    if args.configfile:
+        use_config(args.configfile)
+    return 0 if rpc_call(command) in (RPC_OK, RPC_BYE) else 1
+
+def shutdown_main():
+    ''' Console script to stop a running bot. '''
+    return _control_main('shutdown', 'Stop a running Tombot')
+
+def restart_main():
+    ''' Console script to restart a running bot. '''
+    return _control_main('restart', 'Restart a running Tombot')
@@ -0,0 +1,72 @@
+'''
+Contains the message view, which holds what handlers derive from a message.
+
+The view is built once when a message arrives and passed to the command
+and to the BOT_MSG_RECEIVE subscribers as the 'view' keyword argument, so
+the body is split, decoded and routed only once per message.
+'''
+
+
+class MessageView(object):
+    '''
+    Read-only summary of a received message.
+
+    message: the yowsup entity
+    body: the body as received (utf-8 bytes), text: the body decoded
+    tokens: the body split on whitespace
+    is_group: whether the message was sent in a group chat
+    sender: the author's jid, chat: the jid of the chat it was sent in
+    trigger_offset: number of tokens before the command (the trigger in groups)
+    route: the RouteMatch if the message is a command, else None
+    command: the COMMAND_DICT key of the command, or None
+    query: the text after the command (or after the first word if none matched)
+
+    text, tokens and query are computed on first use, most messages are not
+    commands and never need them.
+    '''
+    __slots__ = ('message', 'body', 'is_group', 'sender', 'chat',
+                 'trigger_offset', 'route', 'command', '_text', '_tokens', '_query')
+
+    def __init__(self, message, route=None):
+        self.message = message
+        self.body = message.getBody() or ''
+        self.is_group = bool(message.participant)
+        self.chat = message.getFrom()
+        self.sender = message.participant if self.is_group else self.chat
+        self.trigger_offset = 1 if self.is_group else 0
+        self.route = route
+        self.command = route.name if route is not None else None
+        self._text = None
+        self._tokens = None
+        self._query = route.query if route is not None else None
+
+    @property
+    def text(self):
+        ''' The body decoded from utf-8. '''
+        if self._text is None:
+            self._text = self.body.decode('utf-8', 'replace')
+        return self._text
+
+    @property
+    def tokens(self):
+        ''' The body split on whitespace. '''
+        if self._tokens is None:
+            self._tokens = self.body.split()
+        return self._tokens
+
+    @property
+    def query(self):
+        ''' The text after the command. '''
+        if self._query is None:
+            self._query = ' '.join(self.tokens[self.trigger_offset + 1:])
+        return self._query
+
+    @classmethod
+    def route_message(cls, message, router):
+        ''' Build the view of a message, routing it with a CommandRouter. '''
+        return cls(message, router.route(
+            message.getBody() or '', require_trigger=bool(message.participant)))
+
+    def __repr__(self):
+        return '<MessageView {} from {}: {!r}>'.format(
+            self.command, self.sender, self.body[:40])